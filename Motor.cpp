@@ -59,27 +59,41 @@ int Motor::disable() {
 
 /**
  * Moves the motor the given number of steps in the given amount of time. Polarity of the steps
- * argument determines the direction of the movement.
+ * argument determines the direction of the movement. If the previous move ended at a non zero
+ * exit frequency in the same direction, the profile starts from that frequency instead of from
+ * rest, and it ends at the given exit frequency so that consecutive moves blend into each other.
  */
-void Motor::moveSteps(int stepsToMove, int timeMillis) {
-    if (stepsToMove == 0) return;
+void Motor::moveSteps(int stepsToMove, int timeMillis, int exitFrequency) {
+    if (stepsToMove == 0) {
+        exitFreq = 0;
+        return;
+    }
     steps += stepsToMove;
     digitalWrite(dirPin, stepsToMove < 0);
 
+    // Entry frequency is only carried over if the motor keeps moving in the same direction
+    int fStart = (stepsToMove < 0) == reverse ? exitFreq : 0;
+    int fEnd = exitFrequency;
+    reverse = stepsToMove < 0;
+    exitFreq = fEnd;
+
     // Calculate speed profile
     stepsToMove = abs(stepsToMove);
     timeSlices = timeMillis / MOTOR_CONTROLLER_UPDATE_INTERVAL_MILLIS;
-    int fMax = stepsToMove / (float)timeMillis * 1000 * 2;
-    int fDelta = fMax / timeSlices * 2;
+    int midPoint = timeSlices / 2;
     int correctiveSteps = stepsToMove * 100;
 
+    // Peak frequency such that the area under the start -> peak -> end profile covers the steps
+    int fMax = (correctiveSteps * 2 - midPoint * fStart - (timeSlices - midPoint) * fEnd) /
+               timeSlices;
+    if (fMax < 0) fMax = 0;
+
     // Form frequency array
-    int midPoint = timeSlices / 2;
     freqs = (uint16_t*)malloc(sizeof(uint16_t) * timeSlices);
     for (int i = 0; i < timeSlices; i++) {
         freqs[i] = i < midPoint ?
-                    fDelta * i :
-                    fDelta * (timeSlices - i);
+                    fStart + (fMax - fStart) * i / midPoint :
+                    fEnd + (fMax - fEnd) * (timeSlices - i) / (timeSlices - midPoint);
         correctiveSteps -= freqs[i];
     }
 
@@ -16,7 +16,7 @@
 class Motor {
     public:
     void init(struct MotorConfig motorConfig);
-    void moveSteps(int steps, int timeMillis);
+    void moveSteps(int steps, int timeMillis, int exitFrequency = 0);
     int enable();
     int disable();
 
@@ -29,6 +29,8 @@ class Motor {
     int timeSlices = 0;
     int counter = 0;  // stores the number of pulses sent
     int target = 0;  // stores the target steps to move
+    int exitFreq = 0;  // frequency the previous move ended at, carried into a blended move
+    bool reverse = false;  // direction of the previous move
     uint16_t *freqs = NULL;  // stores frequency array
     hw_timer_t *timer = NULL;  // hardware timer of the motor
     portMUX_TYPE timerMux = portMUX_INITIALIZER_UNLOCKED;
@@ -98,11 +98,54 @@ int MotorController::setTime(int channel, int timeMillis) {
 
 
 /**
- * Initiates the move of the motor on the given channel.
+ * Sets the frequency the next move on the given channel should end at. A non zero exit frequency
+ * lets the following move on the channel continue without decelerating to a stop.
+ */
+int MotorController::setExitFreq(int channel, int freq) {
+    if (channel < 0 || channel >= numMotors || freq < 0) {
+        DPRINTLN("MC: Invalid channel number provided");
+        return 1;
+    }
+    exitFreqs[channel] = freq;
+    return 0;
+}
+
+
+/**
+ * Checks that the move on the given channel, or on every channel if the channel is -1, can
+ * be started. A channel with steps to move needs a time of at least one update interval, since
+ * the speed profile has one frequency per interval.
+ */
+int MotorController::checkMove(int channel) {
+    if (channel == -1) {
+        for (int i = 0; i < numMotors; i++) {
+            if (checkMove(i) != 0) {
+                return 1;
+            }
+        }
+        return 0;
+    }
+    if (channel < 0 || channel >= numMotors) {
+        DPRINTLN("MC: Invalid channel number provided");
+        return 1;
+    }
+    if (steps[channel] != 0 && times[channel] < MOTOR_CONTROLLER_UPDATE_INTERVAL_MILLIS) {
+        DPRINTLN("MC: Move time shorter than the update interval");
+        return 1;
+    }
+    return 0;
+}
+
+
+/**
+ * Initiates the move of the motor on the given channel. The steps and exit frequency only apply to
+ * the move they were set for, the time is kept for the next move.
  */
 void MotorController::move(int channel) {
-    DPRINTLN("MC: Move called on channel: " + String(channel) + " steps: " + String(steps[channel]) + " time: " + String(times[channel]));
-    motors[channel].moveSteps(steps[channel], times[channel]);
+    DPRINTLN("MC: Move called on channel: " + String(channel) + " steps: " + String(steps[channel]) + " time: " + String(times[channel]) + " exit: " + String(exitFreqs[channel]));
+    motors[channel].moveSteps(steps[channel], times[channel], exitFreqs[channel]);
+    steps[channel] = 0;
+    exitFreqs[channel] = 0;
 }
 
 
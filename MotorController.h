@@ -21,6 +21,8 @@ class MotorController {
     int disable(int channel);
     int setSteps(int channel, int steps);
     int setTime(int channel, int time);
+    int setExitFreq(int channel, int freq);
+    int checkMove(int channel);
     void move(int channel);
     bool running();
 
@@ -34,6 +36,7 @@ class MotorController {
     private:
     int steps[MAX_NUM_MOTORS];
     int times[MAX_NUM_MOTORS];
+    int exitFreqs[MAX_NUM_MOTORS] = {0};
     bool isInit = false;
 };
 
@@ -1,75 +1,113 @@
 #include "Parser.h"
-#include "Debug.h"
+#include <ctype.h>
+#include <stdlib.h>
+#include <string.h>
 
+#define TERMINATOR "\r\n\r\n"
+#define TERMINATOR_LENGTH 4
 
-int Parser::parse(String string, Command *command) {
-    // Check for empty string and split it into <command> <channel/pin> <arg>
-    if (!string.endsWith("\r\n\r\n")) {
+
+int Parser::parse(char *frame, size_t length, Command *command) {
+    // Check for the terminator and split the frame into <command> <channel/pin> <arg>
+    if (length < TERMINATOR_LENGTH ||
+        memcmp(frame + length - TERMINATOR_LENGTH, TERMINATOR, TERMINATOR_LENGTH) != 0) {
         return 1;
     }
-    if (split(string, command) != 0) {
+    if (split(frame, length, command) != 0) {
         return 1;
     }
     // Validate command and return
     return validate(*command);
 }
 
-int Parser::split(String string, Command *command) {
+int Parser::split(char *string, size_t length, Command *command) {
     // String should be in the format <command_code> <channel> [<arg>]\r\n\r\n
-    // Trim string and check if empty
-    string.trim();
-    if (string.length() <= 0) {
+    // Trim string in place and check if empty, the terminator is trimmed so there is room for the
+    // null character
+    char *start = string;
+    char *end = string + length;
+    while (start < end && isspace((unsigned char) *start)) start++;
+    while (end > start && isspace((unsigned char) end[-1])) end--;
+    if (start == end) {
         return 1;
     }
-    int firstSpace = string.indexOf(' ');
-    if (firstSpace != -1) {
-        command->type = string.substring(0, firstSpace);
-        int nextSpace = string.indexOf(' ', firstSpace + 1);
-        if (nextSpace != -1) {
-            command->channel = string.substring(firstSpace + 1, nextSpace).toInt();
-            command->arg = string.substring(nextSpace + 1).toFloat();
+    *end = '\0';
+    // Tokens are terminated in place, so numbers are read exactly as toInt and toFloat read the
+    // substrings they replace
+    char *firstSpace = strchr(start, ' ');
+    size_t typeLength = end - start;
+    if (firstSpace != NULL) {
+        typeLength = firstSpace - start;
+        char *nextSpace = strchr(firstSpace + 1, ' ');
+        if (nextSpace != NULL) {
+            *nextSpace = '\0';
+            command->channel = strtol(firstSpace + 1, NULL, 10);
+            command->arg = strtod(nextSpace + 1, NULL);
         } else {
-            command->channel = string.substring(firstSpace).toInt();
+            command->channel = strtol(firstSpace, NULL, 10);
         }
-    } else {
-        command->type = string.substring(0);
     }
+    // Every command type is a single character
+    command->type = typeLength == 1 ? *start : COMMAND_INVALID;
     return 0;
 }
 
-int Parser::validate(Command command) {
-    // Only channel must be provided for the following commands
-    if (command.type == ENABLE_SYMBOL || 
-        command.type == DISABLE_SYMBOL) {
-        return (!hasChannel(command) || hasArg(command));
-    }
+int Parser::validate(const Command &command) {
+    switch (command.type) {
+        // Only channel must be provided for the following commands
+        case ENABLE_SYMBOL:
+        case DISABLE_SYMBOL:
+        case TELEMETRY_SYMBOL:
+        case BAUD_SYMBOL:
+            return (!hasChannel(command) || hasArg(command));
 
-    // Channel and argument must be provided for the following commands
-    if (command.type == STEPS_SYMBOL || 
-        command.type == TIME_SYMBOL || 
-        command.type == PIN_SYMBOL) {
-        return (!hasChannel(command) || !hasArg(command));
-    }
+        // Channel and argument must be provided for the following commands
+        case STEPS_SYMBOL:
+        case TIME_SYMBOL:
+        case EXIT_FREQ_SYMBOL:
+        case PIN_SYMBOL:
+            return (!hasChannel(command) || !hasArg(command));
 
-    // Neither channel nor argument is required for the following commands
-    if (command.type == STATUS_SYMBOL || 
-        command.type == RESTART_SYMBOL) {
-        return (hasChannel(command) || hasArg(command));
-    }
+        // Neither channel nor argument is required for the following commands
+        case STATUS_SYMBOL:
+        case RESTART_SYMBOL:
+        case BOOT_ID_SYMBOL:
+            return (hasChannel(command) || hasArg(command));
 
-    // Channel is provided but arg is optional
-    if (command.type == START_SYMBOL) {
-        return (hasArg(command));
-    }
+        // Channel is provided but arg is optional
+        case START_SYMBOL:
+            return (hasArg(command));
 
-    // Unknown command type received
-    return 1;
+        // Unknown command type received
+        default:
+            return 1;
+    }
 }
 
-int Parser::hasChannel(Command command) {
+int Parser::hasChannel(const Command &command) {
     return command.channel != UNDEFINED;
 }
 
-int Parser::hasArg(Command command) {
+int Parser::hasArg(const Command &command) {
     return command.arg != UNDEFINED;
 }
+
+
+int FrameBuffer::push(char byte) {
+    if (length == MAX_FRAME_LENGTH) {
+        // Drop the oversized frame but keep its last bytes, so its terminator is still found
+        overflowed = true;
+        memmove(data, data + length - (TERMINATOR_LENGTH - 1), TERMINATOR_LENGTH - 1);
+        length = TERMINATOR_LENGTH - 1;
+    }
+    data[length++] = byte;
+    data[length] = '\0';
+    return length >= TERMINATOR_LENGTH &&
+        memcmp(data + length - TERMINATOR_LENGTH, TERMINATOR, TERMINATOR_LENGTH) == 0;
+}
+
+void FrameBuffer::clear() {
+    length = 0;
+    overflowed = false;
+    data[0] = '\0';
+}
@@ -1,45 +1,77 @@
 #ifndef PARSER_H
-#define PARSER
+#define PARSER_H
 
-#include "WString.h"
+#include <stddef.h>
 
-#define COMMAND_INVALID "I"
+#define COMMAND_INVALID 'I'
 #define UNDEFINED -1
 
-#define ENABLE_SYMBOL "E"
+// Largest frame the parser accepts, including the terminator
+#define MAX_FRAME_LENGTH 64
 
-#define DISABLE_SYMBOL "D"
+#define ENABLE_SYMBOL 'E'
 
-#define STEPS_SYMBOL "S"
+#define DISABLE_SYMBOL 'D'
 
-#define TIME_SYMBOL "T"
+#define STEPS_SYMBOL 'S'
 
-#define START_SYMBOL "G"
+#define TIME_SYMBOL 'T'
 
-#define STATUS_SYMBOL "?"
+#define EXIT_FREQ_SYMBOL 'V'
 
-#define RESTART_SYMBOL "R"
+#define START_SYMBOL 'G'
 
-#define PIN_SYMBOL "P"
+#define STATUS_SYMBOL '?'
+
+#define RESTART_SYMBOL 'R'
+
+#define PIN_SYMBOL 'P'
+
+#define TELEMETRY_SYMBOL 'L'
+
+#define BOOT_ID_SYMBOL 'U'
+
+#define BAUD_SYMBOL 'N'
 
 
 struct Command
 {
-    String type = "";
+    char type = COMMAND_INVALID;
     int channel = UNDEFINED;
     float arg = UNDEFINED;
 };
 
 
+/**
+ * Parses frames in place without allocating. The frame buffer is tokenized by overwriting
+ * separators with null characters, so it must be writable and is clobbered by parsing.
+ */
 class Parser {
     public:
-    int parse(String string, Command *command);
+    int parse(char *frame, size_t length, Command *command);
 
     private:
-    int split(String string, Command *command);
-    int validate(Command command);
-    int hasChannel(Command command);
-    int hasArg(Command command);
+    int split(char *string, size_t length, Command *command);
+    int validate(const Command &command);
+    int hasChannel(const Command &command);
+    int hasArg(const Command &command);
+};
+
+
+/**
+ * Accumulates received bytes in a fixed buffer until a frame terminator arrives. Bytes of an
+ * oversized frame are dropped up to its terminator, and the frame is reported as overflowed.
+ */
+class FrameBuffer {
+    public:
+    // Returns 1 once the byte completes a frame, 0 otherwise
+    int push(char byte);
+    // Starts the next frame, to be called after a completed frame was handled
+    void clear();
+
+    char data[MAX_FRAME_LENGTH + 1];
+    size_t length = 0;
+    bool overflowed = false;
 };
 
 #endif
@@ -0,0 +1,126 @@
+#ifndef WSTRING_H
+#define WSTRING_H
+
+// Minimal host shim of the Arduino String class, covering what the String based parser used. Like
+// the Arduino class it keeps its characters on the heap and reallocates as it grows.
+
+#include <ctype.h>
+#include <stdlib.h>
+#include <string.h>
+
+
+class String {
+    public:
+    String(const char *string = "") {
+        assign(string, strlen(string));
+    }
+
+    explicit String(char c) {
+        char string[2] = {c, '\0'};
+        assign(string, c == '\0' ? 0 : 1);
+    }
+
+    String(const String &other) {
+        assign(other.buffer, other.len);
+    }
+
+    ~String() {
+        delete[] buffer;
+    }
+
+    String &operator=(const String &other) {
+        if (this != &other) {
+            delete[] buffer;
+            assign(other.buffer, other.len);
+        }
+        return *this;
+    }
+
+    String &operator+=(const String &other) {
+        char *grown = new char[len + other.len + 1];
+        memcpy(grown, buffer, len);
+        memcpy(grown + len, other.buffer, other.len + 1);
+        delete[] buffer;
+        buffer = grown;
+        len += other.len;
+        return *this;
+    }
+
+    bool operator==(const char *string) const {
+        return strcmp(buffer, string) == 0;
+    }
+
+    unsigned int length() const {
+        return len;
+    }
+
+    const char *c_str() const {
+        return buffer;
+    }
+
+    bool endsWith(const char *suffix) const {
+        size_t suffixLength = strlen(suffix);
+        return suffixLength <= len && strcmp(buffer + len - suffixLength, suffix) == 0;
+    }
+
+    void trim() {
+        size_t start = 0;
+        size_t end = len;
+        while (start < end && isspace((unsigned char) buffer[start])) start++;
+        while (end > start && isspace((unsigned char) buffer[end - 1])) end--;
+        memmove(buffer, buffer + start, end - start);
+        len = end - start;
+        buffer[len] = '\0';
+    }
+
+    int indexOf(char c, unsigned int from = 0) const {
+        if (from >= len) {
+            return -1;
+        }
+        const char *found = strchr(buffer + from, c);
+        return found == NULL ? -1 : found - buffer;
+    }
+
+    String substring(unsigned int begin) const {
+        return substring(begin, len);
+    }
+
+    String substring(unsigned int begin, unsigned int end) const {
+        if (begin > end) {
+            unsigned int swap = begin;
+            begin = end;
+            end = swap;
+        }
+        if (begin >= len) {
+            return String();
+        }
+        if (end > len) {
+            end = len;
+        }
+        String result;
+        delete[] result.buffer;
+        result.assign(buffer + begin, end - begin);
+        return result;
+    }
+
+    long toInt() const {
+        return atol(buffer);
+    }
+
+    float toFloat() const {
+        return atof(buffer);
+    }
+
+    private:
+    void assign(const char *string, size_t length) {
+        buffer = new char[length + 1];
+        memcpy(buffer, string, length);
+        buffer[length] = '\0';
+        len = length;
+    }
+
+    char *buffer;
+    size_t len;
+};
+
+#endif
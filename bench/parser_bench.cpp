@@ -0,0 +1,254 @@
+// Host benchmark of the firmware command parser. The fixed buffer parser is first checked for parity
+// with the String based parser it replaced, on hand written edge cases and random frames, then both
+// are timed on a stream of typical move frames, including the byte by byte reading of readSerial.
+//
+// Build and run from the repository root:
+//     g++ -O2 -std=c++11 -I. -Ibench bench/parser_bench.cpp Parser.cpp -o parser_bench
+//     ./parser_bench
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <new>
+#include <random>
+#include <string>
+#include <vector>
+#include "Parser.h"
+#include "WString.h"
+
+
+static size_t allocations = 0;
+
+void *operator new(size_t size) {
+    allocations++;
+    void *pointer = malloc(size);
+    if (pointer == NULL) throw std::bad_alloc();
+    return pointer;
+}
+
+void *operator new[](size_t size) {
+    allocations++;
+    void *pointer = malloc(size);
+    if (pointer == NULL) throw std::bad_alloc();
+    return pointer;
+}
+
+void operator delete(void *pointer) noexcept { free(pointer); }
+void operator delete[](void *pointer) noexcept { free(pointer); }
+void operator delete(void *pointer, size_t) noexcept { free(pointer); }
+void operator delete[](void *pointer, size_t) noexcept { free(pointer); }
+
+
+// The String based parser as it was before the fixed buffer parser
+struct LegacyCommand
+{
+    String type = "";
+    int channel = UNDEFINED;
+    float arg = UNDEFINED;
+};
+
+class LegacyParser {
+    public:
+    int parse(String string, LegacyCommand *command) {
+        if (!string.endsWith("\r\n\r\n")) {
+            return 1;
+        }
+        if (split(string, command) != 0) {
+            return 1;
+        }
+        return validate(*command);
+    }
+
+    private:
+    int split(String string, LegacyCommand *command) {
+        string.trim();
+        if (string.length() <= 0) {
+            return 1;
+        }
+        int firstSpace = string.indexOf(' ');
+        if (firstSpace != -1) {
+            command->type = string.substring(0, firstSpace);
+            int nextSpace = string.indexOf(' ', firstSpace + 1);
+            if (nextSpace != -1) {
+                command->channel = string.substring(firstSpace + 1, nextSpace).toInt();
+                command->arg = string.substring(nextSpace + 1).toFloat();
+            } else {
+                command->channel = string.substring(firstSpace).toInt();
+            }
+        } else {
+            command->type = string.substring(0);
+        }
+        return 0;
+    }
+
+    int validate(LegacyCommand command) {
+        if (command.type == "E" || command.type == "D" || command.type == "L" ||
+            command.type == "N") {
+            return (!hasChannel(command) || hasArg(command));
+        }
+        if (command.type == "S" || command.type == "T" || command.type == "V" ||
+            command.type == "P") {
+            return (!hasChannel(command) || !hasArg(command));
+        }
+        if (command.type == "?" || command.type == "R" || command.type == "U") {
+            return (hasChannel(command) || hasArg(command));
+        }
+        if (command.type == "G") {
+            return (hasArg(command));
+        }
+        return 1;
+    }
+
+    int hasChannel(LegacyCommand command) {
+        return command.channel != UNDEFINED;
+    }
+
+    int hasArg(LegacyCommand command) {
+        return command.arg != UNDEFINED;
+    }
+};
+
+
+// Reads a frame the way readSerial did, one String per byte
+static String legacyRead(const std::string &frame) {
+    String buf = "";
+    for (size_t i = 0; i < frame.size() && !buf.endsWith("\r\n\r\n"); i++) {
+        buf += String(frame[i]);
+    }
+    return buf;
+}
+
+// Reads a frame the way readSerial does, into the frame buffer
+static bool read(FrameBuffer *frameBuffer, const std::string &frame) {
+    for (size_t i = 0; i < frame.size(); i++) {
+        if (frameBuffer->push(frame[i])) {
+            return true;
+        }
+    }
+    return false;
+}
+
+
+static std::vector<std::string> corpus() {
+    std::vector<std::string> frames = {
+        "E 0\r\n\r\n", "D 2\r\n\r\n", "S 0 1234\r\n\r\n", "S 1 -1234\r\n\r\n", "T 0 421.7\r\n\r\n",
+        "V 2 500\r\n\r\n", "G\r\n\r\n", "G 1\r\n\r\n", "?\r\n\r\n", "R\r\n\r\n", "U\r\n\r\n",
+        "L 20\r\n\r\n", "N 921600\r\n\r\n", "P 2 1\r\n\r\n", "", "\r\n\r\n", "   \r\n\r\n",
+        "S 0 12", "S 0\r\n\r\n", "S  0 5\r\n\r\n", "S 0  5\r\n\r\n", "E\r\n\r\n", "E 0 1\r\n\r\n",
+        "G 1 2\r\n\r\n", "? 1\r\n\r\n", "EX 0\r\n\r\n", "X 0\r\n\r\n", "S -1 5\r\n\r\n",
+        "S 0 -1\r\n\r\n", "T 0 -1.0\r\n\r\n", "S 0 abc\r\n\r\n", "S x 5\r\n\r\n", "E 1x\r\n\r\n",
+        "T 0 .5\r\n\r\n", "T 0 5.\r\n\r\n", "T 0 +3\r\n\r\n", "\tS 0 1 \r\n\r\n", "S 0 1 2\r\n\r\n",
+        "L -5\r\n\r\n", "G -1\r\n\r\n", "S 0 1e3\r\n\r\n", "S 2147483647 1\r\n\r\n",
+    };
+    std::mt19937 random(1);
+    const std::string alphabet = "ESTVG?RPLUNX -0123456789.+e\t\r\n";
+    for (int i = 0; i < 200000; i++) {
+        std::string frame;
+        size_t length = random() % 20;
+        for (size_t j = 0; j < length; j++) {
+            frame += alphabet[random() % alphabet.size()];
+        }
+        if (random() % 8 != 0) {
+            frame += "\r\n\r\n";
+        }
+        frames.push_back(frame);
+    }
+    return frames;
+}
+
+
+// Checks that both parsers accept the same frames with the same values
+static int parity() {
+    Parser parser;
+    LegacyParser legacyParser;
+    int mismatches = 0;
+    std::vector<std::string> frames = corpus();
+    for (const std::string &frame : frames) {
+        // Frames are read up to the first terminator by both readSerial versions
+        String legacyFrame = legacyRead(frame);
+        std::string text(legacyFrame.c_str());
+        if (text.size() > MAX_FRAME_LENGTH) {
+            continue;
+        }
+        char buffer[MAX_FRAME_LENGTH + 1];
+        memcpy(buffer, text.c_str(), text.size() + 1);
+        Command command;
+        LegacyCommand legacyCommand;
+        int validity = parser.parse(buffer, text.size(), &command);
+        int legacyValidity = legacyParser.parse(legacyFrame, &legacyCommand);
+        bool same = validity == legacyValidity;
+        if (same && validity == 0) {
+            same = String(command.type) == legacyCommand.type.c_str() &&
+                command.channel == legacyCommand.channel && command.arg == legacyCommand.arg;
+        }
+        if (!same) {
+            if (mismatches++ < 10) {
+                printf("mismatch on %s: %d %c %d %f, expected %d %s %d %f\n", text.c_str(),
+                       validity, command.type, command.channel, command.arg, legacyValidity,
+                       legacyCommand.type.c_str(), legacyCommand.channel, legacyCommand.arg);
+            }
+        }
+    }
+    printf("parity: %zu frames, %d mismatches\n", frames.size(), mismatches);
+    return mismatches;
+}
+
+
+template <typename Function>
+static void benchmark(const char *name, const std::vector<std::string> &stream, Function parse) {
+    using clock = std::chrono::steady_clock;
+    const int rounds = 200000;
+    std::vector<double> latencies;
+    latencies.reserve(stream.size() * rounds / 10);
+    size_t allocationsBefore = allocations;
+    int failures = 0;
+    clock::time_point start = clock::now();
+    for (int round = 0; round < rounds; round++) {
+        for (const std::string &frame : stream) {
+            if (round % 10 == 0) {
+                clock::time_point frameStart = clock::now();
+                failures += parse(frame);
+                latencies.push_back(
+                    std::chrono::duration<double, std::nano>(clock::now() - frameStart).count()
+                );
+            } else {
+                failures += parse(frame);
+            }
+        }
+    }
+    double elapsed = std::chrono::duration<double>(clock::now() - start).count();
+    size_t frames = stream.size() * rounds;
+    std::sort(latencies.begin(), latencies.end());
+    printf("%-8s %8.0f frames/s  %6.1f ns/frame  p50 %6.0f ns  p99 %6.0f ns  max %8.0f ns  "
+           "%5.2f allocations/frame  %d failures\n",
+           name, frames / elapsed, elapsed * 1e9 / frames, latencies[latencies.size() / 2],
+           latencies[latencies.size() * 99 / 100], latencies.back(),
+           (double) (allocations - allocationsBefore) / frames,
+           failures);
+}
+
+
+int main() {
+    if (parity() != 0) {
+        return 1;
+    }
+    std::vector<std::string> stream = {
+        "S 0 1234\r\n\r\n", "T 0 421.7\r\n\r\n", "V 0 500\r\n\r\n", "S 1 -87\r\n\r\n",
+        "T 1 421.7\r\n\r\n", "S 2 15\r\n\r\n", "T 2 421.7\r\n\r\n", "G\r\n\r\n", "?\r\n\r\n",
+    };
+    Parser parser;
+    FrameBuffer frameBuffer;
+    benchmark("fixed", stream, [&](const std::string &frame) {
+        Command command;
+        int validity = read(&frameBuffer, frame) ?
+            parser.parse(frameBuffer.data, frameBuffer.length, &command) : 1;
+        frameBuffer.clear();
+        return validity;
+    });
+    LegacyParser legacyParser;
+    benchmark("string", stream, [&](const std::string &frame) {
+        LegacyCommand command;
+        return legacyParser.parse(legacyRead(frame), &command);
+    });
+    return 0;
+}
@@ -20,9 +20,36 @@
 #define COM_RX 14
 #define COM_TX 27
 #define SERIAL_COM Serial
+#define SERIAL_BAUD 115200
 #define sendDoneSignal() SERIAL_COM.println("0\r\n\r\n")
 #define sendErrorSignal() SERIAL_COM.println("1\r\n\r\n")
+#define sendMoveDoneSignal() SERIAL_COM.println("!0\r\n\r\n")
 Parser commandParser;
+FrameBuffer frameBuffer;
+
+// Interval in milliseconds between telemetry frames sent during movement, 0 disables telemetry
+int telemetryInterval = 0;
+unsigned long lastTelemetry = 0;
+
+// Random number drawn at boot which lets the host tell whether the controller has been reset. It
+// is at least 2 so that it cannot be mistaken for a status code.
+long bootId = 0;
+
+// Baud rate negotiation. A new baud rate is only kept once a valid frame is received at it,
+// otherwise the link falls back to the previous baud rate after BAUD_CONFIRM_MILLIS.
+#define BAUD_CONFIRM_MILLIS 1000
+long baudRate = SERIAL_BAUD;
+long fallbackBaudRate = SERIAL_BAUD;
+bool baudPending = false;
+unsigned long baudSwitched = 0;
+
+// Moves run in the background while frames keep being served. G replies as soon as the move has
+// started, and the completion of the move is reported with a separate !0 frame. One more move can
+// be queued behind the running one, it starts with the registers set when it was queued as soon as
+// the running move completes, so the registers cannot be changed while a move is queued.
+bool moving = false;
+bool moveQueued = false;
+int queuedChannel = UNDEFINED;
 
 #define FOR_PICKER
 
@@ -35,8 +62,9 @@ Parser commandParser;
 void setup() {
     DPRINT_BEGIN(115200);
     // SERIAL_COM.begin(115200, SERIAL_8N1, COM_RX, COM_TX);
-    SERIAL_COM.begin(115200);
+    SERIAL_COM.begin(SERIAL_BAUD);
     DPRINTLN("Running setup");
+    bootId = (esp_random() & 0x3FFFFFFF) + 2;
     
     // Prepare array of up to 3 motor configs to be passed into the motor controller.
     MotorConfig configs[NUM_MOTORS];
@@ -75,16 +103,23 @@ void setup() {
 
 void loop() {
     serveSerial();
+    serveMotion();
+    serveBaudFallback();
 }
 
 
 void serveSerial() {
-    if (SERIAL_COM.available()) {
-        String recv = readSerial();
+    if (readSerial()) {
         Command command;
-        DPRINT(recv);
-        int validity = commandParser.parse(recv, &command);
+        DPRINT(frameBuffer.data);
+        int validity = frameBuffer.overflowed ? 1 :
+            commandParser.parse(frameBuffer.data, frameBuffer.length, &command);
+        frameBuffer.clear();
         bool error = false;
+        if (validity == 0) {
+            // A valid frame confirms a negotiated baud rate
+            baudPending = false;
+        }
         if (validity != 0) {
             error = true;
         } else if (command.type == ENABLE_SYMBOL) {
@@ -99,6 +134,10 @@ void serveSerial() {
                 DPRINTLN("Error disabling channel");
                 error = true;
             }
+        } else if (moveQueued && (command.type == STEPS_SYMBOL || command.type == TIME_SYMBOL ||
+                                  command.type == EXIT_FREQ_SYMBOL)) {
+            DPRINTLN("Registers are held by the queued move");
+            error = true;
         } else if (command.type == STEPS_SYMBOL) {
             DPRINTLN("Setting steps: " + String(command.channel) + " to: " + String(command.arg));
             if (motorController.setSteps(command.channel, command.arg) != 0) {
@@ -111,26 +150,61 @@ void serveSerial() {
                 DPRINTLN("Error setting time");
                 error = true;
             }
+        } else if (command.type == EXIT_FREQ_SYMBOL) {
+            DPRINTLN("Setting exit frequency: " + String(command.channel) + " to: " + String(command.arg));
+            if (motorController.setExitFreq(command.channel, command.arg) != 0) {
+                DPRINTLN("Error setting exit frequency");
+                error = true;
+            }
         } else if (command.type == START_SYMBOL) {
-            if (command.channel == -1) {
-                DPRINTLN("Moving all");
-                for (int i = 0; i < NUM_MOTORS; i++) {
-                    motorController.move(i);
-                }
+            if (moveQueued) {
+                DPRINTLN("A move is already queued");
+                error = true;
+            } else if (motorController.checkMove(command.channel) != 0) {
+                DPRINTLN("Invalid move");
+                error = true;
+            } else if (moving) {
+                DPRINTLN("Queueing move: " + String(command.channel));
+                moveQueued = true;
+                queuedChannel = command.channel;
             } else {
-                DPRINTLN("Moving: " + String(command.channel));
-                motorController.move(command.channel);
+                startMove(command.channel);
             }
-            while (motorController.running()) yield();
         } else if (command.type == STATUS_SYMBOL) {
             DPRINTLN("Status query");
-            if (motorController.running()) {
+            if (moving) {
                 error = true;
             }
         } else if (command.type == RESTART_SYMBOL) {
             DPRINTLN("Restarting");
             sendDoneSignal();
             ESP.restart();
+        } else if (command.type == TELEMETRY_SYMBOL) {
+            DPRINTLN("Setting telemetry interval: " + String(command.channel));
+            if (command.channel < 0) {
+                error = true;
+            } else {
+                telemetryInterval = command.channel;
+            }
+        } else if (command.type == BOOT_ID_SYMBOL) {
+            DPRINTLN("Boot id query");
+            SERIAL_COM.println(String(bootId) + "\r\n\r\n");
+            return;
+        } else if (command.type == BAUD_SYMBOL) {
+            DPRINTLN("Switching baud rate to: " + String(command.channel));
+            if (command.channel <= 0) {
+                error = true;
+            } else {
+                // Reply at the current baud rate before switching
+                sendDoneSignal();
+                SERIAL_COM.flush();
+                fallbackBaudRate = baudRate;
+                baudRate = command.channel;
+                SERIAL_COM.updateBaudRate(baudRate);
+                baudPending = true;
+                baudSwitched = millis();
+                return;
+            }
         } else if (command.type == PIN_SYMBOL) {
             DPRINTLN("Setting pin: " + String(command.channel) + " to: " + String(command.arg));
             digitalWrite(command.channel, command.arg);
@@ -146,10 +220,99 @@ void serveSerial() {
 }
 
 
-String readSerial() {
-    String buf = "";
-    while (SERIAL_COM.available() && !buf.endsWith("\r\n\r\n")) {
-        buf += String(char(SERIAL_COM.read()));
+/**
+ * Starts a move on a channel, or on all channels if the channel is undefined, without waiting for
+ * it to complete.
+ */
+void startMove(int channel) {
+    if (channel == UNDEFINED) {
+        DPRINTLN("Moving all");
+        for (int i = 0; i < NUM_MOTORS; i++) {
+            motorController.move(i);
+        }
+    } else {
+        DPRINTLN("Moving: " + String(channel));
+        motorController.move(channel);
+    }
+    moving = true;
+}
+
+
+/**
+ * Sends telemetry during a move and reports its completion once motion ends, then starts the
+ * queued move if there is one.
+ */
+void serveMotion() {
+    if (!moving) {
+        return;
+    }
+    if (motorController.running()) {
+        serveTelemetry();
+        return;
+    }
+    moving = false;
+    if (telemetryInterval > 0) sendTelemetry();
+    if (moveQueued) {
+        moveQueued = false;
+        startMove(queuedChannel);
+    }
+    sendMoveDoneSignal();
+}
+
+
+/**
+ * Falls back to the previous baud rate if no valid frame was received at a negotiated baud rate
+ * within BAUD_CONFIRM_MILLIS.
+ */
+void serveBaudFallback() {
+    if (baudPending && millis() - baudSwitched >= BAUD_CONFIRM_MILLIS) {
+        DPRINTLN("Baud rate not confirmed, falling back to: " + String(fallbackBaudRate));
+        baudRate = fallbackBaudRate;
+        SERIAL_COM.updateBaudRate(baudRate);
+        baudPending = false;
+    }
+}
+
+
+/**
+ * Sends a telemetry frame if the telemetry interval has elapsed since the last one.
+ */
+void serveTelemetry() {
+    if (telemetryInterval > 0 && millis() - lastTelemetry >= telemetryInterval) {
+        sendTelemetry();
+    }
+}
+
+
+/**
+ * Sends a telemetry frame with the pulse counter, pulse target and time slice of every channel in
+ * the format @<counter>,<target>,<time slice>;<counter>,<target>,<time slice>;...
+ */
+void sendTelemetry() {
+    lastTelemetry = millis();
+    SERIAL_COM.print('@');
+    for (int i = 0; i < motorController.numMotors; i++) {
+        if (i > 0) SERIAL_COM.print(';');
+        SERIAL_COM.print(motorController.motors[i].counter);
+        SERIAL_COM.print(',');
+        SERIAL_COM.print(motorController.motors[i].target);
+        SERIAL_COM.print(',');
+        SERIAL_COM.print(motorController.motors[i].currentTimeSlice);
+    }
+    SERIAL_COM.print("\r\n\r\n");
+}
+
+
+/**
+ * Reads the available bytes into the frame buffer until a frame is complete. A partial frame is
+ * kept until the rest of it arrives.
+ * Returns whether a complete frame is in the frame buffer.
+ */
+bool readSerial() {
+    while (SERIAL_COM.available()) {
+        if (frameBuffer.push(char(SERIAL_COM.read()))) {
+            return true;
+        }
     }
-    return buf;
+    return false;
 }
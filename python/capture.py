@@ -0,0 +1,303 @@
+'''
+Capture of the serial traffic between the host and the motor controllers, and deterministic replay
+of a captured session without the hardware.
+
+A capture file starts with MAGIC followed by records of a RECORD header (time in microseconds
+since the start of the capture, kind, stream, payload length) and the payload. A NAME record maps a
+stream number to the name of a motor controller, SENT records hold a frame written to it and
+RECEIVED records hold the bytes read from it. HEARTBEAT records hold a heartbeat frame written to
+it, heartbeats are left out of a replay together with their replies since they depend on timing.
+
+Usage:
+    python -m python.capture dump <capture path>
+    python -m python.capture replay <config path> <capture path> <program path> [--fast]
+'''
+import argparse
+import struct
+import threading
+from collections import deque, namedtuple
+from time import monotonic
+from python.exception import ReplayError
+from python.motorcontroller import MotorController
+from python.robotarm import RobotArm
+
+
+MAGIC = b'PRAC\x01'
+RECORD = struct.Struct('<QBBH')
+NAME = 0
+SENT = 1
+RECEIVED = 2
+HEARTBEAT = 3
+KINDS = {NAME: 'name', SENT: 'sent', RECEIVED: 'received', HEARTBEAT: 'heartbeat'}
+TERMINATOR = b'\r\n\r\n'
+
+Record = namedtuple('Record', ['time', 'kind', 'name', 'data'])
+
+
+class Recorder:
+    '''
+    Writes the traffic of any number of motor controllers to one capture file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = monotonic()
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def stream(self, name):
+        '''
+        :return: Stream number of the motor controller with the given name.
+        '''
+        with self.lock:
+            if name not in self.streams:
+                self.streams[name] = len(self.streams)
+                self._write(NAME, self.streams[name], name.encode())
+            return self.streams[name]
+
+    def sent(self, stream, data, heartbeat=False):
+        '''
+        Records a frame sent to a motor controller.
+        :param stream: Stream number of the motor controller.
+        :param heartbeat: Whether the frame is a heartbeat.
+        '''
+        self._record(HEARTBEAT if heartbeat else SENT, stream, data)
+
+    def received(self, stream, data):
+        '''
+        Records bytes received from a motor controller.
+        :param stream: Stream number of the motor controller.
+        '''
+        self._record(RECEIVED, stream, data)
+
+    def _record(self, kind, stream, data):
+        with self.lock:
+            if not self.file.closed:
+                self._write(kind, stream, data)
+
+    def _write(self, kind, stream, data):
+        time = int((monotonic() - self.start) * 1000000)
+        # Payloads longer than a record can hold are split over several records
+        for i in range(0, max(1, len(data)), 0xFFFF):
+            chunk = data[i:i + 0xFFFF]
+            self.file.write(RECORD.pack(time, kind, stream, len(chunk)))
+            self.file.write(chunk)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load(path):
+    '''
+    Reads a capture file.
+    :return: Generator of Records, times are in seconds.
+    '''
+    with open(path, 'rb') as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ReplayError(f'{path} is not a capture file')
+        names = {}
+        while True:
+            header = capture_file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            time, kind, stream, length = RECORD.unpack(header)
+            data = capture_file.read(length)
+            if kind == NAME:
+                names[stream] = data.decode()
+                continue
+            yield Record(time / 1000000, kind, names.get(stream, str(stream)), data)
+
+
+def skipheartbeats(records):
+    '''
+    Leaves the heartbeats and their replies out of the records of one motor controller. Replies
+    are matched to the frames sent in order, the same way MotorController matches them, and a
+    reply split over several records is passed on once it is complete.
+    :param records: Records of a single motor controller.
+    :return: Generator of Records.
+    '''
+    awaiting = deque()  # whether each frame waiting for a reply is a heartbeat
+    partial = b''
+    for record in records:
+        if record.kind in (SENT, HEARTBEAT):
+            awaiting.append(record.kind == HEARTBEAT)
+            if record.kind == SENT:
+                yield record
+            continue
+        if record.kind != RECEIVED:
+            yield record
+            continue
+        partial += record.data
+        data = b''
+        while TERMINATOR in partial:
+            end = partial.index(TERMINATOR) + len(TERMINATOR)
+            frame, partial = partial[:end], partial[end:]
+            stripped = frame.strip()
+            # Telemetry and move completions are not replies
+            if stripped and not stripped.startswith((b'@', b'!')) and awaiting:
+                if awaiting.popleft():
+                    continue
+            data += frame
+        if data:
+            yield record._replace(data=data)
+
+
+class ReplaySerial:
+    '''
+    Serial port like object which answers the frames written to it with the bytes received from a
+    motor controller in a capture. Every frame written must match the next frame sent in the
+    capture. The replies are delivered after the same delay as in the capture, or straight away if
+    replaying as fast as possible.
+    '''
+    def __init__(self, records, name, realtime=True, timeout=None):
+        '''
+        :param records: Records of the capture.
+        :param name: Name of the motor controller to replay.
+        :param realtime: Whether to deliver replies with their original timing.
+        :param timeout: Read timeout in seconds.
+        '''
+        self.name = name
+        self.realtime = realtime
+        self.timeout = timeout
+        self.records = deque(skipheartbeats(record for record in records if record.name == name))
+        self.received = b''
+        self.buffer = b''
+        self.scheduled = deque()  # (time the bytes become readable, bytes)
+        self.condition = threading.Condition()
+        self.is_open = True
+        # Anything received before the first frame was sent, e.g. boot messages
+        with self.condition:
+            self._schedule(self.records[0].time if self.records else 0)
+
+    def _schedule(self, sent_time):
+        now = monotonic()
+        while self.records and self.records[0].kind == RECEIVED:
+            record = self.records.popleft()
+            delay = record.time - sent_time if self.realtime else 0
+            self.scheduled.append((now + max(0, delay), record.data))
+        self.condition.notify_all()
+
+    def write(self, data):
+        with self.condition:
+            self.received += data
+            while b'\r\n\r\n' in self.received:
+                end = self.received.index(b'\r\n\r\n') + 4
+                frame, self.received = self.received[:end], self.received[end:]
+                if not self.records:
+                    raise ReplayError(f'{self.name}: {frame} sent after the end of the capture')
+                record = self.records.popleft()
+                if record.data != frame:
+                    raise ReplayError(f'{self.name}: sent {frame}, capture has {record.data}')
+                self._schedule(record.time)
+        return len(data)
+
+    def _deliver(self):
+        now = monotonic()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            self.buffer += self.scheduled.popleft()[1]
+
+    def _ready(self):
+        self._deliver()
+        return self.buffer or not self.is_open
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        # Captures only hold the bytes the host read, so nothing is discarded
+        pass
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self._deliver()
+            return len(self.buffer)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self.condition:
+            while not self._ready():
+                wait = self.scheduled[0][0] - monotonic() if self.scheduled else None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+            if not self.is_open:
+                raise ReplayError(f'{self.name}: port closed')
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+
+class ReplayRobotArm(RobotArm):
+    '''
+    Robot arm whose motor controllers are replaced by a captured session.
+    '''
+    def __init__(self, config_path, capture_path, realtime=True, verbose=False):
+        '''
+        :param config_path: Path to the configuration the capture was made with.
+        :param capture_path: Path to the capture file.
+        :param realtime: Whether to replay with the original timing or as fast as possible.
+        '''
+        self.records = list(load(capture_path))
+        self.realtime = realtime
+        super().__init__(config_path, verbose)
+
+    def loadconfig(self, config_path):
+        super().loadconfig(config_path)
+        # Heartbeats depend on timing, so they cannot be replayed in step with the capture
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+    def createmotorcontroller(self, name, config):
+        serial_port = ReplaySerial(self.records, name, self.realtime, config['timeout'])
+        return MotorController(name, config, serial_port=serial_port)
+
+    def sleep(self, seconds):
+        if self.realtime:
+            super().sleep(seconds)
+
+
+def dump(path):
+    '''
+    Prints every record of a capture with the time since the previous record of its controller.
+    '''
+    previous = {}
+    for record in load(path):
+        delta = record.time - previous.get(record.name, record.time)
+        previous[record.name] = record.time
+        print(f'{record.time:12.6f} {delta * 1000:+10.3f} ms  {record.name:<12} '
+              f'{KINDS[record.kind]:<8} {record.data!r}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serial capture tools')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    dump_parser = subparsers.add_parser('dump')
+    dump_parser.add_argument('capture')
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('config')
+    replay_parser.add_argument('capture')
+    replay_parser.add_argument('program')
+    replay_parser.add_argument('--fast', action='store_true')
+    args = parser.parse_args()
+    if args.action == 'dump':
+        dump(args.capture)
+    else:
+        start = monotonic()
+        robot_arm = ReplayRobotArm(args.config, args.capture, not args.fast)
+        for command in RobotArm.Command.loadprogram(args.program):
+            try:
+                robot_arm.execute(command)
+            except StopIteration:
+                break
+        print(f'Replayed in {(monotonic() - start) * 1000:.1f} ms')
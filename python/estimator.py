@@ -0,0 +1,155 @@
+'''
+Offline cycle time estimation. Programs are executed through the regular RobotArm logic, with the
+serial ports replaced by a model of the motor controller firmware running on a virtual clock.
+
+Usage: python -m python.estimator <config path> <program path> [<program path> ...]
+'''
+import sys
+from python.firmwaremodel import ModelLink, frametime
+from python.motorcontroller import MotorController
+from python.robotarm import RobotArm
+
+
+class VirtualClock:
+    '''
+    Clock which only advances when told to.
+    '''
+    def __init__(self):
+        self.now = 0
+
+    def advance(self, millis):
+        self.now += millis
+
+    def advanceto(self, millis):
+        self.now = max(self.now, millis)
+
+
+class VirtualSerial:
+    '''
+    Serial port like object connected to a firmware model. Writing a frame advances the clock by
+    its transmission time, and reading a reply advances the clock to the time the reply arrives.
+    '''
+    def __init__(self, clock, baud, latency=1):
+        '''
+        :param clock: Virtual clock shared by all ports.
+        :param baud: Baud rate used for transmission times.
+        :param latency: Turnaround time in ms of the USB serial link and the firmware loop.
+        '''
+        self.clock = clock
+        self.baudrate = baud
+        self.link = ModelLink(latency)
+        self.buffer = b''
+        self.is_open = True
+
+    def write(self, data):
+        self.clock.advance(frametime(len(data), self.baudrate))
+        self.link.write(data, self.clock.now, self.baudrate)
+        return len(data)
+
+    def _receive(self):
+        ready, data = self.link.pop()
+        self.clock.advanceto(ready)
+        self.buffer += data
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.buffer = b''
+        self.link.ready(self.clock.now)
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer) + self.link.waiting(self.clock.now)
+
+    def read(self, size=1):
+        if not self.buffer and self.link.next() is not None:
+            self._receive()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_until(self, terminator=b'\n'):
+        while terminator not in self.buffer and self.link.next() is not None:
+            self._receive()
+        if terminator not in self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        end = self.buffer.index(terminator) + len(terminator)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def close(self):
+        self.is_open = False
+
+
+class Estimator(RobotArm):
+    '''
+    Robot arm which runs against firmware models on a virtual clock and records the time of every
+    move.
+    '''
+    def __init__(self, config_path, latency=1):
+        '''
+        :param config_path: Path to the robot arm configuration.
+        :param latency: Turnaround time in ms of each serial link.
+        '''
+        self.clock = VirtualClock()
+        self.latency = latency
+        self.moves = []
+        super().__init__(config_path)
+
+    def createmotorcontroller(self, name, config):
+        serial_port = VirtualSerial(self.clock, config['baud'], self.latency)
+        # Replies are read on the thread waiting for them so the virtual clock advances in order
+        return MotorController(name, config, serial_port=serial_port, threaded=False)
+
+    def sleep(self, seconds):
+        self.clock.advance(seconds * 1000)
+
+    def moveto(self, x, y, z, time=None, exit_freqs=None):
+        start = self.clock.now
+        super().moveto(x, y, z, time, exit_freqs)
+        self.moves.append(((x, y, z), self.clock.now - start))
+
+    def movethrough(self, points, tolerance=None):
+        # Blended segments are queued behind each other, so only the whole run can be timed
+        start = self.clock.now
+        super().movethrough(points, tolerance)
+        self.moves.append((tuple(points[-1]), self.clock.now - start))
+
+    def estimate(self, commands):
+        '''
+        Executes the commands and measures the time they take on the virtual clock.
+        :param commands: List of commands.
+        :return: Total time in ms and a list of (coordinates, time in ms) tuples, one per move or
+        blended run of moves.
+        '''
+        self.moves = []
+        start = self.clock.now
+        for command in commands:
+            try:
+                self.execute(command)
+            except StopIteration:
+                break
+        return self.clock.now - start, self.moves
+
+
+def estimate(config_path, commands, latency=1):
+    '''
+    Estimates the time the commands take to execute on a freshly started robot arm.
+    :param config_path: Path to the robot arm configuration.
+    :param commands: List of commands.
+    :param latency: Turnaround time in ms of each serial link.
+    :return: Total time in ms and a list of (coordinates, time in ms) tuples, one per move.
+    '''
+    return Estimator(config_path, latency).estimate(commands)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    for program_path in sys.argv[2:]:
+        total, moves = estimate(sys.argv[1], RobotArm.Command.loadprogram(program_path))
+        print(f'{program_path}: {total:.1f} ms')
+        for i, (coord, time) in enumerate(moves):
+            print(f'  {i}\t{coord}\t{time:.1f} ms')
@@ -10,3 +10,40 @@ class IKError(Exception):
     Inverse kinematic calculation exception.
     '''
     pass
+
+
+class ValidationError(Exception):
+    '''
+    Program validation exception. Holds every violation found in the program.
+    '''
+    def __init__(self, violations):
+        self.violations = violations
+        super().__init__('\n'.join(str(violation) for violation in violations))
+
+
+class ReplayError(Exception):
+    '''
+    Serial capture replay exception, e.g. a frame which differs from the captured one.
+    '''
+    pass
+
+
+class PlanningError(Exception):
+    '''
+    Motion planning exception, e.g. no collision free path to the destination.
+    '''
+    pass
+
+
+class ControllerError(Exception):
+    '''
+    Motor controller failure exception, e.g. a controller which stopped answering.
+    '''
+    pass
+
+
+class ControllerResetError(ControllerError):
+    '''
+    Motor controller which was reset unexpectedly and lost its state.
+    '''
+    pass
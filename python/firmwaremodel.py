@@ -0,0 +1,345 @@
+'''
+Host side model of the motor controller firmware. Mirrors the command handling in main.ino and the
+frequency profile generated by Motor::moveSteps so that the duration of a move can be predicted
+without the hardware.
+'''
+import random
+import re
+from collections import namedtuple
+from heapq import heappop, heappush
+from itertools import count
+
+
+TERMINATOR = b'\r\n\r\n'
+UPDATE_INTERVAL_MILLIS = 10  # MOTOR_CONTROLLER_UPDATE_INTERVAL_MILLIS
+MAX_NUM_MOTORS = 3
+MAX_FREQUENCY = 0xFFFF  # frequencies are stored in a uint16_t array
+MAX_TIME_SLICES = 6000  # the frequency array is malloc'd per move, keep it well inside the heap
+MAX_INT = 0x7FFFFFFF
+BAUD_CONFIRM_MILLIS = 1000  # time a negotiated baud rate has to be confirmed in
+MAX_FRAME_LENGTH = 64  # longer frames overflow the frame buffer and are rejected
+INITIAL_FREQUENCY = 500  # Motor::init arms the timer with a 1000us alarm, toggling every 1 ms
+
+UNDEFINED = -1
+INT_PATTERN = re.compile(r'\s*[-+]?\d+')
+FLOAT_PATTERN = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)')
+
+Frame = namedtuple('Frame', ['type', 'channel', 'arg'])
+
+
+def _leadingnumber(string, pattern):
+    match = pattern.match(string)
+    return match.group() if match else 0
+
+
+def cdiv(a, b):
+    '''
+    Integer division truncating towards zero like C.
+    '''
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def frametime(nbytes, baud):
+    '''
+    :return: Time in ms to transmit the given number of bytes at the given baud rate (8N1).
+    '''
+    return nbytes * 10 / baud * 1000
+
+
+def reply(status):
+    '''
+    :return: The bytes the firmware sends for the given status code, including the line ending
+    added by println.
+    '''
+    return f'{status}\r\n\r\n\r\n'.encode()
+
+
+MOVE_DONE = b'!' + reply(0)  # sendMoveDoneSignal
+
+
+def peakfrequency(steps, time, start_freq=0, end_freq=0):
+    '''
+    Calculates the peak frequency of a move's profile before it is stored in the uint16_t
+    frequency array.
+    :param steps: Number of steps to move, the sign is ignored.
+    :param time: Time of the move in ms.
+    :param start_freq: Frequency the move starts from.
+    :param end_freq: Frequency the move ends at.
+    :return: Peak step frequency of the profile.
+    '''
+    steps = abs(int(steps))
+    slices = int(time) // UPDATE_INTERVAL_MILLIS
+    if slices <= 0:
+        raise ValueError(f'Move of {time} ms is shorter than one time slice')
+    mid = slices // 2
+    return max(0, cdiv(steps * 200 - mid * start_freq - (slices - mid) * end_freq, slices))
+
+
+def profile(steps, time, start_freq=0, end_freq=0):
+    '''
+    Generates the frequency of each time slice of a move the same way Motor::moveSteps does.
+    :param steps: Number of steps to move, the sign is ignored.
+    :param time: Time of the move in ms.
+    :param start_freq: Frequency the move starts from.
+    :param end_freq: Frequency the move ends at.
+    :return: List of step frequencies, one per time slice.
+    '''
+    steps = abs(int(steps))
+    slices = int(time) // UPDATE_INTERVAL_MILLIS
+    mid = slices // 2
+    corrective = steps * 100
+    f_max = peakfrequency(steps, time, start_freq, end_freq)
+    freqs = []
+    for i in range(slices):
+        if i < mid:
+            freq = start_freq + cdiv((f_max - start_freq) * i, mid)
+        else:
+            freq = end_freq + cdiv((f_max - end_freq) * (slices - i), slices - mid)
+        freq &= MAX_FREQUENCY
+        freqs.append(freq)
+        corrective -= freq
+    if corrective > 0:
+        share, extra = divmod(corrective, slices)
+        freqs = [(f + share + (i < extra)) & MAX_FREQUENCY for i, f in enumerate(freqs)]
+    return freqs
+
+
+def movetime(steps, freqs, initial_freq=INITIAL_FREQUENCY):
+    '''
+    Predicts how long the motor takes to pulse the given number of steps with the given profile.
+    The first slice is only applied by the motor controller ISR one update interval after the move
+    starts, and slices with a frequency of 0 keep the previous frequency.
+    :param steps: Number of steps to move, the sign is ignored.
+    :param freqs: Frequency profile as returned by profile.
+    :param initial_freq: Frequency the motor timer was left at by the previous move.
+    :return: Duration of the move in ms and the frequency the motor timer is left at.
+    '''
+    remaining = abs(int(steps))
+    elapsed = 0
+    freq = initial_freq
+    for next_freq in [freq] + freqs:
+        freq = next_freq or freq
+        if remaining <= 0:
+            break
+        pulses = freq * UPDATE_INTERVAL_MILLIS / 1000
+        if pulses >= remaining:
+            return elapsed + remaining / freq * 1000, freq
+        remaining -= pulses
+        elapsed += UPDATE_INTERVAL_MILLIS
+    if remaining > 0:
+        if freq <= 0:
+            raise ValueError('Move never completes')
+        elapsed += remaining / freq * 1000
+    return elapsed, freq
+
+
+class Channel:
+    '''
+    Registers and motion state of one motor channel.
+    '''
+    def __init__(self):
+        self.steps = 0
+        self.time = 0
+        self.exit_freq = 0
+        self.position = 0
+        self.enabled = False
+        self.reverse = False
+        self.carry_freq = 0
+        self.timer_freq = INITIAL_FREQUENCY
+
+    def move(self):
+        '''
+        Runs the queued move the same way Motor::moveSteps does.
+        :return: Duration of the move in ms.
+        '''
+        steps, exit_freq = self.steps, self.exit_freq
+        self.steps = self.exit_freq = 0
+        if steps == 0:
+            self.carry_freq = 0
+            return 0
+        self.position += steps
+        start_freq = self.carry_freq if (steps < 0) == self.reverse else 0
+        self.reverse = steps < 0
+        self.carry_freq = exit_freq
+        freqs = profile(steps, self.time, start_freq, exit_freq)
+        duration, self.timer_freq = movetime(steps, freqs, self.timer_freq)
+        return duration
+
+
+class FirmwareModel:
+    '''
+    Model of a single motor controller. Frames are handled in the order they are received, also
+    while a move is running. A move started while another one is running is queued and starts when
+    the running move completes, and the completion of every move is reported as an event.
+    '''
+    def __init__(self, num_channels=MAX_NUM_MOTORS):
+        self.channels = [Channel() for _ in range(num_channels)]
+        self.busy_until = 0  # time the last started or queued move completes
+        self.queued_until = 0  # time the queued move starts, the registers are held until then
+        self.events = []  # (time in ms the event is sent, bytes) of completed moves
+        self.telemetry_interval = 0
+        self.baud = None  # baud rate negotiated with N, None until negotiated
+        self.boot_id = random.randint(2, 0x3FFFFFFF + 2)
+
+    @staticmethod
+    def parse(frame):
+        '''
+        Parses a frame the same way Parser::parse does.
+        :param frame: Bytes of the frame including the terminator.
+        :return: Frame tuple, or None if the frame is invalid.
+        '''
+        if not frame.endswith(TERMINATOR) or len(frame) > MAX_FRAME_LENGTH:
+            return None
+        parts = frame.decode(errors='replace').strip().split(' ', 2)
+        if not parts[0]:
+            return None
+        # toInt and toFloat read a leading number and give 0 otherwise, and -1 means undefined
+        channel = int(_leadingnumber(parts[1], INT_PATTERN)) if len(parts) > 1 else UNDEFINED
+        arg = float(_leadingnumber(parts[2], FLOAT_PATTERN)) if len(parts) > 2 else UNDEFINED
+        channel = None if channel == UNDEFINED else channel
+        arg = None if arg == UNDEFINED else arg
+        command = Frame(parts[0], channel, arg)
+        if command.type in ('E', 'D', 'L', 'N'):
+            valid = command.channel is not None and command.arg is None
+        elif command.type in ('S', 'T', 'V', 'P'):
+            valid = command.channel is not None and command.arg is not None
+        elif command.type in ('?', 'R', 'U'):
+            valid = command.channel is None and command.arg is None
+        elif command.type == 'G':
+            valid = command.arg is None
+        else:
+            valid = False
+        return command if valid else None
+
+    def handle(self, frame, now):
+        '''
+        Handles a frame received at the given time.
+        :param frame: Bytes of the frame including the terminator.
+        :param now: Time in ms the frame was received.
+        :return: Status code and the time in ms the reply is sent.
+        '''
+        command = self.parse(frame)
+        if command is None:
+            return 1, now
+        if command.type in ('S', 'T', 'V', 'E', 'D', 'G') and command.channel is not None:
+            if not 0 <= command.channel < len(self.channels):
+                return 1, now
+        if command.type in ('S', 'T', 'V') and now < self.queued_until:
+            return 1, now
+        if command.type == 'S':
+            self.channels[command.channel].steps = int(command.arg)
+        elif command.type == 'T':
+            self.channels[command.channel].time = int(command.arg)
+        elif command.type == 'V':
+            if command.arg < 0:
+                return 1, now
+            self.channels[command.channel].exit_freq = int(command.arg)
+        elif command.type in ('E', 'D'):
+            self.channels[command.channel].enabled = command.type == 'E'
+        elif command.type == 'L':
+            if command.channel < 0:
+                return 1, now
+            self.telemetry_interval = command.channel
+        elif command.type == 'G':
+            if now < self.queued_until:
+                return 1, now
+            channels = self.channels
+            if command.channel is not None:
+                channels = [self.channels[command.channel]]
+            # MotorController::checkMove
+            if any(channel.steps != 0 and channel.time < UPDATE_INTERVAL_MILLIS
+                   for channel in channels):
+                return 1, now
+            start = now
+            if now < self.busy_until:
+                start = self.queued_until = self.busy_until
+            # The registers of a queued move cannot change, so it can be run right away
+            self.busy_until = start + max([channel.move() for channel in channels])
+            self.events.append((self.busy_until, MOVE_DONE))
+        elif command.type == '?':
+            if now < self.busy_until:
+                return 1, now
+        elif command.type == 'R':
+            self.__init__(len(self.channels))
+        elif command.type == 'U':
+            return self.boot_id, now
+        elif command.type == 'N':
+            if command.channel <= 0:
+                return 1, now
+            self.baud = command.channel
+        return 0, now
+
+    def popevents(self):
+        '''
+        :return: List of the events generated since the last call, as (time in ms the event is
+        sent, bytes) tuples.
+        '''
+        events, self.events = self.events, []
+        return events
+
+
+class ModelLink:
+    '''
+    Serial link to a firmware model, shared by the serial port like objects which run the model on
+    a clock of their own. Bytes written to the link are split into frames and handled by the model,
+    and its replies and events are scheduled at the time they have been transmitted back. Times
+    are passed in by the owner of the link.
+    '''
+    def __init__(self, latency=1):
+        '''
+        :param latency: Turnaround time in ms of the USB serial link and the firmware loop.
+        '''
+        self.latency = latency
+        self.model = FirmwareModel()
+        self.received = b''
+        self.replies = []  # heap of (time the bytes are transmitted, sequence number, bytes)
+        self.sequence = count()
+
+    def write(self, data, now, baud):
+        '''
+        Handles the frames completed by the written bytes.
+        :param data: Bytes written by the host.
+        :param now: Time in ms the bytes have been transmitted.
+        :param baud: Baud rate used for transmission times.
+        '''
+        self.received += data
+        while TERMINATOR in self.received:
+            end = self.received.index(TERMINATOR) + len(TERMINATOR)
+            frame, self.received = self.received[:end], self.received[end:]
+            status, sent = self.model.handle(frame, now + self.latency)
+            self._schedule(sent, reply(status), baud)
+            for sent, event in self.model.popevents():
+                self._schedule(sent, event, baud)
+
+    def _schedule(self, sent, data, baud):
+        ready = sent + frametime(len(data), baud)
+        heappush(self.replies, (ready, next(self.sequence), data))
+
+    def next(self):
+        '''
+        :return: Time in ms the next reply has been transmitted, or None if there is none.
+        '''
+        return self.replies[0][0] if self.replies else None
+
+    def pop(self):
+        '''
+        :return: Time in ms the next reply has been transmitted and its bytes.
+        '''
+        ready, _, data = heappop(self.replies)
+        return ready, data
+
+    def ready(self, now):
+        '''
+        :return: Bytes of every reply transmitted by the given time.
+        '''
+        data = b''
+        while self.replies and self.replies[0][0] <= now:
+            data += self.pop()[1]
+        return data
+
+    def waiting(self, now):
+        '''
+        :return: Number of bytes transmitted by the given time which have not been popped.
+        '''
+        return sum(len(data) for ready, _, data in self.replies if ready <= now)
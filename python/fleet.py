@@ -0,0 +1,190 @@
+'''
+Runs several robot arms from a single host process. The serial ports of every motor controller are
+read by one shared ReaderPool, and each arm runs its program on a worker of a shared thread pool.
+
+Programs are the same as for a single arm, with one extra verb:
+    sync                synchronizes with every other arm running a program
+    sync move x y z     stages the move on every arm, then starts all of them at once
+
+Usage: python -m python.fleet <config path> <program path> [<config path> <program path> ...]
+'''
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from python.motorcontroller import ReaderPool
+from python.robotarm import RobotArm
+
+
+class FleetArm(RobotArm):
+    '''
+    Robot arm which keeps track of its throughput and of the time the host spends preparing and
+    starting moves.
+    '''
+    def __init__(self, name, config_path, verbose=False, reader_pool=None):
+        self.name = name
+        self.moves = 0
+        self.commands = 0
+        self.host_time = 0
+        self.busy_time = 0
+        super().__init__(config_path, verbose, reader_pool)
+
+    def stagemove(self, x, y, z, time=None, exit_freqs=None):
+        start = monotonic()
+        super().stagemove(x, y, z, time, exit_freqs)
+        self.host_time += monotonic() - start
+
+    def startmove(self):
+        start = monotonic()
+        super().startmove()
+        self.host_time += monotonic() - start
+        self.moves += 1
+
+    def stats(self):
+        '''
+        :return: Dictionary of throughput metrics of the arm.
+        '''
+        return {
+            'commands': self.commands,
+            'moves': self.moves,
+            'busy_s': self.busy_time,
+            'moves_per_s': self.moves / self.busy_time if self.busy_time else 0,
+            'host_ms_per_move': self.host_time / self.moves * 1000 if self.moves else 0
+        }
+
+
+class Fleet:
+    def __init__(self, config_paths, verbose=False):
+        '''
+        Creates a robot arm for every configuration. All motor controllers share one reader thread.
+        :param config_paths: Dictionary of arm name to configuration path, or a list of
+        configuration paths, in which case the arms are named arm0, arm1, ...
+        :param verbose: Flag to control verbosity.
+        '''
+        if not isinstance(config_paths, dict):
+            config_paths = {f'arm{i}': path for i, path in enumerate(config_paths)}
+        self.reader_pool = ReaderPool()
+        self.arms = {}
+        try:
+            for name, config_path in config_paths.items():
+                self.arms[name] = FleetArm(name, config_path, verbose, self.reader_pool)
+        except Exception:
+            self.reader_pool.close()
+            raise
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, len(self.arms)), thread_name_prefix='fleet'
+        )
+
+    def __getitem__(self, name):
+        return self.arms[name]
+
+    def run(self, programs):
+        '''
+        Runs a program on each of the given arms concurrently.
+        :param programs: Dictionary of arm name to list of commands. Every program must contain
+        the same number of sync commands.
+        :return: Dictionary of arm name to list of results, one per command.
+        '''
+        syncs = {
+            name: sum(command.type == 'sync' for command in commands)
+            for name, commands in programs.items()
+        }
+        if len(set(syncs.values())) > 1:
+            raise ValueError(f'Programs have different numbers of sync commands: {syncs}')
+        barrier = threading.Barrier(len(programs))
+        futures = {
+            name: self.executor.submit(self._run, self.arms[name], commands, barrier)
+            for name, commands in programs.items()
+        }
+        results, error = {}, None
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except threading.BrokenBarrierError:
+                pass  # another arm failed and broke the barrier, its error is raised instead
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def _run(self, arm, commands, barrier):
+        results = []
+        start = monotonic()
+        try:
+            for command in commands:
+                if command.type == 'sync':
+                    results.append(self._sync(arm, command, barrier))
+                else:
+                    results.append(arm.execute(command))
+                arm.commands += 1
+        except Exception:
+            # Arms waiting for this one at a sync would otherwise wait forever
+            barrier.abort()
+            raise
+        finally:
+            arm.busy_time += monotonic() - start
+        return results
+
+    def _sync(self, arm, command, barrier):
+        if not command.args:
+            barrier.wait()
+            return
+        move = RobotArm.Command(command.args[0], command.args[1:])
+        if move.type not in ('move', 'm'):
+            raise ValueError(f'Cannot synchronize {move.type}')
+        x, y, z = map(int, move.args[:3])
+        time = float(move.args[3]) if len(move.args) > 3 else None
+        arm.stagemove(x, y, z, time)
+        barrier.wait()
+        arm.startmove()
+        arm.waitmove()
+        arm.prev_command = move
+
+    def moveall(self, targets, times=None):
+        '''
+        Moves several arms at once. Every move is staged before any of them is started.
+        :param targets: Dictionary of arm name to x, y, z coordinates.
+        :param times: Optional dictionary of arm name to time in ms.
+        '''
+        times = times or {}
+        for name, (x, y, z) in targets.items():
+            self.arms[name].stagemove(x, y, z, times.get(name))
+        for name in targets:
+            self.arms[name].startmove()
+        for name in targets:
+            self.arms[name].waitmove()
+
+    def stats(self):
+        '''
+        :return: Dictionary of arm name to throughput metrics.
+        '''
+        return {name: arm.stats() for name, arm in self.arms.items()}
+
+    def terminate(self):
+        '''
+        Terminates every arm and stops the shared threads.
+        '''
+        self.executor.shutdown()
+        try:
+            for arm in self.arms.values():
+                arm.terminate()
+        finally:
+            self.reader_pool.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) % 2 == 0:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    pairs = list(zip(sys.argv[1::2], sys.argv[2::2]))
+    fleet = Fleet([config_path for config_path, _ in pairs])
+    try:
+        fleet.run({
+            f'arm{i}': RobotArm.Command.loadprogram(program_path)
+            for i, (_, program_path) in enumerate(pairs)
+        })
+        for name, stats in fleet.stats().items():
+            print(name, ', '.join(f'{key}: {value:.3f}' for key, value in stats.items()))
+    finally:
+        fleet.terminate()
@@ -0,0 +1,177 @@
+'''
+Streaming G-code importer. The file is parsed lazily, one line at a time, so even very large files
+start moving as soon as the first chunk of moves has been solved.
+
+Supported codes:
+    G0, G1      linear move, G1 moves take distance / feedrate, G0 moves take the calculated time
+    G4          dwell, P in ms or S in seconds
+    G20, G21    inches, millimetres
+    G90, G91    absolute, relative coordinates
+    F           feedrate in units per minute
+    M codes     mapped to pin states with the gcode_mcodes configuration, e.g.
+                {"M3": ["controller0", "2", "1"], "M5": ["controller0", "2", "0"]}
+    M2, M30     end of program
+G-code coordinates are offset by the gcode_origin configuration. Other G codes are ignored, arcs are
+not supported.
+
+Usage: python -m python.gcode <config path> <G-code path> [--convert]
+'''
+import math
+import re
+import sys
+from collections import namedtuple
+from python.robotarm import RobotArm
+
+
+Move = namedtuple('Move', ['x', 'y', 'z', 'time'])  # time is None for rapid moves
+Dwell = namedtuple('Dwell', ['seconds'])
+Pin = namedtuple('Pin', ['motor_controller', 'pin', 'state'])
+
+COMMENT_PATTERN = re.compile(r'\(.*?\)|;.*')
+WORD_PATTERN = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+
+
+def parse(lines, start=(0, 0, 0), origin=(0, 0, 0), mcodes=None):
+    '''
+    Parses G-code into motion events.
+    :param lines: Iterable of G-code lines, e.g. an open file.
+    :param start: x, y, z coordinates the arm starts at.
+    :param origin: Arm coordinates of the G-code origin.
+    :param mcodes: Dictionary of M code, e.g. 'M3', to (motor controller, pin, state).
+    :return: Generator of Move, Dwell and Pin events in arm coordinates.
+    '''
+    mcodes = mcodes or {}
+    position = [start[i] - origin[i] for i in range(3)]  # in G-code coordinates
+    motion, feed, scale, relative = 0, None, 1, False
+    for number, line in enumerate(lines, 1):
+        line = COMMENT_PATTERN.sub('', line.split('*')[0]).upper()
+        words = WORD_PATTERN.findall(line)
+        if not words:
+            continue
+        values = {letter: float(value) for letter, value in words if letter not in 'GM'}
+        dwell = False
+        for letter, value in words:
+            if letter == 'G':
+                code = float(value)
+                if code in (0, 1):
+                    motion = int(code)
+                elif code in (2, 3):
+                    raise ValueError(f'line {number}: arcs are not supported')
+                elif code == 4:
+                    dwell = True
+                elif code in (20, 21):
+                    scale = 25.4 if code == 20 else 1
+                elif code in (90, 91):
+                    relative = code == 91
+            elif letter == 'M':
+                code = f'M{int(float(value))}'
+                if code in ('M2', 'M30'):
+                    return
+                if code in mcodes:
+                    yield Pin(*map(str, mcodes[code]))
+        if 'F' in values:
+            feed = values['F'] * scale
+        if dwell:
+            seconds = values['P'] / 1000 if 'P' in values else values.get('S', 0)
+            yield Dwell(seconds)
+            continue
+        if not any(axis in values for axis in 'XYZ'):
+            continue
+        previous = list(position)
+        for i, axis in enumerate('XYZ'):
+            if axis in values:
+                position[i] = position[i] + values[axis] * scale if relative \
+                    else values[axis] * scale
+        time = None
+        if motion == 1:
+            if not feed:
+                raise ValueError(f'line {number}: G1 move without a feedrate')
+            time = math.dist(previous, position) / feed * 60000
+        yield Move(*[position[i] + origin[i] for i in range(3)], time)
+
+
+def play(robot_arm, events, chunk_size=64):
+    '''
+    Executes G-code events on the robot arm. Runs of consecutive moves are planned, validated
+    and queued a chunk at a time, blending corners within the blend tolerance of the robot arm.
+    Move times are floored at the minimum time of the slowest motor a move involves.
+    :param robot_arm: Robot arm to move.
+    :param events: Iterable of events from parse.
+    :param chunk_size: Largest number of moves solved at a time.
+    :return: Number of moves executed.
+    :raise ValidationError: If a move of the chunk about to be executed violates a limit.
+    '''
+    moved = 0
+    moves = []
+    for event in events:
+        if isinstance(event, Move):
+            moves.append(event)
+            if len(moves) == chunk_size:
+                moved += _move(robot_arm, moves)
+                moves = []
+            continue
+        moved += _move(robot_arm, moves)
+        moves = []
+        if isinstance(event, Dwell):
+            robot_arm.sleep(event.seconds)
+        else:
+            robot_arm.setpin(*event)
+    return moved + _move(robot_arm, moves)
+
+
+def _move(robot_arm, moves):
+    if moves:
+        robot_arm.movethrough([move[:3] for move in moves], times=[move.time for move in moves])
+    return len(moves)
+
+
+def importfile(robot_arm, path, chunk_size=64):
+    '''
+    Streams a G-code file to the robot arm, using its gcode_origin and gcode_mcodes configuration.
+    :return: Number of moves executed.
+    '''
+    with open(path) as gcode_file:
+        return play(robot_arm, events(robot_arm, gcode_file), chunk_size)
+
+
+def events(robot_arm, lines):
+    '''
+    Parses G-code lines from the current position of the robot arm.
+    '''
+    return parse(
+        lines, (robot_arm.x, robot_arm.y, robot_arm.z),
+        robot_arm.gcode_origin, robot_arm.gcode_mcodes
+    )
+
+
+def tocommands(events):
+    '''
+    Converts G-code events to robot arm commands, e.g. to save them as a program.
+    :return: Generator of commands.
+    '''
+    for event in events:
+        if isinstance(event, Move):
+            args = [str(round(value)) for value in event[:3]]
+            if event.time is not None:
+                args.append(f'{event.time:.2f}')
+            yield RobotArm.Command('move', args)
+        elif isinstance(event, Dwell):
+            yield RobotArm.Command('wait', [str(event.seconds)])
+        else:
+            yield RobotArm.Command('pin', list(event))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    robot_arm = RobotArm(sys.argv[1])
+    try:
+        if '--convert' in sys.argv[3:]:
+            with open(sys.argv[2]) as gcode_file:
+                for command in tocommands(events(robot_arm, gcode_file)):
+                    print(command.type, ' '.join(command.args))
+        else:
+            print(f'Executed {importfile(robot_arm, sys.argv[2])} moves')
+    finally:
+        robot_arm.terminate()
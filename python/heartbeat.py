@@ -0,0 +1,111 @@
+'''
+Heartbeat watchdog for the motor controllers. Idle controllers are pinged with the boot id command
+every interval, so a controller which stops answering or was reset is found within the heartbeat
+timeout instead of at the next command. The failed controller then fails every request waiting on
+it and every later request with a ControllerError until it is restarted.
+
+Any frame received counts as a heartbeat, and controllers are never pinged while they have a
+request in flight, so the watchdog stays out of the way of motion traffic. The firmware answers
+every frame right away, also while a move is running, so a request which is not answered within the
+heartbeat timeout fails the controller. Running moves are pinged like idle controllers.
+'''
+import threading
+from time import monotonic
+from python import metrics
+from python.exception import ControllerError, ControllerResetError
+from python.log import getlogger
+
+
+logger = getlogger('heartbeat')
+
+
+class Heartbeat:
+    def __init__(self, robot_arm, interval, timeout=200):
+        '''
+        Starts watching every motor controller of the robot arm.
+        :param robot_arm: Robot arm whose motor controllers are to be watched.
+        :param interval: Interval in milliseconds between heartbeats.
+        :param timeout: Time in milliseconds a controller has to answer a heartbeat.
+        '''
+        self.robot_arm = robot_arm
+        self.interval = interval / 1000
+        self.timeout = timeout / 1000
+        self.subscribers = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+        self.thread.start()
+
+    def subscribe(self, callback):
+        '''
+        Subscribes to controller failures.
+        :param callback: Function called with the motor controller and the ControllerError from
+        the heartbeat thread.
+        '''
+        self.subscribers.append(callback)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            for mc in self.robot_arm.motor_controllers.values():
+                if self.stopped.is_set():
+                    return
+                error = self.check(mc)
+                if error is not None:
+                    self._fail(mc, error)
+
+    def check(self, mc):
+        '''
+        Checks that the motor controller is alive, pinging it if it has no request in flight and
+        has been quiet for the interval.
+        :return: ControllerError if the controller failed, None otherwise.
+        '''
+        if mc.failure is not None or mc.restarting or mc.reader is None and \
+                mc.reader_pool is None:
+            return None
+        now = monotonic()
+        quiet = now - mc.last_heard
+        try:
+            oldest = mc.pending[0]
+        except IndexError:
+            oldest = None
+        if oldest is not None:
+            if now - oldest.sent > self.timeout:
+                return ControllerError(
+                    f'{mc.name}: no reply to {oldest.frame} within {self.timeout} s'
+                )
+            return None
+        if quiet < self.interval:
+            return None
+        try:
+            request = mc._request(b'U\r\n\r\n', heartbeat=True)
+        except ControllerError:
+            return None
+        except Exception as e:
+            return ControllerError(f'{mc.name}: heartbeat failed: {e}')
+        if not request.done.wait(self.timeout):
+            request.abandoned = True
+            return ControllerError(f'{mc.name}: no heartbeat reply within {self.timeout} s')
+        if request.error is not None:
+            return None
+        boot_id = int(request.reply.split(b'\r\n')[-1])
+        # Firmware without boot ids answers with a status code, which still proves it is alive
+        if boot_id > 1:
+            if mc.boot_id is None:
+                mc.boot_id = boot_id
+            elif boot_id != mc.boot_id:
+                mc.forget()
+                return ControllerResetError(
+                    f'{mc.name}: controller was reset, boot id {mc.boot_id} is now {boot_id}'
+                )
+        return None
+
+    def _fail(self, mc, error):
+        logger.error('%s', error)
+        kind = 'reset' if isinstance(error, ControllerResetError) else 'unresponsive'
+        metrics.HEARTBEAT_FAILURES.labels(mc.name, kind).inc()
+        mc.fail(error)
+        for callback in self.subscribers:
+            callback(mc, error)
@@ -0,0 +1,293 @@
+'''
+Jog mode. A velocity, either Cartesian in mm/s or per joint in degrees/s, is turned into a stream of
+small incremental moves at a fixed control rate. Each increment ends at the step frequency of the
+next one, so the motors keep moving between increments instead of stopping, and is queued on the
+motor controllers behind the running one so it starts without a round trip to the host. The next
+increment is computed before the current one is sent, so the last increment comes to a stop.
+
+An increment takes at least the minimum move time of the motors it moves, so the control rate is
+lowered while a slow motor moves. A new velocity takes effect once the running increment completes,
+the increment computed ahead is computed again. Stopping still runs the increment computed ahead, so
+it takes up to two increments, a higher rate stops sooner but sends more moves.
+
+Interactive keys:
+    w/s a/d r/f     +/- x, y, z (or base, arm a, arm b in joint mode) while held
+    j               toggle Cartesian and joint mode
+    + -             double or halve the jog speed
+    c               capture the pose as the next checkpoint
+    space           stop
+    q               leave jog mode
+'''
+import contextlib
+import io
+import logging
+import threading
+from time import monotonic
+from python.log import LOGGER_NAME
+
+
+KEYS = {
+    'w': (0, 1), 's': (0, -1), 'a': (1, 1), 'd': (1, -1), 'r': (2, 1), 'f': (2, -1)
+}
+
+
+def jacobian(robot_arm, angles, delta=0.01):
+    '''
+    Jacobian of the forward kinematics by central differences.
+    :param angles: Base, arm a, and arm b angles.
+    :return: 3x3 list of lists where [i][j] is the change in coordinate i per degree of joint j.
+    '''
+    columns = []
+    for j in range(3):
+        plus, minus = list(angles[:3]), list(angles[:3])
+        plus[j] += delta
+        minus[j] -= delta
+        high, low = robot_arm.anglestocoord(*plus), robot_arm.anglestocoord(*minus)
+        columns.append([(h - l) / (2 * delta) for h, l in zip(high, low)])
+    return [[columns[j][i] for j in range(3)] for i in range(3)]
+
+
+def solve(matrix, vector, epsilon=1e-9):
+    '''
+    Solves a 3x3 linear system with Cramer's rule.
+    :return: Solution, or None if the matrix is singular.
+    '''
+    def determinant(m):
+        return m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1]) - \
+            m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0]) + \
+            m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0])
+
+    det = determinant(matrix)
+    if abs(det) < epsilon:
+        return None
+    solution = []
+    for j in range(3):
+        replaced = [[vector[i] if k == j else matrix[i][k] for k in range(3)] for i in range(3)]
+        solution.append(determinant(replaced) / det)
+    return solution
+
+
+class Jogger:
+    def __init__(self, robot_arm, rate=20, hold=None):
+        '''
+        :param robot_arm: Robot arm to jog.
+        :param rate: Control rate in Hz, each increment takes 1 / rate seconds. Lowered for an
+        increment to the rate at which it takes the largest minimum move time of the motors it moves.
+        :param hold: Time in seconds a velocity is held for unless it is set again, or None to hold
+        it until it is changed.
+        '''
+        self.robot_arm = robot_arm
+        self.period = 1000 / rate
+        self.hold = hold
+        self.velocity = (0, 0, 0)
+        self.joint = False
+        self.expires = None
+        self.setpoint = None  # Cartesian position the last increment was aimed at
+        self.running = False
+        self.thread = None
+        self.error = None
+        self.changed = threading.Event()
+
+    def setvelocity(self, velocity, joint=False):
+        '''
+        Sets the jog velocity.
+        :param velocity: x, y, z velocity in mm/s, or base, arm a, arm b velocity in degrees/s.
+        :param joint: Whether the velocity is per joint.
+        '''
+        self.velocity = tuple(velocity)
+        self.joint = joint
+        self.expires = monotonic() + self.hold if self.hold is not None else None
+        self.changed.set()
+
+    def stop(self):
+        '''
+        Stops jogging after the current increment.
+        '''
+        self.setvelocity((0, 0, 0), self.joint)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='jog', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        '''
+        Stops the control loop and waits for the last increment to finish.
+        '''
+        self.running = False
+        self.changed.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def capture(self, index=None):
+        '''
+        Stores the current pose as a checkpoint.
+        :param index: Checkpoint number. Defaults to one after the highest checkpoint.
+        :return: Checkpoint number.
+        '''
+        arm = self.robot_arm
+        if index is None:
+            index = max(arm.checkpoints, default=-1) + 1
+        command = arm.Command('move', [str(round(value)) for value in (arm.x, arm.y, arm.z)])
+        arm.checkpoints[index] = arm.prev_command = command
+        arm.savestate()
+        return index
+
+    def increment(self, angles):
+        '''
+        Computes the next increment from the given angles.
+        :return: Target base, arm a, arm b, and picker angles and the time of the increment in
+        milliseconds, or None if the arm should not move.
+        '''
+        if self.expires is not None and monotonic() > self.expires:
+            self.velocity = (0, 0, 0)
+        velocity = self.velocity
+        if not any(velocity):
+            self.setpoint = None
+            return None
+        time = self.period
+        result = self._target(angles, velocity, time)
+        if result is not None:
+            time = max([self.period] + [
+                motor.min_time
+                for motor, start, angle in zip(self.robot_arm.motors, angles, result[0])
+                if motor.angletosteps(angle - start) != 0
+            ])
+            if time > self.period:
+                result = self._target(angles, velocity, time)
+        if result is None:
+            self.setpoint = None
+            return None
+        target, self.setpoint = result
+        return target, time
+
+    def _target(self, angles, velocity, time):
+        '''
+        :return: Target angles of an increment of the given time and the Cartesian setpoint it is
+        aimed at, or None if the target is out of reach.
+        '''
+        seconds = time / 1000
+        setpoint = None
+        if self.joint:
+            deltas = [v * seconds for v in velocity]
+        else:
+            # Steering towards a setpoint instead of integrating velocities keeps the other
+            # coordinates from drifting due to the linearization
+            position = self.robot_arm.anglestocoord(*angles[:3])
+            start = self.setpoint if self.setpoint is not None else position
+            setpoint = [p + v * seconds for p, v in zip(start, velocity)]
+            deltas = solve(
+                jacobian(self.robot_arm, angles), [s - p for s, p in zip(setpoint, position)]
+            )
+            if deltas is None:
+                return None
+        target = [angle + delta for angle, delta in zip(angles[:3], deltas)]
+        target.append(270 - target[1] - target[2])
+        for motor, angle in zip(self.robot_arm.motors, target):
+            if not motor.min_angle <= angle <= motor.max_angle:
+                return None
+        return target, setpoint
+
+    def _run(self):
+        arm = self.robot_arm
+        try:
+            target = setpoint = None
+            while self.running:
+                if target is None:
+                    arm.waitmove()
+                    self.changed.wait(self.period / 1000)
+                    self.changed.clear()
+                    setpoint = self.setpoint
+                    target = self.increment([motor.angle for motor in arm.motors])
+                    continue
+                if self.changed.is_set():
+                    # The increment computed ahead still has the previous velocity, it is only
+                    # kept if the arm is to stop, so it comes to a stop from the running one
+                    self.changed.clear()
+                    self.setpoint = setpoint
+                    target = self.increment([motor.angle for motor in arm.motors]) or target
+                angles, time = target
+                steps = [
+                    motor.angletosteps(angle - motor.angle)
+                    for motor, angle in zip(arm.motors, angles)
+                ]
+                setpoint = self.setpoint
+                following = self.increment([
+                    motor.angle + motor.stepstoangle(motor_steps)
+                    for motor, motor_steps in zip(arm.motors, steps)
+                ])
+                # Assume the next increment continues at the same rate, the firmware starts from
+                # a stop instead if it reverses
+                exit_freqs = [0] * len(steps)
+                if following is not None:
+                    exit_freqs = [round(abs(s) * 1000 / time) for s in steps]
+                arm.stageangles(angles, time, exit_freqs)
+                arm.x, arm.y, arm.z = arm.anglestocoord(*[m.angle for m in arm.motors[:3]])
+                arm.queuemove()
+                target = following
+            arm.waitmove()
+        except Exception as e:
+            self.error = e
+
+
+def interactive(robot_arm, speed=20, rate=20):
+    '''
+    Jogs the robot arm from the keyboard until q is pressed.
+    :param speed: Initial jog speed in mm/s or degrees/s.
+    :param rate: Control rate in Hz.
+    '''
+    import curses
+
+    def run(screen):
+        nonlocal speed
+        screen.nodelay(False)
+        # Key repeat keeps the velocity alive, releasing the key lets it expire
+        screen.timeout(50)
+        jogger = Jogger(robot_arm, rate, hold=0.6)
+        jogger.start()
+        message = ''
+        try:
+            while True:
+                mode = 'joint' if jogger.joint else 'cartesian'
+                screen.erase()
+                screen.addstr(0, 0, __doc__.strip().split('Interactive keys:')[-1])
+                screen.addstr(10, 0, f'mode: {mode}  speed: {speed}  '
+                                     f'x: {robot_arm.x:.1f} y: {robot_arm.y:.1f} '
+                                     f'z: {robot_arm.z:.1f}  {message}')
+                key = screen.getch()
+                if jogger.error is not None:
+                    break
+                if key < 0:
+                    continue
+                key = chr(key).lower()
+                if key == 'q':
+                    break
+                elif key in KEYS:
+                    axis, sign = KEYS[key]
+                    velocity = [0, 0, 0]
+                    velocity[axis] = sign * speed
+                    jogger.setvelocity(velocity, jogger.joint)
+                elif key == 'j':
+                    jogger.setvelocity((0, 0, 0), not jogger.joint)
+                elif key in '+=':
+                    speed *= 2
+                elif key == '-':
+                    speed /= 2
+                elif key == 'c':
+                    message = f'captured checkpoint {jogger.capture()}'
+                elif key == ' ':
+                    jogger.stop()
+        finally:
+            jogger.close()
+
+    # The screen belongs to curses, anything printed or logged while jogging would corrupt it
+    logger = logging.getLogger(LOGGER_NAME)
+    level = logger.level
+    logger.setLevel(logging.CRITICAL)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            curses.wrapper(run)
+    finally:
+        logger.setLevel(level)
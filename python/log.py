@@ -0,0 +1,100 @@
+'''
+Structured logging for the robot arm. Records carry key=value fields which are only formatted once
+a record passes the level check, and configured logging hands records to a queue which is written
+out on a background thread, so logging never blocks the move path on a slow console.
+'''
+import atexit
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+
+LOGGER_NAME = 'pirobotarm'
+
+listener = None
+handler = None
+
+
+def getlogger(name):
+    '''
+    :return: Logger of a module of the robot arm.
+    '''
+    return logging.getLogger(f'{LOGGER_NAME}.{name}')
+
+
+def log(logger, level, message, **fields):
+    '''
+    Logs a message with key=value fields. Nothing is formatted unless the level is enabled.
+    '''
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields})
+
+
+class Lazy:
+    '''
+    Value which is only computed when it is formatted, e.g. an expensive dump of an object.
+    '''
+    def __init__(self, function):
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+
+class KeyValueFormatter(logging.Formatter):
+    '''
+    Formats records as a single line of time, level, logger, message and key=value fields.
+    '''
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    '''
+    Queue handler which drops records instead of blocking when the queue is full and leaves all
+    formatting to the listener thread.
+    '''
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def configure(level=logging.INFO, stream=None, queue_size=10000):
+    '''
+    Sends the records of every robot arm logger at or above the level to the stream through a
+    bounded queue. Calling it again only changes the level.
+    :param level: Lowest level logged.
+    :param stream: Stream records are written to. Defaults to stdout.
+    :param queue_size: Largest number of records waiting to be written, further records are
+    dropped.
+    '''
+    global listener, handler
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    if listener is not None:
+        return
+    output = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    output.setFormatter(KeyValueFormatter())
+    handler = DroppingQueueHandler(Queue(queue_size))
+    logger.addHandler(handler)
+    logger.propagate = False
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    atexit.register(listener.stop)
@@ -0,0 +1,268 @@
+'''
+Metrics of the robot arm and its motor controllers, exposed in the Prometheus text format over HTTP
+and optionally written to a file periodically, e.g. for the node exporter textfile collector.
+
+Updating a metric only takes an uncontended lock, so it adds no measurable latency to the move
+path. Every metric is registered in REGISTRY.
+'''
+import bisect
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+
+class Metric(ABC):
+    type = None
+    suffix = ''  # appended to the name to get the name of the metric family, e.g. _total
+
+    def __init__(self, name, help, labels=()):
+        '''
+        :param name: Metric name.
+        :param help: Description of the metric.
+        :param labels: Names of the labels, children are created per label values with labels.
+        '''
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        '''
+        :return: Child metric for the given label values.
+        '''
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        return type(self)(self.name, self.help)
+
+    @abstractmethod
+    def _samples(self):
+        '''
+        :return: List of (suffix, extra labels, value) tuples of an unlabelled metric.
+        '''
+
+    def render(self):
+        family = self.name + self.suffix
+        lines = [f'# HELP {family} {self.help}', f'# TYPE {family} {self.type}']
+        with self.lock:
+            children = sorted(self.children.items(), key=lambda item: item[0])
+        metrics = [((), self)] if not self.label_names else children
+        for values, metric in metrics:
+            labels = list(zip(self.label_names, values))
+            for suffix, extra, value in metric._samples():
+                pairs = ','.join(f'{key}="{value}"' for key, value in labels + extra)
+                lines.append(f'{family}{suffix}{{{pairs}}} {value}' if pairs
+                             else f'{family}{suffix} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+    suffix = '_total'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def _samples(self):
+        return [('', [], self.value)]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        '''
+        :param function: Function returning the value, evaluated when the metric is rendered.
+        '''
+        super().__init__(name, help, labels)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def _samples(self):
+        return [('', [], self.function() if self.function is not None else self.value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        '''
+        :param buckets: Upper bounds of the buckets in seconds.
+        '''
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def _child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', [('le', bound)], cumulative))
+        return samples + [('_sum', [], total), ('_count', [], count)]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        :return: Every metric in the Prometheus text format.
+        '''
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+    def snapshot(self, path):
+        '''
+        Writes every metric to a file. The file is replaced atomically so readers never see a
+        partial snapshot.
+        '''
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as snapshot_file:
+            snapshot_file.write(self.render())
+        os.replace(temp_path, path)
+
+
+class RateWindow:
+    '''
+    Rate of events over a sliding window.
+    '''
+    def __init__(self, window=60):
+        self.window = window
+        self.times = deque()
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.times.append(monotonic())
+
+    def rate(self):
+        start = monotonic() - self.window
+        with self.lock:
+            while self.times and self.times[0] < start:
+                self.times.popleft()
+            return len(self.times) / self.window
+
+
+REGISTRY = Registry()
+MOVE_WINDOW = RateWindow()
+
+MOVES = REGISTRY.register(Counter('robotarm_moves', 'Moves completed'))
+MOVE_RATE = REGISTRY.register(Gauge(
+    'robotarm_moves_per_second', 'Moves completed per second over the last minute',
+    function=MOVE_WINDOW.rate
+))
+MOVE_TIME = REGISTRY.register(Histogram(
+    'robotarm_move_seconds', 'Cycle time of a move including IK and communication'
+))
+IK_FAILURES = REGISTRY.register(Counter('robotarm_ik_failures', 'Moves to unreachable points'))
+CONTROLLER_STATUS = REGISTRY.register(Gauge(
+    'motorcontroller_status', 'Last status reported by the motor controller, 0 if ok',
+    ['controller']
+))
+ROUND_TRIP_TIME = REGISTRY.register(Histogram(
+    'motorcontroller_round_trip_seconds', 'Time from sending a command to its reply',
+    ['controller', 'command']
+))
+TIMEOUTS = REGISTRY.register(Counter(
+    'motorcontroller_timeouts', 'Commands without a reply within the timeout', ['controller']
+))
+WAIT_TIME = REGISTRY.register(Histogram(
+    'motorcontroller_wait_seconds', 'Time blocked waiting for a move to complete', ['controller']
+))
+BAUD = REGISTRY.register(Gauge(
+    'motorcontroller_baud', 'Baud rate of the link to the motor controller', ['controller']
+))
+FRAME_RATE = REGISTRY.register(Gauge(
+    'motorcontroller_frames_per_second', 'Frames received per second over the last 10 seconds',
+    ['controller']
+))
+HEARTBEAT_FAILURES = REGISTRY.register(Counter(
+    'motorcontroller_heartbeat_failures',
+    'Controllers found unresponsive or reset by the heartbeat', ['controller', 'reason']
+))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+servers = {}
+
+
+def serve(port, host='127.0.0.1'):
+    '''
+    Serves the metrics on http://host:port/metrics from a background thread. Serving the same
+    address again reuses the running server.
+    :return: The HTTP server.
+    '''
+    if (host, port) not in servers:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        servers[(host, port)] = server
+    return servers[(host, port)]
+
+
+def writesnapshots(path, interval=10):
+    '''
+    Writes a snapshot of the metrics to the path every interval seconds from a background thread.
+    :return: Event which stops the snapshots when set.
+    '''
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            REGISTRY.snapshot(path)
+        REGISTRY.snapshot(path)
+
+    threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+    return stopped
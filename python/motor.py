@@ -1,5 +1,14 @@
 import math
-from pprint import pformat
+from collections import deque
+from logging import DEBUG
+from python.log import getlogger, log
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = getlogger('motor')
 
 
 class Motor:
@@ -14,6 +23,7 @@ class Motor:
         # Get motor controller information
         self.motor_controller = motor_controller
         self.controller_channel = config['controller_channel']
+        motor_controller.subscribecompletions(self._completed)
         
         # Get motor parameters
         self.microstep = config['microstep']
@@ -22,16 +32,25 @@ class Motor:
         # Get angle parameters
         self.min_angle = config['min_angle']
         self.max_angle = config['max_angle']
-        self.angle = config['init_angle']
+        self.init_angle = config['init_angle']
+        self.angle = self.init_angle
+        self.move_origin = self.angle  # angle the staged move starts from
+        self.move_steps = 0  # steps of the staged move
+        self.started = deque()  # (origin, steps) of the started moves which have not completed
+        self.enabled = None  # unknown until the motor is enabled or disabled
         self.step_range = self.angletosteps(self.max_angle - self.min_angle)
 
         # Get timing parameters
         self.max_time = config['max_time']        
         self.min_time = config['min_time']
         self.time_range = self.max_time - self.min_time
+
+        # Move time of every step count within the range of the motor, indexed by step count
+        self.time_table = [self.calcsteptime(steps) for steps in range(self.step_range + 1)]
+        self.time_array = numpy.array(self.time_table, dtype=float) if numpy is not None else None
     
     def __repr__(self):
-        return pformat(self.__dict__)
+        return f'Motor({self.name!r}, channel={self.controller_channel}, angle={self.angle})'
 
     def angletosteps(self, angle):
         '''
@@ -47,6 +66,54 @@ class Motor:
         '''
         return steps / self.ratio * self.microstep
 
+    def stepposition(self):
+        '''
+        :return: Number of steps the motor is away from its initial angle.
+        '''
+        return round((self.angle - self.init_angle) / self.microstep * self.ratio)
+
+    def progressangle(self, counter, target):
+        '''
+        :param counter: Number of steps of the running move pulsed so far.
+        :param target: Number of steps of the running move, as reported by the firmware.
+        :return: Angle of the motor part way through the running move.
+        '''
+        if not self.started:
+            return self.angle
+        origin, steps = self.started[0]
+        if steps == 0:
+            # The firmware keeps reporting the previous move of a motor which does not move
+            return origin
+        if abs(steps) != target:
+            # Skip moves whose completion was never reported, e.g. after a restart
+            for origin, steps in self.started:
+                if abs(steps) == target:
+                    break
+            else:
+                return self.started[0][0]
+        counter = min(counter, target)
+        return origin + self.stepstoangle(counter if steps > 0 else -counter)
+
+    def startstaged(self):
+        '''
+        Records the staged move as started. Called for every motor of a motor controller a move
+        is started on, even if the motor does not move, so the started moves line up with the
+        completions the motor controller reports.
+        '''
+        self.started.append((self.move_origin, self.move_steps))
+        self.move_origin, self.move_steps = self.angle, 0
+
+    def rejectstarted(self):
+        '''
+        Forgets the last started move after the motor controller rejected it.
+        '''
+        if self.started:
+            self.started.pop()
+
+    def _completed(self, motor_controller):
+        if self.started:
+            self.started.popleft()
+
     def calctime(self, angle):
         '''
         Returns the amount of time the motor should take to move the given angle. Calculation is
@@ -54,7 +121,16 @@ class Motor:
         :param angle: The angle to move.
         :return: The amount of time the motor should take to move the given angle.
         '''
-        steps = self.angletosteps(angle)
+        steps = abs(self.angletosteps(angle))
+        if steps < len(self.time_table):
+            return self.time_table[steps]
+        return self.calcsteptime(steps)
+
+    def calcsteptime(self, steps):
+        '''
+        :param steps: The number of steps to move.
+        :return: The amount of time the motor should take to move the given number of steps.
+        '''
         time = self.time_range * math.sin((abs(steps) * math.pi) / (self.step_range * 2))
         if time < self.min_time:
             time = self.min_time
@@ -62,33 +138,79 @@ class Motor:
             time = self.max_time
         return time
 
-    def moveto(self, angle, time):
+    def calctimes(self, angles):
+        '''
+        Bulk version of calctime for planners which evaluate many moves.
+        :param angles: Sequence or numpy array of angles to move.
+        :return: numpy array of times if numpy is installed, list of times otherwise.
+        '''
+        if numpy is None:
+            return [self.calctime(angle) for angle in angles]
+        # Same operations as angletosteps, truncating towards zero like int
+        steps = numpy.abs((numpy.asarray(angles, dtype=float) / self.microstep * self.ratio)
+                          .astype(numpy.int64))
+        inside = steps < len(self.time_table)
+        times = self.time_array[numpy.where(inside, steps, 0)]
+        for i in numpy.flatnonzero(~inside):
+            times[i] = self.calcsteptime(int(steps[i]))
+        return times
+
+    def moveto(self, angle, time, exit_freq=0):
         '''
         Queues a move of the given angle in the given time.
         :param angle: The angle to move to with reference to the initial angle of the motor.
         :param time: The amount of time the move should take.
+        :param exit_freq: Step frequency the move should end at, used to blend into the next move.
+        '''
+        return self.movesteps(self.angletosteps(angle - self.angle), time, exit_freq)
+
+    def movesteps(self, steps, time, exit_freq=0):
+        '''
+        Queues a move of the given number of steps in the given time.
+        :param steps: Number of steps to move, negative to move backwards.
+        :param time: The amount of time the move should take.
+        :param exit_freq: Step frequency the move should end at, used to blend into the next move.
+        '''
+        self.stagesteps(steps, time, exit_freq)
+        return self.motor_controller.awaitstaged(self.motor_controller.sendstaged())
+
+    def stage(self, angle, time, exit_freq=0):
+        '''
+        Stages a move to the given angle on the motor controller without sending it, so the moves
+        of every motor on the controller can be sent together. Takes the same arguments as moveto.
+        '''
+        self.stagesteps(self.angletosteps(angle - self.angle), time, exit_freq)
+
+    def stagesteps(self, steps, time, exit_freq=0):
+        '''
+        Stages a move of the given number of steps on the motor controller without sending it.
+        Takes the same arguments as movesteps.
         '''
-        angle_to_move = angle - self.angle
-        steps = self.angletosteps(angle_to_move)
+        self.move_origin, self.move_steps = self.angle, steps
         self.angle += self.stepstoangle(steps)
-        print(f'Moving {self.name} on channel: {self.controller_channel} {steps} in {time}')
-        steps_status = self.motor_controller.setsteps(self.controller_channel, steps)
-        time_status = self.motor_controller.settime(self.controller_channel, time)
-        return max(steps_status, time_status)
+        log(logger, DEBUG, 'Moving motor', name=self.name, channel=self.controller_channel,
+            steps=steps, time=time)
+        self.motor_controller.stage(self.controller_channel, steps, time, exit_freq)
 
     def enable(self):
         '''
         Enables the motor.
         :return: Response code from the motor controller.
         '''
-        return self.motor_controller.enable(self.controller_channel)
+        status = self.motor_controller.enable(self.controller_channel)
+        if status == 0:
+            self.enabled = True
+        return status
     
     def disable(self):
         '''
         Disables the motor.
         :return: Response code from the motor controller.
         '''
-        return self.motor_controller.disable(self.controller_channel)
+        status = self.motor_controller.disable(self.controller_channel)
+        if status == 0:
+            self.enabled = False
+        return status
 
     def getstatus(self):
         '''
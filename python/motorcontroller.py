@@ -1,81 +1,568 @@
-from pprint import pformat
-from time import sleep
-from serial import Serial
+import selectors
+import threading
+from collections import deque
+from logging import INFO, WARNING
+from time import monotonic, sleep
+from python import metrics
+from python.exception import ControllerError
+from python.firmwaremodel import BAUD_CONFIRM_MILLIS
+from python.log import getlogger, log
+from python.transport import opentransport
+
+
+TERMINATOR = b'\r\n\r\n'
+
+logger = getlogger('motorcontroller')
+
+
+class Request:
+    '''
+    A frame sent to the motor controller which is waiting for its status code reply.
+    '''
+    def __init__(self, frame, completion=None):
+        '''
+        :param frame: Bytes of the frame.
+        :param completion: Request resolved by the completion frame of a move, for the frames
+        starting a move.
+        '''
+        self.frame = frame
+        self.completion = completion
+        self.sent = monotonic()
+        self.reply = None
+        self.abandoned = False
+        self.error = None
+        self.done = threading.Event()
+
+    def resolve(self, reply):
+        self.reply = reply
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+
+class ReaderPool:
+    '''
+    Single thread which reads the serial ports of many motor controllers, so the number of threads
+    does not grow with the number of motor controllers. Ports which can be selected on are waited on
+    together, any other port is polled.
+    '''
+    def __init__(self, poll_interval=0.002):
+        '''
+        :param poll_interval: Time in seconds between polls of ports which cannot be selected on.
+        '''
+        self.poll_interval = poll_interval
+        self.selector = selectors.DefaultSelector()
+        self.polled = []
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.running = True
+        self.thread = threading.Thread(target=self._readloop, name='reader-pool', daemon=True)
+        self.thread.start()
+
+    def register(self, motor_controller):
+        '''
+        Starts reading the serial port of the motor controller.
+        '''
+        with self.lock:
+            try:
+                self.selector.register(
+                    motor_controller.serial_port.fileno(), selectors.EVENT_READ, motor_controller
+                )
+            except (AttributeError, OSError, ValueError):
+                self.polled.append(motor_controller)
+            self.changed.notify_all()
+
+    def unregister(self, motor_controller):
+        '''
+        Stops reading the serial port of the motor controller.
+        '''
+        with self.lock:
+            if motor_controller in self.polled:
+                self.polled.remove(motor_controller)
+            else:
+                for key in list(self.selector.get_map().values()):
+                    if key.data is motor_controller:
+                        self.selector.unregister(key.fileobj)
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.changed.notify_all()
+        self.thread.join()
+        self.selector.close()
+
+    def _readloop(self):
+        while True:
+            with self.lock:
+                self.changed.wait_for(
+                    lambda: not self.running or self.polled or self.selector.get_map()
+                )
+                if not self.running:
+                    return
+                selected = bool(self.selector.get_map())
+                polled = list(self.polled)
+            if selected:
+                # Registrations made while selecting are picked up on the next pass
+                ready = [
+                    key.data for key, events in self.selector.select(
+                        self.poll_interval if polled else 0.05
+                    )
+                ]
+            else:
+                ready = []
+                threading.Event().wait(self.poll_interval)
+            for motor_controller in ready + polled:
+                self._read(motor_controller)
+
+    def _read(self, motor_controller):
+        serial_port = motor_controller.serial_port
+        try:
+            waiting = serial_port.in_waiting
+            data = serial_port.read(waiting) if waiting else b''
+        except Exception as e:
+            # A port which fails, e.g. an unplugged adapter, must not stop reading the other ports
+            self.unregister(motor_controller)
+            if serial_port.is_open:
+                logger.error('%s: read failed: %s', motor_controller.name, e)
+                motor_controller.fail(ControllerError(f'{motor_controller.name}: read failed: {e}'))
+            return
+        if data:
+            motor_controller.feed(data)
 
 
 class MotorController:
-    def __init__(self, name, config):
+    def __init__(self, name, config, serial_port=None, threaded=True, reader_pool=None,
+                 recorder=None):
+        '''
+        Motor controller class which communicates with a motor controller over a serial port.
+        Replies are read by a dedicated reader thread which matches status codes to the requests
+        waiting for them, in the order the requests were sent, and passes every other frame on to
+        the subscribers.
+        :param config: A dictionary object with the keys: port, baud, timeout, and optionally
+        transport and simulation_speed, see python.transport.
+        :param serial_port: Already opened serial port like object to use instead of opening the
+        configured port.
+        :param threaded: Whether to start a reader thread. Without one, frames are read by the
+        thread waiting for a reply.
+        :param reader_pool: ReaderPool to read the serial port on instead of a reader thread of
+        its own.
+        :param recorder: Recorder which captures every frame sent and every byte received.
+        '''
         self.name = name
 
-        # Get serial port parameters and open serial port
+        # Get serial port parameters and open the configured transport
         self.port = config['port']
         self.baud = config['baud']
         self.timeout = config['timeout']
-        self.serial_port = Serial(
-            port=self.port,
-            baudrate=self.baud,
-            timeout=self.timeout
-        )
+        if serial_port is None:
+            serial_port = opentransport(config)
+        self.serial_port = serial_port
+        self.recorder = recorder
+        self.stream = recorder.stream(name) if recorder is not None else None
+        self.subscribers = []
+        self.event_subscribers = []
+        self.completion_subscribers = []
+
+        # Requests are answered in order, so replies are matched to the oldest pending request
+        self.pending = deque()
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.buffer = b''
+        self.moves = deque()  # requests starting moves which have not been waited for
+        self.completions = deque()  # completions of the accepted moves, in the order they run
+        self.boot_id = None
+        self.registers = {}  # channel -> {register: value} the firmware is known to hold
+        self.carry = {}  # channel -> exit frequency the last move on the channel ended at
+        self.staged = []  # register frames of the next move
+        self.involved = False  # whether the next move has to be started on this controller
+        self.last_heard = monotonic()  # time the last bytes were received
+        self.failure = None  # ControllerError every request raises until the next restart
+        self.restarting = False
+        self.frames = metrics.RateWindow(10)  # frames received
+        metrics.FRAME_RATE.labels(name).function = self.frames.rate
+        self.reader = None
+        self.reader_pool = reader_pool
+        if reader_pool is not None:
+            reader_pool.register(self)
+        elif threaded:
+            self.reader = threading.Thread(
+                target=self._readloop, name=f'{name}-reader', daemon=True
+            )
+            self.reader.start()
 
-        # Test connection
+        # Test connection and upgrade the link if a faster baud rate is configured
         self.getstatus()
-    
-    def _readuntiltermination(self):
-        term = self.serial_port.read_until(b'\r\n\r\n')
-        return term
+        metrics.BAUD.labels(name).set(self.baud)
+        if config.get('negotiate_baud', 0) > 0:
+            self.negotiatebaud(config['negotiate_baud'])
 
-    def _clearallbuffers(self):
-        self.serial_port.flush()
-        self.serial_port.reset_input_buffer()
+    def _readloop(self):
+        while self.serial_port.is_open:
+            try:
+                data = self.serial_port.read(max(1, self.serial_port.in_waiting))
+            except Exception as e:
+                # Closing the port stops the reader, any other failure fails the requests waiting
+                # for a reply instead of leaving them to time out
+                if self.serial_port.is_open:
+                    logger.error('%s: read failed: %s', self.name, e)
+                    self.fail(ControllerError(f'{self.name}: read failed: {e}'))
+                break
+            if data:
+                self.feed(data)
+
+    def _pump(self, request):
+        '''
+        Reads frames on the calling thread until the request is resolved or the port times out.
+        '''
+        with self.read_lock:
+            while not request.done.is_set():
+                data = self.serial_port.read(max(1, self.serial_port.in_waiting))
+                if not data:
+                    return
+                self.feed(data)
+
+    def feed(self, data):
+        '''
+        Splits received bytes into frames and routes each frame to the request waiting for it or
+        to the subscribers.
+        :param data: Bytes received from the serial port.
+        '''
+        self.last_heard = monotonic()
+        if self.recorder is not None:
+            self.recorder.received(self.stream, data)
+        self.buffer += data
+        while TERMINATOR in self.buffer:
+            frame, self.buffer = self.buffer.split(TERMINATOR, 1)
+            frame = frame.strip()
+            if frame:
+                self._dispatch(frame)
+
+    def _dispatch(self, frame):
+        self.frames.add()
+        if frame.startswith(b'@'):
+            self._publish(frame)
+            return
+        if frame.startswith(b'!'):
+            # Moves complete in the order they were accepted
+            if self.completions:
+                self.completions.popleft().resolve(frame[1:])
+            for callback in self.completion_subscribers:
+                callback(self)
+            return
+        if self.pending:
+            request = self.pending.popleft()
+            metrics.ROUND_TRIP_TIME.labels(self.name, request.frame[:1].decode()).observe(
+                monotonic() - request.sent
+            )
+            # The completion of an accepted move can only arrive after the move was accepted
+            if request.completion is not None and frame.split(b'\r\n')[-1] == b'0':
+                self.completions.append(request.completion)
+            if not request.abandoned:
+                request.resolve(frame)
+            return
+        for callback in self.event_subscribers:
+            callback(self, frame)
+
+    def _publish(self, frame):
+        try:
+            channels = [
+                tuple(map(int, channel.split(b',')))
+                for channel in frame[1:].split(b';')
+            ]
+        except ValueError:
+            return
+        for callback in self.subscribers:
+            callback(self, channels)
+
+    def subscribe(self, callback):
+        '''
+        Subscribes to telemetry frames from the motor controller.
+        :param callback: Function called with the motor controller and a list of (pulse counter,
+        pulse target, time slice) tuples, one per channel.
+        '''
+        self.subscribers.append(callback)
+
+    def subscribecompletions(self, callback):
+        '''
+        Subscribes to the completions of moves reported by the motor controller.
+        :param callback: Function called with the motor controller every time a move completes.
+        '''
+        self.completion_subscribers.append(callback)
+
+    def subscribeevents(self, callback):
+        '''
+        Subscribes to frames that are not a reply to any request.
+        :param callback: Function called with the motor controller and the frame.
+        '''
+        self.event_subscribers.append(callback)
+
+    def _request(self, bytes, heartbeat=False):
+        '''
+        Sends a frame without waiting for its reply.
+        :return: Request which is resolved when the reply arrives.
+        '''
+        return self._requestall([bytes], heartbeat=heartbeat)[0]
+
+    def _requestall(self, frames, moves=False, heartbeat=False):
+        '''
+        Sends frames in a single write without waiting for their replies.
+        :param moves: Whether the frames start moves, whose completions are reported separately.
+        :param heartbeat: Whether the frames are heartbeats, which are captured as such so that
+        they can be left out of a replay.
+        :return: List of requests, one per frame, resolved in order.
+        '''
+        if self.failure is not None:
+            raise self.failure
+        requests = [Request(frame, Request(frame) if moves else None) for frame in frames]
+        with self.write_lock:
+            self.pending.extend(requests)
+            if self.recorder is not None:
+                for frame in frames:
+                    self.recorder.sent(self.stream, frame, heartbeat)
+            self.serial_port.write(b''.join(frames))
+        return requests
+
+    def _await(self, request, timeout=None):
+        '''
+        Waits for the reply to a request.
+        :return: Status code, or None if no reply arrived within the timeout.
+        '''
+        done = self._wait(request, timeout)
+        if request.error is not None:
+            raise request.error
+        if not done:
+            # The reply may still arrive, in which case it must not be matched to a later request
+            request.abandoned = True
+            metrics.TIMEOUTS.labels(self.name).inc()
+            if request in self.pending:
+                self._resync()
+            return None
+        # Anything printed before the status code, e.g. boot messages, precedes the last line
+        return int(request.reply.split(b'\r\n')[-1])
+
+    def _wait(self, request, timeout=None):
+        '''
+        Waits for a request to be resolved, reading frames on the calling thread if there is no
+        reader.
+        :return: Whether the request was resolved within the timeout.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        if self.reader is None and self.reader_pool is None:
+            self._pump(request)
+            return request.done.is_set()
+        return request.done.wait(timeout)
+
+    def _resync(self):
+        '''
+        Matches replies to requests again after a request timed out. The reply to a timed out
+        request may never arrive, e.g. if the frame was lost on the way, in which case every later
+        reply would be matched to the request before it. Every request waiting for a reply is
+        failed, the received bytes are discarded, and the link is probed with a status query. The
+        motor controller is failed if the probe is not answered either.
+        '''
+        log(logger, WARNING, 'Request timed out, resynchronising', controller=self.name)
+        error = ControllerError(f'{self.name}: request abandoned after a timeout')
+        with self.write_lock:
+            stale = list(self.pending)
+            self.pending.clear()
+        for request in stale:
+            request.fail(error)
+        self._discard()
+        try:
+            probe = self._request(b'?\r\n\r\n')
+        except ControllerError:
+            return
+        if not self._wait(probe) or probe.error is not None:
+            probe.abandoned = True
+            self.fail(ControllerError(f'{self.name}: no reply after a timeout'))
 
     def _sendreturn(self, bytes):
-        self._clearallbuffers()
-        self.serial_port.write(bytes)
-        self.serial_port.flush()
-        recv = self._readuntiltermination()
-        # print(bytes, recv)
-        return int(recv)
-    
-    def _send(self, bytes):
-        self._clearallbuffers()
-        self.serial_port.write(bytes)
-        self.serial_port.flush()
-    
-    def wait(self):
+        status = self._await(self._request(bytes))
+        if status is None:
+            raise TimeoutError(f'{self.name}: no reply to {bytes}')
+        return status
+
+    def _startmove(self, bytes):
+        '''
+        Sends a frame starting a move without waiting for it to be accepted or completed.
+        '''
+        request = self._requestall([bytes], moves=True)[0]
+        self.moves.append(request)
+        return request
+
+    def _discard(self):
+        '''
+        Discards received bytes which are not part of any frame. Only used when no request is
+        pending, e.g. after a restart.
         '''
-        Waits for a status code response from the motor controller.
-        :return: Status code from the motor controller.
+        self.serial_port.reset_input_buffer()
+        self.buffer = b''
+
+    def awaitaccepted(self):
+        '''
+        Waits for the motor controller to accept the last started move, without waiting for the
+        move to complete.
+        :return: Status code, 1 if no reply arrived.
+        '''
+        if not self.moves:
+            return 0
+        status = self._await(self.moves[-1])
+        if status != 0:
+            self.forget()
+        return 1 if status is None else status
+
+    def wait(self, remaining=0):
         '''
-        status = self._readuntiltermination()
+        Waits for the moves started on the motor controller to be completed.
+        :param remaining: Number of the last started moves which may still be running, e.g. 1 to
+        wait until the last move has started, so that the next move can be staged and queued
+        behind it.
+        :return: Highest status code from the motor controller.
+        '''
+        status = 0
+        start = monotonic()
         try:
-            return int(status)
+            while len(self.moves) > remaining:
+                move = self.moves[0]
+                move_status = self._await(move)
+                if move_status == 0:
+                    move_status = self._await(move.completion)
+                else:
+                    # The registers of a rejected move were not cleared, e.g. after a reset
+                    self.forget()
+                self.moves.popleft()
+                status = max(status, 1 if move_status is None else move_status)
         except ValueError:
+            self.moves.clear()
             return 1
+        finally:
+            metrics.WAIT_TIME.labels(self.name).observe(monotonic() - start)
+        return status
 
     def getstatus(self):
         '''
         Gets the status of the motor controller.
         :return: 0 if ok, 1 otherwise.
         '''
-        return self._sendreturn(b'?\r\n\r\n')
+        status = self._sendreturn(b'?\r\n\r\n')
+        metrics.CONTROLLER_STATUS.labels(self.name).set(status)
+        return status
     
+    def getbootid(self):
+        '''
+        Gets the boot id of the motor controller, a random number drawn every time it boots.
+        :return: Boot id, or None if the firmware does not support boot ids.
+        '''
+        boot_id = self._sendreturn(b'U\r\n\r\n')
+        # Firmware without boot ids rejects the command with a status code
+        boot_id = boot_id if boot_id > 1 else None
+        if boot_id != self.boot_id:
+            # The registers of a controller which was reset hold nothing
+            self.forget()
+        self.boot_id = boot_id
+        return self.boot_id
+
     def restart(self):
         '''
         Restarts the motor controller.
         :return: Status of the motor controller after restarting.
         '''
-        status = self._sendreturn(b'R\r\n\r\n')
-        if status != 0:
-            raise Exception('Error restarting controller')
-        sleep(0.2)
-        status = self.getstatus()
+        # Restarting is the way to recover from a failure, and resets the boot id
+        self.restarting = True
+        self.failure = None
+        self.boot_id = None
+        try:
+            status = self._sendreturn(b'R\r\n\r\n')
+            if status != 0:
+                raise Exception('Error restarting controller')
+            sleep(0.2)
+            self._discard()
+            self.forget()
+            self.carry = {}
+            self.moves.clear()
+            self.completions.clear()
+            status = self.getstatus()
+        finally:
+            self.restarting = False
         return status
+
+    def negotiatebaud(self, baud, timeout=0.5):
+        '''
+        Switches the link to a faster baud rate. The motor controller replies at the current baud
+        rate and switches, then the host switches and verifies the link with a status round trip.
+        If the verification fails the host switches back, and the motor controller falls back
+        since it received no valid frame at the new baud rate. Must only be called while the motor
+        controller is idle.
+        :param baud: Baud rate to switch to.
+        :param timeout: Time in seconds to wait for the status reply at the new baud rate.
+        :return: Baud rate the link runs at.
+        '''
+        previous = self.baud
+        if self._sendreturn(f'N {baud}\r\n\r\n'.encode()) != 0:
+            log(logger, WARNING, 'Baud rate rejected', controller=self.name, baud=baud)
+            return previous
+        self.serial_port.baudrate = baud
+        # Waited for without resynchronising, since a lost reply is expected if the link failed
+        probe = self._request(b'?\r\n\r\n')
+        status = None
+        if self._wait(probe, timeout) and probe.error is None:
+            try:
+                status = int(probe.reply.split(b'\r\n')[-1])
+            except ValueError:
+                pass
+        else:
+            probe.abandoned = True
+        if status == 0:
+            self.baud = baud
+            metrics.BAUD.labels(self.name).set(baud)
+            log(logger, INFO, 'Negotiated baud rate', controller=self.name, baud=baud)
+            return baud
+        log(logger, WARNING, 'No reply at negotiated baud rate, falling back', controller=self.name,
+            baud=baud, fallback=previous)
+        self.serial_port.baudrate = previous
+        sleep(BAUD_CONFIRM_MILLIS / 1000)
+        # Whatever was received at the wrong baud rate is garbage, and no reply is outstanding
+        self.pending.clear()
+        self._discard()
+        self.getstatus()
+        return previous
+
+    def framerate(self):
+        '''
+        :return: Frames received per second over the last 10 seconds.
+        '''
+        return self.frames.rate()
+
+    def fail(self, error):
+        '''
+        Marks the motor controller as failed. Every request waiting for a reply and every later
+        request raises the error, instead of waiting for the timeout, until it is restarted.
+        :param error: ControllerError to raise.
+        '''
+        self.failure = error
+        while True:
+            try:
+                request = self.pending.popleft()
+            except IndexError:
+                break
+            request.fail(error)
+        while True:
+            try:
+                completion = self.completions.popleft()
+            except IndexError:
+                break
+            completion.fail(error)
     
     def terminate(self):
         '''
-        Resets the motor controllers.
+        Resets the motor controllers. The boot id after the reset is kept in boot_id.
         '''
         self.restart()
+        self.getbootid()
+        if self.reader_pool is not None:
+            self.reader_pool.unregister(self)
         self.serial_port.close()
     
     def setsteps(self, channel, steps):
@@ -83,15 +570,22 @@ class MotorController:
         Sets the steps value for a channel.
         '''
         to_send = f'S {channel} {steps}\r\n\r\n'.encode()
-        return self._sendreturn(to_send)
+        return self._remember('S', channel, steps, self._sendreturn(to_send))
     
     def settime(self, channel, time):
         '''
         Sets the time value for a channel.
         '''
         to_send = f'T {channel} {time}\r\n\r\n'.encode()
-        return self._sendreturn(to_send)
+        return self._remember('T', channel, time, self._sendreturn(to_send))
     
+    def setexitfreq(self, channel, freq):
+        '''
+        Sets the frequency the next move on a channel ends at.
+        '''
+        to_send = f'V {channel} {freq}\r\n\r\n'.encode()
+        return self._remember('V', channel, freq, self._sendreturn(to_send))
+
     def enable(self, channel):
         '''
         Enables the channel.
@@ -106,27 +600,118 @@ class MotorController:
         to_send = f'D {channel}\r\n\r\n'.encode()
         return self._sendreturn(to_send)
     
+    def settelemetry(self, interval):
+        '''
+        Sets the interval between telemetry frames sent during movement.
+        :param interval: Interval in milliseconds, 0 disables telemetry.
+        '''
+        to_send = f'L {interval}\r\n\r\n'.encode()
+        return self._sendreturn(to_send)
+
     def setpin(self, pin, state):
         '''
         '''
         to_send = f'P {pin} {state}\r\n\r\n'.encode()
         return self._sendreturn(to_send)
 
+    def _remember(self, register, channel, value, status):
+        '''
+        Records the value of a register written to the firmware.
+        :return: The status code of the write.
+        '''
+        if status == 0:
+            self.registers.setdefault(channel, {})[register] = value
+        else:
+            self.forget(channel)
+        return status
+
+    def forget(self, channel=None):
+        '''
+        Forgets the register values of a channel, or of every channel, so they are written again.
+        '''
+        if channel is None:
+            self.registers = {}
+        else:
+            self.registers.pop(channel, None)
+
+    def stage(self, channel, steps, time, exit_freq=0):
+        '''
+        Stages the register writes of a move on a channel, skipping registers the firmware already
+        holds. A channel that does not move needs no writes at all, the firmware clears the steps
+        and exit frequency after every move.
+        :param channel: Channel number.
+        :param steps: Number of steps to move, negative to move backwards.
+        :param time: The amount of time the move should take.
+        :param exit_freq: Step frequency the move should end at.
+        '''
+        if steps == 0:
+            # A move still has to be started if it clears a frequency carried over from the last
+            # move
+            self.involved = self.involved or self.carry.get(channel, 0) != 0
+            return
+        self.involved = True
+        registers = self.registers.setdefault(channel, {})
+        for register, value in (('S', steps), ('T', time), ('V', exit_freq)):
+            if registers.get(register) != value:
+                self.staged.append(f'{register} {channel} {value}\r\n\r\n'.encode())
+                registers[register] = value
+
+    def sendstaged(self):
+        '''
+        Sends the staged register writes in a single write without waiting for their replies.
+        :return: List of requests to pass to awaitstaged.
+        '''
+        frames, self.staged = self.staged, []
+        return self._requestall(frames) if frames else []
+
+    def awaitstaged(self, requests):
+        '''
+        Waits for the replies to staged register writes. If any write failed the registers are
+        forgotten, so they are all written again.
+        :return: Highest status code, 0 if nothing was sent.
+        '''
+        status = 0
+        for request in requests:
+            reply = self._await(request)
+            if reply is None:
+                self.forget()
+                raise TimeoutError(f'{self.name}: no reply to {request.frame}')
+            status = max(status, reply)
+        if status != 0:
+            self.forget()
+        return status
+
+    def _moved(self, channels):
+        '''
+        Updates the registers of channels a move was started on the way the firmware does.
+        '''
+        for channel in channels:
+            registers = self.registers.setdefault(channel, {})
+            self.carry[channel] = registers.get('V', 0)
+            registers['S'] = registers['V'] = 0
+        self.involved = False
+
     def moveall(self, wait=False):
         '''
-        Executes all movements on the motor controller.
+        Executes all movements on the motor controller. The firmware accepts the move right away
+        and reports its completion with a separate frame. One move can be started while another
+        one is running, it then starts as soon as the running move completes.
+        :param wait: Whether to wait for every started move to complete.
         '''
         to_send = b'G\r\n\r\n'
+        self._moved(set(self.registers) | set(self.carry))
+        self._startmove(to_send)
         if wait:
-            return self._return()
-        self._send(to_send)
+            return self.wait()
     
     def move(self, channel, wait=False):
         '''
         Executes movement on a specific channel of the motor controller.
         :param channel: Channel number
+        :param wait: Whether to wait for every started move to complete.
         '''
         to_send = f'G {channel}\r\n\r\n'.encode()
+        self._moved([channel])
+        self._startmove(to_send)
         if wait:
-            return self._sendreturn(to_send)
-        self._send(to_send)
+            return self.wait()
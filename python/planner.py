@@ -0,0 +1,363 @@
+'''
+Obstacle aware motion planning with a probabilistic roadmap. Collision free configurations of the
+base, arm a, and arm b motors are sampled and joined to their nearest neighbours by collision free
+joint space moves, weighted by the time the move takes. Queries connect the current angles and every
+inverse kinematics solution of the destination to the roadmap and return the shortest time path.
+
+The arm is checked as two line segments, shoulder to elbow and elbow to tip, against obstacles in
+the arm frame inflated by the obstacle_clearance configuration. Obstacles are configured with the
+obstacles configuration, e.g.
+    {"type": "box", "min": [x, y, z], "max": [x, y, z]}
+    {"type": "cylinder", "center": [x, y], "radius": r, "z": [bottom, top]}
+
+Building the roadmap takes seconds, so it is cached in the roadmap_cache directory, one file per
+obstacle set and arm configuration. Queries take milliseconds.
+
+Usage: python -m python.planner <config path> <x> <y> <z>
+'''
+import hashlib
+import heapq
+import json
+import math
+import os
+import random
+import sys
+from collections import namedtuple
+from time import monotonic
+from python.exception import IKError, InvalidConfigurationException, PlanningError
+
+
+Waypoint = namedtuple('Waypoint', ['x', 'y', 'z', 'angles', 'time'])
+
+
+def segmentslab(p, q, low, high, axes):
+    '''
+    Clips the segment p -> q to the slab low <= coordinate <= high along the given axes.
+    :return: Parameter interval (t0, t1) of the segment inside the slab, or None if it is outside.
+    '''
+    t0, t1 = 0.0, 1.0
+    for i in axes:
+        d = q[i] - p[i]
+        if d == 0:
+            if not low[i] <= p[i] <= high[i]:
+                return None
+            continue
+        a, b = (low[i] - p[i]) / d, (high[i] - p[i]) / d
+        if a > b:
+            a, b = b, a
+        t0, t1 = max(t0, a), min(t1, b)
+        if t0 > t1:
+            return None
+    return t0, t1
+
+
+class Box:
+    def __init__(self, low, high):
+        self.low = tuple(low)
+        self.high = tuple(high)
+
+    def intersects(self, p, q):
+        return segmentslab(p, q, self.low, self.high, (0, 1, 2)) is not None
+
+
+class Cylinder:
+    '''
+    Vertical cylinder.
+    '''
+    def __init__(self, center, radius, bottom, top):
+        self.center = tuple(center)
+        self.radius2 = radius * radius
+        self.low = (0, 0, bottom)
+        self.high = (0, 0, top)
+
+    def intersects(self, p, q):
+        interval = segmentslab(p, q, self.low, self.high, (2,))
+        if interval is None:
+            return False
+        # Closest approach to the axis within the height range
+        dx, dy = q[0] - p[0], q[1] - p[1]
+        wx, wy = p[0] - self.center[0], p[1] - self.center[1]
+        length2 = dx * dx + dy * dy
+        t = -(wx * dx + wy * dy) / length2 if length2 > 0 else 0
+        t = min(max(t, interval[0]), interval[1])
+        x, y = wx + dx * t, wy + dy * t
+        return x * x + y * y <= self.radius2
+
+
+def obstacle(config, clearance=0):
+    '''
+    Creates an obstacle from its configuration, inflated by the clearance.
+    '''
+    if config.get('type') == 'box':
+        return Box(
+            [value - clearance for value in config['min']],
+            [value + clearance for value in config['max']]
+        )
+    if config.get('type') == 'cylinder':
+        bottom, top = config['z']
+        return Cylinder(
+            config['center'], config['radius'] + clearance, bottom - clearance, top + clearance
+        )
+    raise InvalidConfigurationException(f'obstacle type must be one of: box, cylinder: {config}')
+
+
+class Planner:
+    def __init__(self, robot_arm, obstacles=None, clearance=None, samples=None, neighbours=None,
+                 resolution=None, cache=None, seed=0):
+        '''
+        Options default to the configuration of the robot arm.
+        :param robot_arm: Robot arm whose kinematics and motors are used.
+        :param obstacles: List of obstacle configurations.
+        :param clearance: Distance in mm the arm keeps from obstacles.
+        :param samples: Number of configurations in the roadmap.
+        :param neighbours: Number of nearest configurations each configuration is joined to.
+        :param resolution: Largest distance in mm the tip moves between collision checks of a move.
+        :param cache: Directory roadmaps are cached in, empty to always build the roadmap.
+        :param seed: Seed of the configuration sampling.
+        '''
+        self.robot_arm = robot_arm
+        self.obstacle_config = robot_arm.obstacles if obstacles is None else obstacles
+        self.clearance = robot_arm.obstacle_clearance if clearance is None else clearance
+        self.samples = robot_arm.roadmap_samples if samples is None else samples
+        self.neighbours = robot_arm.roadmap_neighbours if neighbours is None else neighbours
+        self.resolution = robot_arm.roadmap_resolution if resolution is None else resolution
+        self.cache = robot_arm.roadmap_cache if cache is None else cache
+        self.seed = seed
+        self.obstacles = [obstacle(config, self.clearance) for config in self.obstacle_config]
+        self.reach = robot_arm.arm_a['length'] + robot_arm.arm_b['length']
+        self.nodes = None
+        self.edges = None
+
+    def key(self):
+        '''
+        :return: Hash of everything the roadmap depends on.
+        '''
+        arm = self.robot_arm
+        description = {
+            'obstacles': self.obstacle_config,
+            'options': [self.clearance, self.samples, self.neighbours, self.resolution, self.seed],
+            'arms': [arm.arm_a['length'], arm.arm_b['length'], arm.z_center_to_origin],
+            'motors': [
+                [motor.min_angle, motor.max_angle, motor.microstep, motor.ratio, motor.min_time,
+                 motor.max_time]
+                for motor in arm.motors
+            ]
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def joints(self, angles):
+        '''
+        :return: Shoulder, elbow, and tip coordinates for the given motor angles.
+        '''
+        arm = self.robot_arm
+        base, arm_a = math.radians(angles[0]), math.radians(angles[1])
+        reach = arm.arm_a['length'] * math.cos(arm_a)
+        elbow = (
+            math.cos(base) * reach,
+            math.sin(base) * reach,
+            arm.arm_a['length'] * math.sin(arm_a) + arm.z_center_to_origin
+        )
+        return (0, 0, arm.z_center_to_origin), elbow, arm.anglestocoord(*angles[:3])
+
+    def collides(self, angles):
+        shoulder, elbow, tip = self.joints(angles)
+        return any(
+            o.intersects(shoulder, elbow) or o.intersects(elbow, tip) for o in self.obstacles
+        )
+
+    def valid(self, angles):
+        '''
+        :return: Whether the angles are within the motor limits and collision free.
+        '''
+        in_range = all(
+            motor.min_angle <= angle <= motor.max_angle
+            for motor, angle in zip(self.robot_arm.motors, angles)
+        )
+        return in_range and not self.collides(angles)
+
+    def edgefree(self, start, end):
+        '''
+        :return: Whether the joint space move between two collision free configurations is
+        collision free.
+        '''
+        delta = max(abs(e - s) for s, e in zip(start[:3], end[:3]))
+        count = max(1, math.ceil(math.radians(delta) * self.reach / self.resolution))
+        for k in range(1, count):
+            t = k / count
+            if self.collides([s + (e - s) * t for s, e in zip(start, end)]):
+                return False
+        return not self.collides(end)
+
+    def nearest(self, angles, count):
+        '''
+        :return: List of (time, node) of the count roadmap configurations closest in move time.
+        '''
+        times = self.robot_arm.calcmovetimes(self.nodes, angles)
+        return heapq.nsmallest(count, zip(map(float, times), range(len(self.nodes))))
+
+    def connect(self, angles):
+        '''
+        :return: List of (node, time) collision free moves from the angles into the roadmap.
+        '''
+        return [
+            (node, time) for time, node in self.nearest(angles, self.neighbours)
+            if self.edgefree(angles, self.nodes[node])
+        ]
+
+    def build(self):
+        '''
+        Samples the roadmap.
+        '''
+        rng = random.Random(self.seed)
+        motors = self.robot_arm.motors
+        self.nodes = []
+        attempts = 0
+        while len(self.nodes) < self.samples and attempts < self.samples * 100:
+            attempts += 1
+            angles = [rng.uniform(motor.min_angle, motor.max_angle) for motor in motors[:3]]
+            angles.append(270 - angles[1] - angles[2])
+            if self.valid(angles):
+                self.nodes.append(tuple(angles))
+        neighbours = [{} for _ in self.nodes]
+        for i, node in enumerate(self.nodes):
+            for time, j in self.nearest(node, self.neighbours + 1):
+                if j != i and j not in neighbours[i] and self.edgefree(node, self.nodes[j]):
+                    neighbours[i][j] = neighbours[j][i] = time
+        self.edges = [sorted(edges.items()) for edges in neighbours]
+
+    def cachepath(self):
+        return os.path.join(self.cache, f'roadmap-{self.key()[:16]}.json') if self.cache else ''
+
+    def load(self):
+        '''
+        Loads the roadmap from the cache, building and caching it if it is not cached yet.
+        '''
+        if self.nodes is not None:
+            return
+        path = self.cachepath()
+        if path and os.path.exists(path):
+            with open(path) as roadmap_file:
+                roadmap = json.load(roadmap_file)
+            if roadmap.get('key') == self.key():
+                self.nodes = [tuple(node) for node in roadmap['nodes']]
+                self.edges = [[tuple(edge) for edge in edges] for edges in roadmap['edges']]
+                return
+        self.build()
+        if path:
+            os.makedirs(self.cache, exist_ok=True)
+            temp_path = f'{path}.tmp'
+            with open(temp_path, 'w') as roadmap_file:
+                json.dump({'key': self.key(), 'nodes': self.nodes, 'edges': self.edges},
+                          roadmap_file)
+            os.replace(temp_path, path)
+
+    def plan(self, x, y, z, start=None):
+        '''
+        Plans the shortest time collision free path to the given coordinates.
+        :param start: Angles the path starts from. Defaults to the current motor angles.
+        :return: List of waypoints, each with the coordinates and the motor angles it is reached
+        at and the time in ms of the move to it. moveto may pick a different inverse kinematics
+        solution, so the angles should be moved to, e.g. with follow.
+        '''
+        self.load()
+        arm = self.robot_arm
+        if start is None:
+            start = [motor.angle for motor in arm.motors]
+        start = tuple(start)
+        if self.collides(start):
+            raise PlanningError('start angles collide with an obstacle')
+        solutions = arm.iksolutions(x, y, z, start[0])
+        if not solutions:
+            raise IKError(f'IK Error\nno solution within range for {x} {y} {z}')
+        goals = [tuple(goal) for goal in solutions if self.valid(goal)]
+        if not goals:
+            raise PlanningError(f'every solution for {x} {y} {z} collides with an obstacle')
+
+        # Goals and the start are appended to the roadmap nodes for the search
+        count = len(self.nodes)
+        nodes = self.nodes + goals + [start]
+        source = len(nodes) - 1
+        extra = {source: self.connect(start)}
+        for k, goal in enumerate(goals):
+            if self.edgefree(start, goal):
+                extra[source].append((count + k, arm.calcmovetime(goal, start)))
+            for node, time in self.connect(goal):
+                extra.setdefault(node, []).append((count + k, time))
+
+        times, previous = {source: 0}, {}
+        queue = [(0, source)]
+        while queue:
+            time, node = heapq.heappop(queue)
+            if count <= node < source:
+                break
+            if time > times[node]:
+                continue
+            for neighbour, edge_time in (self.edges[node] if node < count else []) + \
+                    extra.get(node, []):
+                if time + edge_time < times.get(neighbour, math.inf):
+                    times[neighbour] = time + edge_time
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (time + edge_time, neighbour))
+        else:
+            raise PlanningError(f'no collision free path to {x} {y} {z}')
+        path = [nodes[node]]
+        while node != source:
+            node = previous[node]
+            path.append(nodes[node])
+        return self.waypoints(self.shortcut(path[::-1]))
+
+    def shortcut(self, path):
+        '''
+        Skips waypoints where a direct move is collision free. A direct move never takes longer
+        than the moves it replaces.
+        '''
+        result = [path[0]]
+        i = 0
+        while i < len(path) - 1:
+            j = len(path) - 1
+            while j > i + 1 and not self.edgefree(path[i], path[j]):
+                j -= 1
+            result.append(path[j])
+            i = j
+        return result
+
+    def waypoints(self, path):
+        waypoints = []
+        for previous, angles in zip(path, path[1:]):
+            waypoints.append(Waypoint(
+                *self.robot_arm.anglestocoord(*angles[:3]), angles,
+                self.robot_arm.calcmovetime(angles, previous)
+            ))
+        return waypoints
+
+
+def follow(robot_arm, waypoints):
+    '''
+    Moves the robot arm through planned waypoints.
+    '''
+    for waypoint in waypoints:
+        robot_arm.stageangles(waypoint.angles, waypoint.time)
+        robot_arm.x, robot_arm.y, robot_arm.z = waypoint[:3]
+        robot_arm.queuemove()
+    robot_arm.waitmove()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    from python.robotarm import RobotArm
+    robot_arm = RobotArm(sys.argv[1])
+    try:
+        planner = Planner(robot_arm)
+        started = monotonic()
+        planner.load()
+        print(f'Roadmap of {len(planner.nodes)} configurations loaded in '
+              f'{monotonic() - started:.2f} s')
+        started = monotonic()
+        waypoints = planner.plan(*map(float, sys.argv[2:5]))
+        print(f'Planned in {(monotonic() - started) * 1000:.1f} ms')
+        for waypoint in waypoints:
+            print(f'{waypoint.x:.1f} {waypoint.y:.1f} {waypoint.z:.1f} {waypoint.time:.2f}')
+    finally:
+        robot_arm.terminate()
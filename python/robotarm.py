@@ -1,50 +1,92 @@
 import json
 import math
-from time import sleep
-from pprint import pprint
-from serial import Serial
-from python.exception import InvalidConfigurationException, IKError
+import os
+import threading
+from time import monotonic, sleep
+from logging import DEBUG, INFO
+from pprint import pformat
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from python import metrics
+from python.exception import InvalidConfigurationException, IKError, ValidationError
+from python.heartbeat import Heartbeat
+from python.jog import interactive
+from python.log import Lazy, configure, getlogger, log
 from python.motor import Motor
 from python.motorcontroller import MotorController
+from python.planner import Planner, follow
+from python.telemetry import Telemetry
+from python.validation import check, validate, validatepoints
+
+
+def cornerangle(a, b, c):
+    '''
+    Calculates the angle between the segments a -> b and b -> c.
+    :return: Angle in degrees, 0 for a straight line, or None if either segment has no length.
+    '''
+    u = [bi - ai for ai, bi in zip(a, b)]
+    v = [ci - bi for bi, ci in zip(b, c)]
+    norm = math.sqrt(sum(ui * ui for ui in u)) * math.sqrt(sum(vi * vi for vi in v))
+    if norm == 0:
+        return None
+    cos = sum(ui * vi for ui, vi in zip(u, v)) / norm
+    return math.degrees(math.acos(max(-1, min(1, cos))))
+
+
+logger = getlogger('robotarm')
 
 
 class RobotArm:
-    def __init__(self, config_path, verbose=False):
+    def __init__(self, config_path, verbose=False, reader_pool=None, recorder=None):
         '''
         Initializes the variables and objects needed for a robot arm.
         :param configs: A dictionary object containing motor configurations for the base, arm a,
         arm b, and picker motors.
-        :param verbose: Flag to control verbosity.
+        :param verbose: Flag to control verbosity, logs everything down to the debug level.
+        :param reader_pool: ReaderPool shared with other robot arms which reads the serial ports
+        of the motor controllers. Defaults to a reader thread per motor controller.
+        :param recorder: Recorder which captures the serial traffic of every motor controller.
         '''
         self.verbose = verbose
+        if verbose:
+            configure(DEBUG)
+        self.reader_pool = reader_pool
+        self.recorder = recorder
+        self.move_started = None
+        self.started = []  # motor controllers the last move was started on
+        self.state_lock = threading.Lock()  # the jog thread and the jog keys both save the state
         self.loadconfig(config_path)
         self.checkpoints = dict()
+        self.warm_start = self.loadstate()
+        if self.telemetry is not None:
+            self.telemetry.seed()
         self.prev_command = RobotArm.Command('move', [self.x, self.y, self.z])
-        if verbose:
-            print('Robot arm initialization complete')
-            pprint(self.__dict__)
-            print()
+        logger.info('Robot arm initialization complete')
+        logger.debug('%s', Lazy(lambda: pformat(self.__dict__)))
 
     def loadconfig(self, config_path):
         '''
         Loads the config from the configuration path.
         :param config_path: Path to the configuration file.
         '''
-        if self.verbose:
-            print('Loading configuration from', config_path)
+        log(logger, INFO, 'Loading configuration', path=config_path)
         with open(config_path) as config_file:
             config = json.load(config_file)
 
-            # Initialize motor controllers
-            if self.verbose:
-                print('Setting up motor controllers')
+            # Initialize motor controllers, each may override the transport of the robot arm
+            logger.info('Setting up motor controllers')
+            self.transport = config.get('transport', 'serial')
+            self.simulation_speed = config.get('simulation_speed', 1)
+            defaults = {'transport': self.transport, 'simulation_speed': self.simulation_speed}
             self.motor_controllers = {
-                name: MotorController(name, conf) for name, conf in config['motor_controllers'].items()
+                name: self.createmotorcontroller(name, {**defaults, **conf})
+                for name, conf in config['motor_controllers'].items()
             }
 
             # Initialize motors
-            if self.verbose:
-                print('Setting up motors')
+            logger.info('Setting up motors')
             self.base_motor = Motor(
                 'base_motor',
                 config['motors']['base_motor'],
@@ -65,21 +107,75 @@ class RobotArm:
                 config['motors']['picker_motor'],
                 self.motor_controllers[config['motors']['picker_motor']['motor_controller']]
             )
+            self.motors = [self.base_motor, self.arm_a_motor, self.arm_b_motor, self.picker_motor]
 
             # Initialize coordinates, arm lengths, etc
-            if self.verbose:
-                print('Initializing additional variables')
+            logger.info('Initializing additional variables')
             self.arm_a = config['arms']['arm_a']
             self.arm_b = config['arms']['arm_b']
             self.arm_a['length2'] = self.arm_a['length'] * self.arm_a['length']
             self.arm_b['length2'] = self.arm_b['length'] * self.arm_b['length']
             self.z_center_to_origin = config['z_center_to_origin']
+            self.blend_tolerance = config.get('blend_tolerance', 0)
+            self.ik_selection = config.get('ik_selection', 'time')
+            if self.ik_selection not in ('time', 'travel'):
+                raise InvalidConfigurationException('ik_selection must be one of: time, travel')
+            self.state_path = config.get('state_path', '')
+            self.gcode_origin = config.get('gcode_origin', [0, 0, 0])
+            self.gcode_mcodes = config.get('gcode_mcodes', {})
+            self.obstacles = config.get('obstacles', [])
+            self.obstacle_clearance = config.get('obstacle_clearance', 20)
+            self.roadmap_samples = config.get('roadmap_samples', 500)
+            self.roadmap_neighbours = config.get('roadmap_neighbours', 8)
+            self.roadmap_resolution = config.get('roadmap_resolution', 10)
+            self.roadmap_cache = config.get('roadmap_cache', '')
+            self.planner = None
             self.x, self.y, self.z = self.anglestocoord(
                 config['motors']['base_motor']['init_angle'],
                 config['motors']['arm_a_motor']['init_angle'],
                 config['motors']['arm_b_motor']['init_angle']
             )
 
+            # Export metrics if a port or snapshot path is configured
+            if config.get('metrics_port', 0) > 0:
+                metrics.serve(config['metrics_port'])
+            self.metrics_snapshots = None
+            if config.get('metrics_snapshot'):
+                self.metrics_snapshots = metrics.writesnapshots(
+                    config['metrics_snapshot'], config.get('metrics_interval', 10)
+                )
+
+            # Enable the live position feed if a telemetry interval is configured
+            telemetry_interval = config.get('telemetry_interval', 0)
+            self.telemetry = Telemetry(self, telemetry_interval) if telemetry_interval > 0 else None
+
+            # Watch the motor controllers if a heartbeat interval is configured
+            heartbeat_interval = config.get('heartbeat_interval', 0)
+            self.heartbeat = Heartbeat(
+                self, heartbeat_interval, config.get('heartbeat_timeout', 200)
+            ) if heartbeat_interval > 0 else None
+
+    def createmotorcontroller(self, name, config):
+        '''
+        Creates the motor controller for the given controller configuration.
+        :param name: Name of the motor controller.
+        :param config: Configuration of the motor controller.
+        '''
+        return MotorController(
+            name, config, reader_pool=self.reader_pool, recorder=self.recorder
+        )
+
+    def sleep(self, seconds):
+        '''
+        Pauses the robot arm for the given number of seconds. Under the simulator the pause is
+        scaled to the simulation speed, and skipped if the simulation runs as fast as possible.
+        '''
+        if self.transport == 'simulator':
+            if self.simulation_speed == 0:
+                return
+            seconds /= self.simulation_speed
+        sleep(seconds)
+
     def getstatus(self):
         '''
         Gets the status of each motor controller.
@@ -88,8 +184,7 @@ class RobotArm:
         status = 0
         for mc in self.motor_controllers.values():
             mc_status = mc.getstatus()
-            if self.verbose:
-                print(f'{mc.name}: {mc_status}')
+            log(logger, INFO, 'Motor controller status', controller=mc.name, status=mc_status)
             status = max(mc_status, status)
         return status
 
@@ -114,43 +209,121 @@ class RobotArm:
         if not (isinstance(val, int) or isinstance(val, float)):
             raise ValueError('value must be type float or int')
         setattr(self, coord, val)
-        if self.verbose:
-            print(f'Set {coord} to {val}')
+        log(logger, INFO, 'Set coordinate', coord=coord, value=val)
 
     def restart(self):
         '''
         Restarts all motor controllers.
         :return: 0 if all controllers are ok, 1 otherwise.
         '''
-        if self.verbose:
-            print('Restarting all motor controllers')
+        logger.info('Restarting all motor controllers')
         for mc in self.motor_controllers.values():
             mc.restart()
-        sleep(0.2)
-        return self.getstatus()
+        self.sleep(0.2)
+        status = self.getstatus()
+        if self.state_path:
+            # The motors hold their position through a restart, so the state stays valid
+            for mc in self.motor_controllers.values():
+                mc.getbootid()
+            self.savestate()
+        return status
 
     def terminate(self):
         '''
         Terminates all motor controllers.
         '''
-        if self.verbose:
-            print('Terminating all motor controllers')
+        logger.info('Terminating all motor controllers')
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
         for mc in self.motor_controllers.values():
             mc.terminate()
+        # Terminating restarts the controllers, the state is saved with their new boot ids so that
+        # the next start is a warm start
+        self.savestate()
+        if self.metrics_snapshots is not None:
+            self.metrics_snapshots.set()
+
+    def savestate(self):
+        '''
+        Writes the motor angles and step positions, enabled motors, checkpoints and the boot ids
+        of the motor controllers to the state path. The file is replaced atomically, so a crash
+        leaves either the previous or the new state.
+        '''
+        if not self.state_path:
+            return
+        with self.state_lock:
+            self._writestate()
+
+    def _writestate(self):
+        state = {
+            'boot_ids': {name: mc.boot_id for name, mc in self.motor_controllers.items()},
+            'coordinates': [self.x, self.y, self.z],
+            'motors': {
+                motor.name: {
+                    'angle': motor.angle, 'steps': motor.stepposition(), 'enabled': motor.enabled
+                }
+                for motor in self.motors
+            },
+            'checkpoints': {
+                index: [cp.type] + [str(arg) for arg in cp.args]
+                for index, cp in self.checkpoints.items()
+            }
+        }
+        temp_path = f'{self.state_path}.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, self.state_path)
+
+    def loadstate(self):
+        '''
+        Restores the state saved at the state path. Checkpoints are always restored. The motor
+        angles are only restored if every motor controller reports the boot id it had when the
+        state was saved, since the arm may have been moved by hand while a controller was off.
+        :return: Whether the motor angles were restored.
+        '''
+        if not self.state_path:
+            return False
+        boot_ids = {name: mc.getbootid() for name, mc in self.motor_controllers.items()}
+        if not os.path.exists(self.state_path):
+            return False
+        with open(self.state_path) as state_file:
+            state = json.load(state_file)
+        for index, cp in state.get('checkpoints', {}).items():
+            self.checkpoints[int(index)] = RobotArm.Command(cp[0], cp[1:])
+        if None in boot_ids.values() or boot_ids != state.get('boot_ids'):
+            logger.warning('Motor controllers were reset, assuming the initial pose')
+            return False
+        for motor in self.motors:
+            saved = state['motors'][motor.name]
+            motor.angle = motor.move_origin = saved['angle']
+            # Reapply the enabled state in case the enable pins were reset
+            if saved['enabled'] is True:
+                motor.enable()
+            elif saved['enabled'] is False:
+                motor.disable()
+        self.x, self.y, self.z = state['coordinates']
+        log(logger, INFO, 'Restored state', path=self.state_path, x=self.x, y=self.y, z=self.z)
+        return True
         
     def enable(self, motor):
         '''
         Enables the motor.
         :param motor: Motor to be enabled.
         '''
-        return getattr(self, motor).enable()
+        status = getattr(self, motor).enable()
+        self.savestate()
+        return status
     
     def disable(self, motor):
         '''
         Disables the motor.
         :param motor: Motor to be disabled.
         '''
-        return getattr(self, motor).disable()
+        status = getattr(self, motor).disable()
+        self.savestate()
+        return status
     
     def setpin(self, motor_controller, pin, state):
         '''
@@ -180,145 +353,455 @@ class RobotArm:
         y = math.sin(math.radians(base_angle)) * l
         return x, y, z
 
-    def coordtoangles(self, x, y, z):
+    def iksolutions(self, x, y, z, base_reference=None):
+        '''
+        Inverse kinematics function which enumerates every combination of motor angles that
+        reaches the given coordinates within the motor limits. The base can face the target or face
+        away from it with the arm reaching back over the top, and the elbow can bend either way.
+        :param x: x coordinate of destination.
+        :param y: y coordinate of destination.
+        :param z: z coordinate of destination.
+        :param base_reference: Base angle to keep when the destination is on the base axis.
+        Defaults to the current base angle.
+        :return: List of (base angle, arm a angle, arm b angle, picker angle) tuples.
+        '''
+        # Calculate required intermediate values
+        r1 = math.hypot(x, y)
+        r2 = z - self.z_center_to_origin
+        r3 = math.hypot(r1, r2)
+        r32 = r3 * r3
+        cos_a = (self.arm_b['length2'] - self.arm_a['length2'] - r32) / \
+            (-2 * self.arm_a['length'] * r3) if r3 > 0 else 2
+        cos_b = (r32 - self.arm_a['length2'] - self.arm_b['length2']) / \
+            (-2 * self.arm_a['length'] * self.arm_b['length'])
+        if not (-1 <= cos_a <= 1 and -1 <= cos_b <= 1):
+            return []
+        alpha = math.degrees(math.acos(cos_a))
+        gamma = math.degrees(math.acos(cos_b))
+
+        # Base angles facing the destination and facing away from it, in every turn within range
+        if r1 > 0:
+            heading = math.degrees(math.atan2(y, x))
+        else:
+            heading = self.base_motor.angle if base_reference is None else base_reference
+        bases = []
+        for offset, reach in ((0, r1), (180, -r1)):
+            for turn in (-360, 0, 360):
+                base_angle = heading + offset + turn
+                if self.base_motor.min_angle <= base_angle <= self.base_motor.max_angle:
+                    bases.append((base_angle, reach))
+
+        solutions = []
+        for base_angle, reach in bases:
+            elevation = math.degrees(math.atan2(r2, reach))
+            for arm_a_angle, arm_b_angle in ((elevation + alpha, gamma),
+                                             (elevation - alpha, 360 - gamma)):
+                if all([
+                    self.arm_a_motor.min_angle <= arm_a_angle <= self.arm_a_motor.max_angle,
+                    self.arm_b_motor.min_angle <= arm_b_angle <= self.arm_b_motor.max_angle
+                ]):
+                    picker_angle = 270 - arm_b_angle - arm_a_angle
+                    solutions.append((base_angle, arm_a_angle, arm_b_angle, picker_angle))
+        return solutions
+
+    def coordtoangles(self, x, y, z, reference=None):
         '''
         Inverse kinematics function to calculate the angles that each motor should be in in order
-        for the arm to reach the given coordinates.
+        for the arm to reach the given coordinates. When more than one solution exists, the one
+        selected by ik_selection is returned: 'time' picks the shortest predicted move from the
+        reference angles, 'travel' picks the smallest total joint travel.
         :param x: x coordinate of destination.
         :param y: y coordinate of destination.
         :param z: z coordinate of destination.
+        :param reference: Angles the move starts from. Defaults to the current motor angles.
         :return: Four values corresponding to the base angle, arm a angle, arm b angle, and picker
         angle.
         '''
-        try:
-            # Calculate base angle
-            if abs(x) == 0:
-                base_angle = 90
-            elif abs(y) == 0:
-                base_angle = 180 if x < 0 else 0
-            else:
-                base_angle = math.atan(y / x)
-                base_angle = math.degrees(base_angle)
-                if x < 0:
-                    base_angle += 180
-
-            # Calculate required intermediate values
-            r1 = math.sqrt(x * x + y * y)
-            r2 = z - self.z_center_to_origin
-            r3 = math.sqrt(r1 * r1 + r2 * r2)
-            r32 = r3 * r3
-
-            # Calculate the remaining angles
-            arm_a_angle = math.degrees(
-                math.acos((self.arm_b['length2'] - self.arm_a['length2'] - r32) / 
-                (-2 * self.arm_a['length'] * r3)) + math.atan(r2 / r1)
-            )
-            arm_b_angle = math.degrees(math.acos(
-                (r32 - self.arm_a['length2'] - self.arm_b['length2']) / 
-                (-2 * self.arm_a['length'] * self.arm_b['length'])
-            ))
-            picker_angle = 270 - arm_b_angle - arm_a_angle
-
-            # Validate calculated angles and raise IKError if any angle is found to be out of range
-            if any([
-                base_angle < self.base_motor.min_angle, base_angle > self.base_motor.max_angle,
-                arm_a_angle < self.arm_a_motor.min_angle, arm_a_angle > self.arm_a_motor.max_angle,
-                arm_b_angle < self.arm_b_motor.min_angle, arm_b_angle > self.arm_b_motor.max_angle
-            ]):
-                raise IKError((
-                    'Calculated angles\n'
-                    f'base:\t{base_angle}\n'
-                    f'arm a:\t{arm_a_angle}\n'
-                    f'arm b:\t{arm_b_angle}\n'
-                    f'picker:\t{picker_angle}\n'
-                    'resultant angle out of range'
-                ))
-            return base_angle, arm_a_angle, arm_b_angle, picker_angle
-
-        # Invalid mathematical operations from sin, cos, tan, etc. functions will be caught and
-        # converted to an IKError
-        except ValueError as e:
-            raise IKError(f'IK Error {format_exc()}')
-
-    def moveto(self, x, y, z, time=None):
+        if reference is None:
+            reference = [motor.angle for motor in self.motors]
+        solutions = self.iksolutions(x, y, z, reference[0])
+        if not solutions:
+            raise IKError(f'IK Error\nno solution within range for {x} {y} {z}')
+        if len(solutions) == 1:
+            return solutions[0]
+
+        def travel(solution):
+            return sum(abs(angle - start) for angle, start in zip(solution[:3], reference))
+
+        if self.ik_selection == 'travel':
+            return min(solutions, key=travel)
+        return min(solutions, key=lambda solution: (
+            self.calcmovetime(solution, reference), travel(solution)
+        ))
+
+    def calcmovetime(self, angles, reference=None):
+        '''
+        Calculates the time a move to the given motor angles should take.
+        :param angles: Base, arm a, arm b, and picker angles of the destination.
+        :param reference: Angles the move starts from. Defaults to the current motor angles.
+        :return: Time in milliseconds the move should take.
+        '''
+        if reference is None:
+            reference = [motor.angle for motor in self.motors]
+        return max([
+            motor.calctime(angle - start)
+            for motor, angle, start in zip(self.motors, angles, reference)
+        ])
+
+    def calcmovetimes(self, targets, reference=None):
+        '''
+        Bulk version of calcmovetime for planners which evaluate many moves from one reference.
+        :param targets: Sequence of base, arm a, arm b, and picker angles, or a numpy array with
+        one row per target.
+        :param reference: Angles the moves start from. Defaults to the current motor angles.
+        :return: numpy array of times in milliseconds if numpy is installed, list otherwise.
+        '''
+        if reference is None:
+            reference = [motor.angle for motor in self.motors]
+        if numpy is None:
+            columns = [
+                motor.calctimes([target[i] - reference[i] for target in targets])
+                for i, motor in enumerate(self.motors)
+            ]
+            return [max(times) for times in zip(*columns)]
+        targets = numpy.asarray(targets, dtype=float).reshape(-1, len(self.motors))
+        return numpy.max([
+            motor.calctimes(targets[:, i] - reference[i]) for i, motor in enumerate(self.motors)
+        ], axis=0)
+
+    def moveto(self, x, y, z, time=None, exit_freqs=None):
         '''
         Moves the robot arm to the given coordinates.
         :param x: x coordinate of destination.
         :param y: y coordinate of destination.
         :param z: z coordinate of destination.
         :param time: Time in milliseconds the move should take to complete.
-        :param wait: Flag whether the function should block until movement is complete.
+        :param exit_freqs: Step frequencies the base, arm a, arm b, and picker motors should end the
+        move at. Defaults to coming to a stop at the destination.
         '''
-        base_angle, arm_a_angle, arm_b_angle, picker_angle = self.coordtoangles(x, y, z)
-        if self.verbose:
-            print(
-                f'Moving arm to: {x} {y} {z}\n'
-                f'Angles: {base_angle} {arm_a_angle} {arm_b_angle} {picker_angle}'
-            )
+        self.stagemove(x, y, z, time, exit_freqs)
+        self.startmove()
+        self.waitmove()
+
+    def planmove(self, x, y, z):
+        '''
+        Moves the robot arm to the given coordinates along the shortest time path around the
+        configured obstacles. The roadmap is loaded on the first planned move.
+        :param x: x coordinate of destination.
+        :param y: y coordinate of destination.
+        :param z: z coordinate of destination.
+        :return: List of waypoints moved through.
+        '''
+        if self.planner is None:
+            self.planner = Planner(self)
+        waypoints = self.planner.plan(x, y, z)
+        follow(self, waypoints)
+        self.x, self.y, self.z = x, y, z
+        return waypoints
+
+    def stagemove(self, x, y, z, time=None, exit_freqs=None):
+        '''
+        Queues a move to the given coordinates on the motor controllers without starting it. Takes
+        the same arguments as moveto.
+        '''
+        self.move_started = monotonic()
+        try:
+            angles = self.coordtoangles(x, y, z)
+        except IKError:
+            metrics.IK_FAILURES.inc()
+            self.move_started = None
+            raise
+        log(logger, DEBUG, 'Moving arm', x=x, y=y, z=z, angles=angles)
         self.x, self.y, self.z = x, y, z
+        self.stageangles(angles, time, exit_freqs)
+
+    def stageangles(self, angles, time=None, exit_freqs=None):
+        '''
+        Queues a move to the given motor angles on the motor controllers without starting it.
+        :param angles: Base, arm a, arm b, and picker angles of the destination.
+        :param time: Time in milliseconds the move should take to complete.
+        :param exit_freqs: Step frequencies the motors should end the move at.
+        '''
+        if self.move_started is None:
+            self.move_started = monotonic()
+        if time is None:
+            time = self.calcmovetime(angles)
+        time = round(time, 2)
+        if exit_freqs is None:
+            exit_freqs = (0, 0, 0, 0)
+        for motor, angle, exit_freq in zip(self.motors, angles, exit_freqs):
+            motor.stage(angle, time, exit_freq)
+        status = self.dispatch()
+        log(logger, DEBUG, 'Queued movements', status=status)
+
+    def stagesteps(self, positions, time=None):
+        '''
+        Queues a move to the given motor step positions on the motor controllers without starting
+        it. No inverse kinematics are needed, so this is the fastest way to replay a precomputed
+        trajectory.
+        :param positions: Base, arm a, arm b, and picker positions in steps from their initial
+        angles.
+        :param time: Time in milliseconds the move should take to complete.
+        '''
+        if self.move_started is None:
+            self.move_started = monotonic()
+        steps = [position - motor.stepposition() for motor, position in zip(self.motors, positions)]
         if time is None:
             time = max([
-                    self.base_motor.calctime(base_angle),
-                    self.arm_a_motor.calctime(arm_a_angle),
-                    self.arm_b_motor.calctime(arm_b_angle),
-                    self.picker_motor.calctime(picker_angle)
+                motor.calctime(motor.stepstoangle(motor_steps))
+                for motor, motor_steps in zip(self.motors, steps)
             ])
         time = round(time, 2)
-        base_motor_status = self.base_motor.moveto(base_angle, time)
-        arm_a_motor_status = self.arm_a_motor.moveto(arm_a_angle, time)
-        arm_b_motor_status = self.arm_b_motor.moveto(arm_b_angle, time)
-        picker_motor_status = self.picker_motor.moveto(picker_angle, time)
-        if self.verbose:
-            print(
-                'Queued movements with status code',
-                max([
-                    base_motor_status, 
-                    arm_a_motor_status, 
-                    arm_b_motor_status, 
-                    picker_motor_status
-                    ])
-                )
-        for mc in self.motor_controllers.values():
+        for motor, motor_steps in zip(self.motors, steps):
+            motor.stagesteps(motor_steps, time)
+        status = self.dispatch()
+        self.x, self.y, self.z = self.anglestocoord(*[motor.angle for motor in self.motors[:3]])
+        log(logger, DEBUG, 'Queued movements', status=status)
+
+    def coordstoangles(self, points, reference=None):
+        '''
+        Batch inverse kinematics for a path. Each point is solved with the angles the previous
+        point ends at as the reference, including step quantization, as if the points were moved
+        to one after the other.
+        :param points: Iterable of x, y, z coordinates.
+        :param reference: Angles the path starts from. Defaults to the current motor angles.
+        :return: List of (base angle, arm a angle, arm b angle, picker angle) tuples.
+        '''
+        if reference is None:
+            reference = [motor.angle for motor in self.motors]
+        angles = list(reference)
+        solutions = []
+        for point in points:
+            target = self.coordtoangles(*point, reference=angles)
+            for i, motor in enumerate(self.motors):
+                angles[i] += motor.stepstoangle(motor.angletosteps(target[i] - angles[i]))
+            solutions.append(target)
+        return solutions
+
+    def dispatch(self):
+        '''
+        Sends the staged register writes of every motor controller, one write per controller, and
+        waits for the replies only once every controller has been written to.
+        :return: Highest status code.
+        '''
+        requests = [(mc, mc.sendstaged()) for mc in self.motor_controllers.values()]
+        return max([mc.awaitstaged(mc_requests) for mc, mc_requests in requests])
+
+    def startmove(self):
+        '''
+        Starts the queued move on the motor controllers it involves. A motor controller which is
+        still running the previous move starts the queued move as soon as the previous one
+        completes.
+        '''
+        self.started = [mc for mc in self.motor_controllers.values() if mc.involved]
+        # The moves are recorded before they are started, as a short move may complete before its
+        # acceptance is handled
+        for motor in self.motors:
+            if motor.motor_controller in self.started:
+                motor.startstaged()
+        for mc in self.started:
             mc.moveall()
+        # The firmware completes an accepted move on its own, so the target pose is saved as soon
+        # as the move is accepted, in case the host stops before the move completes
+        for mc in self.started:
+            if mc.awaitaccepted() != 0:
+                for motor in self.motors:
+                    if motor.motor_controller is mc:
+                        motor.rejectstarted()
+        self.savestate()
+
+    def waitmove(self, keep_last=False):
+        '''
+        Waits for every motor controller to complete the move.
+        :param keep_last: Whether to leave the last started move running and only wait for the
+        moves before it, so the next move can be staged and queued while it runs.
+        '''
         for mc in self.motor_controllers.values():
-            mc.wait()
-        if self.verbose:
-            print('Done')
+            mc.wait(1 if keep_last and mc in self.started else 0)
+        if self.move_started is not None:
+            metrics.MOVES.inc()
+            metrics.MOVE_TIME.observe(monotonic() - self.move_started)
+            metrics.MOVE_WINDOW.add()
+            self.move_started = None
+        logger.debug('Done')
+
+    def queuemove(self):
+        '''
+        Starts the staged move behind the running move, so that it starts as soon as the running
+        move completes instead of a round trip to the host later, and waits for the running move
+        to complete. A motor controller which is not running the previous move would start the
+        staged move right away, in which case the previous move is waited for first. The last
+        queued move has to be waited for with waitmove.
+        '''
+        if any(mc.involved and mc not in self.started for mc in self.motor_controllers.values()):
+            self.waitmove()
+        self.startmove()
+        self.waitmove(keep_last=True)
+
+    def planblend(self, points, tolerance, times=None):
+        '''
+        Plans a blended move through the given waypoints. At every intermediate waypoint where the
+        corner between the incoming and outgoing segments is within the tolerance, motors which
+        keep moving in the same direction are given an exit frequency instead of stopping, and the
+        segment times are shortened to match the higher average speed. A waypoint is only blended
+        if the outgoing segment can be queued behind the incoming one, otherwise the motors would
+        stop dead from the exit frequency while the host starts the outgoing segment.
+        :param points: List of x, y, z coordinates to move through.
+        :param tolerance: Largest corner angle in degrees that is blended.
+        :param times: Optional list of times in ms, one per segment, None for the calculated time.
+        Floored at the largest minimum time of the motors the segment moves.
+        :return: List of (point, time, exit frequencies) tuples, one per segment.
+        '''
+        # Predict the steps each segment will take, including the quantization in Motor.moveto
+        angles = [motor.angle for motor in self.motors]
+        given = times if times is not None else [None] * len(points)
+        steps, times, min_times = [], [], []
+        for point, time in zip(points, given):
+            target = self.coordtoangles(*point, reference=angles)
+            segment_steps = []
+            for i, motor in enumerate(self.motors):
+                segment_steps.append(motor.angletosteps(target[i] - angles[i]))
+            min_times.append(max([
+                motor.min_time for motor, s in zip(self.motors, segment_steps) if s != 0
+            ], default=0))
+            if time is None:
+                time = self.calcmovetime(target, angles)
+            times.append(max(time, min_times[-1]))
+            for i, motor in enumerate(self.motors):
+                angles[i] += motor.stepstoangle(segment_steps[i])
+            steps.append(segment_steps)
+
+        # Motor controllers each segment involves, see queuemove
+        involved = [
+            {motor.motor_controller for motor, s in zip(self.motors, segment_steps) if s != 0}
+            for segment_steps in steps
+        ]
+
+        # Exit frequencies at waypoints within the corner tolerance
+        exit_freqs = [[0] * len(self.motors) for _ in points]
+        prev_point = (self.x, self.y, self.z)
+        for k in range(len(points) - 1):
+            corner = cornerangle(prev_point, points[k], points[k + 1])
+            prev_point = points[k]
+            if corner is None or corner > tolerance or not involved[k + 1] <= involved[k]:
+                continue
+            for j in range(len(self.motors)):
+                steps_in, steps_out = steps[k][j], steps[k + 1][j]
+                if steps_in * steps_out > 0:
+                    exit_freqs[k][j] = int(min(
+                        abs(steps_in) / times[k], abs(steps_out) / times[k + 1]
+                    ) * 1000)
+
+        # Shorten each segment so the peak frequency stays the same as an unblended move
+        segments = []
+        for k, point in enumerate(points):
+            time = times[k]
+            entry_freqs = exit_freqs[k - 1] if k > 0 else [0] * len(self.motors)
+            blended_times = [
+                4000 * abs(s) / (f_in + 4000 * abs(s) / time + f_out)
+                for s, f_in, f_out in zip(steps[k], entry_freqs, exit_freqs[k]) if s != 0
+            ]
+            if blended_times:
+                time = min(time, max(max(blended_times), min_times[k]))
+            segments.append((point, time, exit_freqs[k]))
+        return segments
+
+    def movethrough(self, points, tolerance=None, times=None):
+        '''
+        Moves the robot arm through the given waypoints without stopping at waypoints whose corner
+        is within the blend tolerance. The planned segments are validated before any of them is
+        started.
+        :param points: List of x, y, z coordinates to move through.
+        :param tolerance: Corner tolerance in degrees. Defaults to the configured blend tolerance.
+        :param times: Optional list of times in ms, one per segment, see planblend.
+        :raise ValidationError: If any planned segment violates a limit.
+        '''
+        if tolerance is None:
+            tolerance = self.blend_tolerance
+        segments = self.planblend(points, tolerance, times)
+        violations = validatepoints(
+            self, points, [time for _, time, _ in segments], [freqs for _, _, freqs in segments]
+        )
+        if violations:
+            raise ValidationError(violations)
+        for (x, y, z), time, exit_freqs in segments:
+            self.stagemove(x, y, z, time, exit_freqs)
+            self.queuemove()
+        self.waitmove()
+
+    def play(self, checkpoints):
+        '''
+        Executes the given checkpoints in order. Consecutive moves are blended if a blend
+        tolerance is set. The whole program is validated before any motion starts.
+        :param checkpoints: List of (index, command) tuples.
+        '''
+        check(self, [cp for _, cp in checkpoints])
+        run = []
+        for index, cp in checkpoints:
+            print(f'{index} {cp}')
+            if self.blend_tolerance > 0 and cp.type in ('move', 'm') and len(cp.args) == 3:
+                run.append(cp)
+                continue
+            if run:
+                self.movethrough([tuple(map(int, move.args)) for move in run])
+                self.prev_command = run[-1]
+                run = []
+            self.execute(cp)
+        if run:
+            self.movethrough([tuple(map(int, move.args)) for move in run])
+            self.prev_command = run[-1]
 
     def execute(self, command):
+        '''
+        Executes a command.
+        :param command: Command to be executed.
+        :return: Result of the command, e.g. a status code or coordinate value, or None.
+        '''
+        result = None
         if command.type == 'status':
-            print('Robot arm status:', self.getstatus())
-            return
+            result = self.getstatus()
+            print('Robot arm status:', result)
+            return result
         elif command.type == 'restart':
             print('Restarting robot arm')
-            print('Robot arm status:', self.restart())
-            return
+            result = self.restart()
+            print('Robot arm status:', result)
+            return result
         elif command.type in ('x', 'y', 'z'):
             if command.args:
                 self.setcoord(command.type, int(command.args[0]))
-            else:
-                print(getattr(self, command.type))
-            return
+                return
+            result = getattr(self, command.type)
+            print(result)
+            return result
         elif command.type in ('move', 'm'):
-            x, y, z = map(int, command.args)
-            self.moveto(x, y, z)  # blocking function
+            x, y, z = map(int, command.args[:3])
+            time = float(command.args[3]) if len(command.args) > 3 else None
+            self.moveto(x, y, z, time)  # blocking function
+        elif command.type == 'plan':
+            x, y, z = map(int, command.args[:3])
+            result = self.planmove(x, y, z)
         elif command.type in ('enable', 'e'):
-            self.enable(command.args[0])
+            result = self.enable(command.args[0])
         elif command.type in ('disable', 'd'):
-            self.disable(command.args[0])
+            result = self.disable(command.args[0])
         elif command.type in ('pin', 'p'):
-            self.setpin(command.args[0], command.args[1], command.args[2])
+            result = self.setpin(command.args[0], command.args[1], command.args[2])
         elif command.type in ('checkpoint', 'cp'):
             if len(command.args) > 0:
                 if command.args[0] == 'rm':
                     self.checkpoints.pop(int(command.args[1]))
                 elif command.args[0] == 'mv':
                     self.checkpoints[int(command.args[2])] = self.checkpoints.pop(int(command.args[1]))
+                elif command.args[0] == 'check':
+                    violations = validate(self, [cp for _, cp in sorted(self.checkpoints.items())])
+                    for violation in violations:
+                        print(violation)
+                    print(f'{len(violations)} violations found')
+                    return [str(violation) for violation in violations]
                 elif command.args[0] == 'play':
                     print('Executing checkpoints:')
-                    for index, cp in sorted(self.checkpoints.items()):
-                        print(f'{index} {cp}')
-                        self.execute(cp)
+                    self.play(sorted(self.checkpoints.items()))
                 else:
                     cp_num = int(command.args[0])
                     print(f'Setting checkpoint {cp_num} to prev command: {self.prev_command}')
@@ -327,15 +810,26 @@ class RobotArm:
                 print('Checkpoints:')
                 for index, cp in self.checkpoints.items():
                     print(index, cp)
+            self.savestate()
             return
+        elif command.type in ('blend', 'b'):
+            if command.args:
+                self.blend_tolerance = float(command.args[0])
+                return
+            print(self.blend_tolerance)
+            return self.blend_tolerance
         elif command.type in ('wait', 'w'):
-            sleep(float(command.args[0]))
+            self.sleep(float(command.args[0]))
+        elif command.type == 'jog':
+            interactive(self, *map(float, command.args[:2]))
+            return
         elif command.type in ('q', 'quit'):
             self.terminate()
             raise StopIteration
         else:
             print('Unknown command')
         self.prev_command = command
+        return result
 
     class Command:
         def __init__(self, type, args):
@@ -346,8 +840,26 @@ class RobotArm:
             return f'{self.type} {self.args}'
         
         @staticmethod
-        def getcommand():
-            raw = input('> ').casefold().split(' ')
+        def parse(line):
+            raw = line.strip().casefold().split(' ')
             if len(raw) >= 2:
                 return RobotArm.Command(raw[0], raw[1:])
             return RobotArm.Command(raw[0], [])
+
+        @staticmethod
+        def getcommand():
+            return RobotArm.Command.parse(input('> '))
+
+        @staticmethod
+        def loadprogram(path):
+            '''
+            Loads a program of commands, one per line. Blank lines and lines starting with # are
+            skipped.
+            :param path: Path to the program file.
+            :return: List of commands.
+            '''
+            with open(path) as program_file:
+                return [
+                    RobotArm.Command.parse(line) for line in program_file
+                    if line.strip() and not line.lstrip().startswith('#')
+                ]
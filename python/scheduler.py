@@ -0,0 +1,288 @@
+'''
+Priority job scheduler in front of RobotArm.execute. Jobs are ordered by priority class, then by
+deadline, then by submission order. Programs are executed one command (segment) at a time so that a
+more urgent job can run in between, and runs of small queued moves are merged into a single move.
+'''
+import heapq
+import itertools
+import math
+import threading
+from queue import Full
+from time import monotonic
+
+
+URGENT = 0
+NORMAL = 1
+BULK = 2
+PRIORITIES = {'urgent': URGENT, 'normal': NORMAL, 'bulk': BULK}
+
+
+def checkargs(command):
+    '''
+    Checks the arguments of a move command, which are only parsed once it is executed.
+    :raise ValueError: If the coordinates are not integers or the time is not a number.
+    '''
+    if command.type not in ('move', 'm'):
+        return
+    if len(command.args) not in (3, 4):
+        raise ValueError(f'{command.type} takes x, y, z and an optional time')
+    try:
+        [int(arg) for arg in command.args[:3]]
+        [float(arg) for arg in command.args[3:]]
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid {command.type} arguments: {" ".join(command.args)}') from None
+
+
+class Job:
+    def __init__(self, commands, priority, deadline, sequence):
+        '''
+        :param commands: List of commands executed in order.
+        :param priority: One of URGENT, NORMAL, or BULK.
+        :param deadline: Monotonic time the job should be started by, or None.
+        '''
+        self.commands = commands
+        self.priority = priority
+        self.deadline = deadline
+        self.sequence = sequence
+        self.position = 0  # index of the next command to execute
+        self.submitted = monotonic()
+        self.started = None
+        self.finished = None
+        self.results = []
+        self.error = None
+        self.coalesced = False
+        self.callbacks = []
+        self.lock = threading.Lock()  # orders adding callbacks against finishing
+        self.done = threading.Event()
+
+    def key(self):
+        return (self.priority, self.deadline if self.deadline is not None else math.inf,
+                self.sequence)
+
+    def __lt__(self, other):
+        return self.key() < other.key()
+
+    def ismove(self):
+        '''
+        :return: Whether the job is a single move without an explicit time.
+        '''
+        if len(self.commands) != 1 or self.commands[0].type not in ('move', 'm') or \
+                len(self.commands[0].args) != 3:
+            return False
+        try:
+            checkargs(self.commands[0])
+        except ValueError:
+            return False
+        return True
+
+    def target(self):
+        return tuple(map(int, self.commands[0].args))
+
+    def add_done_callback(self, callback):
+        '''
+        Adds a function to be called with the job once it finishes. Called immediately if the job
+        has already finished.
+        '''
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the job to finish.
+        :return: List of results, one per command.
+        '''
+        if not self.done.wait(timeout):
+            raise TimeoutError('Job did not finish in time')
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def _finish(self, error=None):
+        with self.lock:
+            self.error = error
+            self.finished = monotonic()
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Scheduler:
+    def __init__(self, robot_arm, max_depth=256, coalesce_distance=5):
+        '''
+        :param robot_arm: Robot arm the jobs are executed on.
+        :param max_depth: Maximum number of queued jobs.
+        :param coalesce_distance: Queued moves whose target is within this distance in mm of the
+        previous move's target are merged into it.
+        '''
+        self.robot_arm = robot_arm
+        self.max_depth = max_depth
+        self.coalesce_distance = coalesce_distance
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.current = None
+        self.running = False
+        self.thread = None
+
+        # Metrics
+        self.executed = 0
+        self.coalesced = 0
+        self.preemptions = 0
+        self.missed_deadlines = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def start(self):
+        '''
+        Starts executing jobs on a worker thread.
+        '''
+        self.running = True
+        self.thread = threading.Thread(target=self._work, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stops the worker thread once the current segment completes. Queued jobs are kept.
+        '''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, commands, priority=NORMAL, deadline=None, block=True, timeout=None):
+        '''
+        Queues a command or a program of commands.
+        :param commands: Command or list of commands.
+        :param priority: One of URGENT, NORMAL, or BULK, or their names.
+        :param deadline: Seconds from now the job should be started within, or None.
+        :param block: Whether to wait for room in the queue if it is full.
+        :param timeout: Maximum time in seconds to wait for room in the queue.
+        :return: The queued job.
+        '''
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        priority = PRIORITIES.get(priority, priority)
+        if isinstance(priority, bool) or priority not in (URGENT, NORMAL, BULK):
+            raise ValueError('priority must be one of: urgent, normal, bulk')
+        if deadline is not None and (isinstance(deadline, bool) or
+                                     not isinstance(deadline, (int, float))):
+            raise ValueError('deadline must be a number of seconds')
+        for command in commands:
+            checkargs(command)
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: len(self.heap) < self.max_depth, timeout if block else 0
+            ):
+                raise Full('Scheduler queue is full')
+            job = Job(
+                list(commands), priority,
+                monotonic() + deadline if deadline is not None else None, next(self.sequence)
+            )
+            heapq.heappush(self.heap, job)
+            self.condition.notify_all()
+        return job
+
+    def metrics(self):
+        '''
+        :return: Dictionary of queue depth, per class depth, wait time, and throughput metrics.
+        '''
+        with self.condition:
+            depth = {name: 0 for name in PRIORITIES}
+            names = {value: name for name, value in PRIORITIES.items()}
+            for job in self.heap:
+                depth[names[job.priority]] += 1
+            started = self.executed + self.coalesced
+            return {
+                'depth': len(self.heap),
+                'depth_by_priority': depth,
+                'busy': self.current is not None,
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'preemptions': self.preemptions,
+                'missed_deadlines': self.missed_deadlines,
+                'mean_wait_ms': self.total_wait / started * 1000 if started else 0,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.heap or not self.running)
+                if not self.running:
+                    return
+                job = heapq.heappop(self.heap)
+                merged = self._coalesce(job) if job.position == 0 and job.ismove() else []
+                self.current = job
+                self.condition.notify_all()
+            for started in [job] + merged:
+                self._started(started)
+            try:
+                self._segment(job, merged)
+            except Exception as e:
+                # A job which breaks the scheduler fails on its own instead of stopping the worker
+                with self.condition:
+                    self.current = None
+                for failed in [job] + merged:
+                    if not failed.done.is_set():
+                        failed._finish(e)
+
+    def _coalesce(self, job):
+        '''
+        Takes the queued moves that directly follow the job in the queue and are within the
+        coalesce distance of each other.
+        :return: List of jobs merged into the job, the job now moves to the last target.
+        '''
+        merged = []
+        target = job.target()
+        while self.heap and self.heap[0].ismove() and self.heap[0].priority == job.priority:
+            following = self.heap[0]
+            if math.dist(target, following.target()) > self.coalesce_distance:
+                break
+            heapq.heappop(self.heap)
+            merged.append(following)
+            target = following.target()
+        if merged:
+            job.commands = [merged[-1].commands[0]]
+        return merged
+
+    def _started(self, job):
+        if job.started is not None:
+            return
+        job.started = monotonic()
+        wait = job.started - job.submitted
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if job.deadline is not None and job.started > job.deadline:
+            self.missed_deadlines += 1
+
+    def _segment(self, job, merged):
+        '''
+        Executes the next command of the job, then either finishes the job or puts it back in the
+        queue so that a more urgent job can run before its next segment.
+        '''
+        try:
+            result = self.robot_arm.execute(job.commands[job.position])
+            error = None
+        except Exception as e:
+            result, error = None, e
+        job.results.append(result)
+        job.position += 1
+        with self.condition:
+            self.current = None
+            if error is None and job.position < len(job.commands):
+                if self.heap and self.heap[0] < job:
+                    self.preemptions += 1
+                heapq.heappush(self.heap, job)
+                return
+            self.executed += 1
+            self.coalesced += len(merged)
+        job._finish(error)
+        for following in merged:
+            following.coalesced = True
+            following.results.append(result)
+            following._finish(error)
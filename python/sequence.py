@@ -0,0 +1,224 @@
+'''
+Visiting order optimization for batches of pick and place targets. Targets are ordered to minimize
+the total move time predicted by the robot arm's joint space timing model.
+'''
+import heapq
+
+
+def costmatrix(robot_arm, angles):
+    '''
+    Builds the matrix of predicted move times between every pair of joint configurations.
+    :param robot_arm: Robot arm whose timing model is used.
+    :param angles: List of base, arm a, arm b, and picker angle tuples.
+    :return: Square list of lists where [i][j] is the time in ms to move from angles i to angles j.
+    '''
+    n = len(angles)
+    costs = [[0.0] * n for _ in range(n)]
+    for i in range(n - 1):
+        row = costs[i]
+        # The timing model only depends on the absolute number of steps, so it is symmetric
+        for j, time in enumerate(robot_arm.calcmovetimes(angles[i + 1:], angles[i]), i + 1):
+            row[j] = costs[j][i] = float(time)
+    return costs
+
+
+def tourcost(costs, tour):
+    '''
+    :return: Total time of visiting the nodes of the tour in order.
+    '''
+    return sum(costs[a][b] for a, b in zip(tour, tour[1:]))
+
+
+def optimizesequence(robot_arm, targets, precedence=(), passes=20, neighbours=8):
+    '''
+    Finds a visiting order of the targets which minimizes the total predicted move time, starting
+    from the current position of the arm. A nearest neighbour tour is built first, then improved
+    with 2-opt and or-opt moves restricted to each target's nearest neighbours so that the
+    improvement passes scale to thousands of targets.
+    :param robot_arm: Robot arm whose kinematics and timing model are used.
+    :param targets: List of x, y, z coordinates.
+    :param precedence: List of (before, after) target index pairs, e.g. a pick before its place.
+    :param passes: Maximum number of improvement passes.
+    :param neighbours: Number of nearest neighbours considered per target during improvement.
+    :return: List of target indices in visiting order and the total predicted time in ms.
+    '''
+    # Node 0 is the current position of the arm, target i is node i + 1
+    angles = [tuple(motor.angle for motor in robot_arm.motors)]
+    angles += [robot_arm.coordtoangles(*target) for target in targets]
+    costs = costmatrix(robot_arm, angles)
+    n = len(angles)
+    preds = [set() for _ in range(n)]
+    succs = [set() for _ in range(n)]
+    for before, after in precedence:
+        preds[after + 1].add(before + 1)
+        succs[before + 1].add(after + 1)
+
+    tour = _nearestneighbour(costs, preds, succs)
+    if not precedence:
+        preds = succs = None
+    # Partial selection, the node itself is usually among the nearest and is dropped
+    near = [
+        [j for j in heapq.nsmallest(neighbours + 1, range(n), key=costs[i].__getitem__)
+         if j != i][:neighbours]
+        for i in range(n)
+    ]
+    for _ in range(passes):
+        improved = _twoopt(tour, costs, near, succs)
+        improved = _oropt(tour, costs, near, preds, succs) or improved
+        if not improved:
+            break
+    return [node - 1 for node in tour[1:]], tourcost(costs, tour)
+
+
+def optimizepickplace(robot_arm, pairs, **kwargs):
+    '''
+    Orders a batch of pick and place pairs, allowing picks and places of different pairs to be
+    interleaved as long as every place comes after its pick.
+    :param robot_arm: Robot arm whose kinematics and timing model are used.
+    :param pairs: List of (pick, place) coordinate pairs.
+    :return: List of ('pick' or 'place', pair index) tuples in visiting order and the total
+    predicted time in ms.
+    '''
+    targets = [pick for pick, _ in pairs] + [place for _, place in pairs]
+    precedence = [(i, i + len(pairs)) for i in range(len(pairs))]
+    order, time = optimizesequence(robot_arm, targets, precedence, **kwargs)
+    return [
+        ('pick', i) if i < len(pairs) else ('place', i - len(pairs)) for i in order
+    ], time
+
+
+def _nearestneighbour(costs, preds, succs):
+    '''
+    Builds a tour from node 0 by repeatedly visiting the closest node whose predecessors have all
+    been visited.
+    '''
+    n = len(costs)
+    visited = [False] * n
+    visited[0] = True
+    waiting = [len(p) for p in preds]
+    tour = [0]
+    for _ in range(n - 1):
+        row = costs[tour[-1]]
+        best = None
+        for j in range(1, n):
+            if not visited[j] and waiting[j] == 0 and (best is None or row[j] < row[best]):
+                best = j
+        if best is None:
+            raise ValueError('Precedence constraints contain a cycle')
+        visited[best] = True
+        tour.append(best)
+        for s in succs[best]:
+            waiting[s] -= 1
+    return tour
+
+
+def _positions(tour):
+    '''
+    :return: List of the position of every node in the tour, indexed by node.
+    '''
+    position = [0] * len(tour)
+    for i, node in enumerate(tour):
+        position[node] = i
+    return position
+
+
+def _twoopt(tour, costs, near, succs):
+    '''
+    Reverses sections of the open tour where doing so reduces its cost. Node 0 stays fixed.
+    :param succs: Successor sets of each node, or None if there are no precedence constraints.
+    :return: Whether the tour was improved.
+    '''
+    improved = False
+    position = _positions(tour)
+    last = len(tour) - 1
+    for i in range(1, len(tour)):
+        a, b = tour[i - 1], tour[i]
+        for c in near[a]:
+            j = position[c]
+            if j <= i:
+                continue
+            d = tour[j + 1] if j < last else None
+            delta = costs[a][c] - costs[a][b]
+            if d is not None:
+                delta += costs[b][d] - costs[c][d]
+            if delta >= -1e-9:
+                continue
+            # Reversing the section only changes the order of the nodes within it
+            if succs is not None and any(
+                i <= position[b] <= j for k in range(i, j + 1) for b in succs[tour[k]]
+            ):
+                continue
+            tour[i:j + 1] = tour[i:j + 1][::-1]
+            for k in range(i, j + 1):
+                position[tour[k]] = k
+            improved = True
+            break
+    return improved
+
+
+def _oropt(tour, costs, near, preds, succs, max_length=3):
+    '''
+    Moves short sections of the tour next to one of their neighbours where doing so reduces its
+    cost. Node 0 stays fixed.
+    :param preds: Predecessor sets of each node, or None if there are no precedence constraints.
+    :param succs: Successor sets of each node, or None if there are no precedence constraints.
+    :return: Whether the tour was improved.
+    '''
+    improved = False
+    position = _positions(tour)
+    n = len(tour)
+    for length in range(1, max_length + 1):
+        i = 1
+        while i + length <= n:
+            segment = tour[i:i + length]
+            prev = tour[i - 1]
+            nxt = tour[i + length] if i + length < n else None
+            removed = costs[prev][segment[0]]
+            if nxt is not None:
+                removed += costs[segment[-1]][nxt] - costs[prev][nxt]
+            best, best_delta = None, -1e-9
+            for c in near[segment[0]]:
+                p = position[c]
+                if i <= p < i + length:
+                    continue
+                # Node following c once the segment is taken out of the tour
+                q = p + 1 if p + 1 != i else i + length
+                after = tour[q] if q < n else None
+                added = costs[c][segment[0]]
+                if after is not None:
+                    added += costs[segment[-1]][after] - costs[c][after]
+                if added - removed < best_delta:
+                    if succs is None or _movable(position, preds, succs, segment, i, p):
+                        best, best_delta = p, added - removed
+            if best is not None:
+                _relocate(tour, position, i, length, best)
+                improved = True
+            i += 1
+    return improved
+
+
+def _movable(position, preds, succs, segment, i, p):
+    '''
+    :return: Whether moving the segment at position i to after position p keeps every node of the
+    segment after its predecessors and before its successors. Only the order of the segment and
+    the nodes it is moved past changes.
+    '''
+    if p < i:
+        return not any(p < position[q] < i for s in segment for q in preds[s])
+    return not any(i + len(segment) <= position[r] <= p for s in segment for r in succs[s])
+
+
+def _relocate(tour, position, i, length, p):
+    '''
+    Moves the segment of the given length at position i to after position p, updating the
+    positions of the nodes in between.
+    '''
+    segment = tour[i:i + length]
+    if p < i:
+        tour[p + 1:i + length] = segment + tour[p + 1:i]
+        start, end = p + 1, i + length
+    else:
+        tour[i:p + 1] = tour[i + length:p + 1] + segment
+        start, end = i, p + 1
+    for k in range(start, end):
+        position[tour[k]] = k
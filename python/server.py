@@ -0,0 +1,210 @@
+'''
+Job server which owns a RobotArm and accepts commands from many clients over TCP or a Unix socket.
+
+Each request is one line, either a command in the same format as the interactive prompt, e.g.
+"move 300 100 200", or a JSON object such as {"id": 1, "command": "move", "args": [300, 100, 200],
+"priority": "urgent"}. Every request gets one JSON line in reply with its id, status, result and
+the time in ms it spent queued and running. Status queries are answered straight from the cached state of
+the arm without touching the serial ports, all other commands are queued on a Scheduler and
+executed one at a time on its worker thread.
+
+A more urgent job only runs between the commands of a queued program. "cp play" is a single
+command, the whole checkpoint program runs before any other job, so it is validated and blended as
+a whole. Submit the checkpoints as a program of commands instead to let urgent jobs in between.
+"jog" takes over the terminal the server runs in until jog mode is left.
+
+Usage: python -m python.server <config path> [--host HOST] [--port PORT] [--unix PATH]
+'''
+import argparse
+import asyncio
+import json
+from queue import Full
+from python.robotarm import RobotArm
+from python.scheduler import NORMAL, PRIORITIES, Scheduler
+
+
+QUERY_VERBS = ('status', 'pose', 'queue')
+COMMAND_VERBS = (
+    'move', 'm', 'x', 'y', 'z', 'enable', 'e', 'disable', 'd', 'pin', 'p', 'checkpoint', 'cp',
+    'blend', 'b', 'wait', 'w', 'restart', 'getstatus', 'plan', 'jog'
+)
+
+
+class JobServer:
+    def __init__(self, robot_arm, max_depth=256, coalesce_distance=5):
+        '''
+        :param robot_arm: Robot arm the jobs are executed on.
+        :param max_depth: Maximum number of queued jobs, further jobs are rejected.
+        :param coalesce_distance: Distance in mm within which consecutive queued moves are merged.
+        '''
+        self.robot_arm = robot_arm
+        self.scheduler = Scheduler(robot_arm, max_depth, coalesce_distance)
+        self.controller_status = None
+        self.servers = []
+
+    async def start(self, host=None, port=None, path=None):
+        '''
+        Starts listening on the given TCP address and/or Unix socket path.
+        '''
+        self.scheduler.start()
+        if port is not None:
+            self.servers.append(await asyncio.start_server(self._serve, host, port))
+        if path is not None:
+            self.servers.append(await asyncio.start_unix_server(self._serve, path))
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        await asyncio.get_event_loop().run_in_executor(None, self.scheduler.stop)
+
+    async def _serve(self, reader, writer):
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                # Replies are written as jobs complete, so a client can have many jobs in flight
+                task = asyncio.ensure_future(self._handle(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, line, writer):
+        reply = await self.submit(line)
+        writer.write(json.dumps(reply).encode() + b'\n')
+        await writer.drain()
+
+    async def submit(self, line):
+        '''
+        Handles one request line. JSON requests may give a list of commands under "commands"
+        instead of a single command to queue a program, a "priority" of urgent, normal, or bulk,
+        and a "deadline" in seconds.
+        :return: Reply dictionary.
+        '''
+        request_id = None
+        try:
+            request = json.loads(line) if line.lstrip().startswith(b'{') else None
+            if request is not None:
+                request_id = request.get('id')
+                if 'commands' in request:
+                    commands = [RobotArm.Command.parse(str(c)) for c in request['commands']]
+                else:
+                    commands = [RobotArm.Command(
+                        str(request['command']).casefold(),
+                        [str(arg) for arg in request.get('args', [])]
+                    )]
+                priority = request.get('priority', NORMAL)
+                if isinstance(priority, str):
+                    priority = PRIORITIES.get(priority.casefold(), priority)
+                if isinstance(priority, bool) or priority not in PRIORITIES.values():
+                    raise ValueError(f'priority must be one of: {", ".join(PRIORITIES)}')
+                deadline = request.get('deadline')
+                if deadline is not None and (isinstance(deadline, bool) or
+                                             not isinstance(deadline, (int, float))):
+                    raise ValueError('deadline must be a number of seconds')
+            else:
+                commands = [RobotArm.Command.parse(line.decode())]
+                priority, deadline = NORMAL, None
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+            return {'id': request_id, 'status': 'error', 'error': f'invalid request: {e}'}
+
+        if len(commands) == 1 and commands[0].type in QUERY_VERBS:
+            return {'id': request_id, 'status': 'ok', 'result': self.query(commands[0].type)}
+        unknown = [command.type for command in commands if command.type not in COMMAND_VERBS]
+        if unknown:
+            return {'id': request_id, 'status': 'error', 'error': f'unknown command {unknown[0]}'}
+        commands = [
+            RobotArm.Command('status', []) if command.type == 'getstatus' else command
+            for command in commands
+        ]
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        try:
+            job = self.scheduler.submit(commands, priority, deadline, block=False)
+        except (Full, ValueError) as e:
+            return {'id': request_id, 'status': 'error', 'error': str(e)}
+        job.add_done_callback(lambda job: loop.call_soon_threadsafe(_resolve, future, job))
+        await future
+        if job.error is not None:
+            reply = {'id': request_id, 'status': 'error',
+                     'error': f'{type(job.error).__name__}: {job.error}'}
+        else:
+            result = job.results if len(job.results) > 1 else job.results[0]
+            if commands[0].type == 'status' and len(commands) == 1:
+                self.controller_status = result
+            reply = {'id': request_id, 'status': 'ok', 'result': result}
+        reply['coalesced'] = job.coalesced
+        reply['queued_ms'] = round((job.started - job.submitted) * 1000, 3)
+        reply['run_ms'] = round((job.finished - job.started) * 1000, 3)
+        return reply
+
+    def query(self, verb):
+        '''
+        Answers a status query from the cached state of the robot arm.
+        '''
+        arm = self.robot_arm
+        metrics = self.scheduler.metrics()
+        if verb == 'queue':
+            return metrics
+        pose = {
+            'x': arm.x, 'y': arm.y, 'z': arm.z,
+            'angles': {motor.name: motor.angle for motor in arm.motors}
+        }
+        if arm.telemetry is not None:
+            pose['live'] = arm.telemetry.pose._asdict()
+        if verb == 'pose':
+            return pose
+        current = self.scheduler.current
+        return {
+            'pose': pose,
+            'controllers': self.controller_status,
+            'busy': metrics['busy'],
+            'current': str(current.commands[min(current.position, len(current.commands) - 1)])
+            if current is not None else None,
+            'depth': metrics['depth']
+        }
+
+
+def _resolve(future, job):
+    if not future.done():
+        future.set_result(job)
+
+
+async def serve(robot_arm, host='127.0.0.1', port=8765, path=None):
+    '''
+    Runs a job server for the robot arm until cancelled.
+    '''
+    server = JobServer(robot_arm)
+    await server.start(host, port, path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Robot arm job server')
+    parser.add_argument('config')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None)
+    args = parser.parse_args()
+    robot_arm = RobotArm(args.config)
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            serve(robot_arm, args.host, args.port, args.unix)
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        robot_arm.terminate()
@@ -0,0 +1,59 @@
+'''
+Live position feed built from the telemetry frames the motor controllers send during movement.
+'''
+from collections import namedtuple
+from time import monotonic
+
+
+Pose = namedtuple('Pose', ['time', 'base', 'arm_a', 'arm_b', 'picker', 'x', 'y', 'z'])
+
+
+class Telemetry:
+    def __init__(self, robot_arm, interval):
+        '''
+        Enables telemetry on every motor controller of the robot arm and decodes the frames into
+        joint and cartesian poses.
+        :param robot_arm: Robot arm whose motor controllers are to be tracked.
+        :param interval: Interval in milliseconds between telemetry frames.
+        '''
+        self.robot_arm = robot_arm
+        self.interval = interval
+        self.subscribers = []
+        self.angles = {motor.name: motor.angle for motor in robot_arm.motors}
+        self.pose = self._pose()
+        self.channels = {
+            (motor.motor_controller.name, motor.controller_channel): motor
+            for motor in robot_arm.motors
+        }
+        for mc in robot_arm.motor_controllers.values():
+            mc.subscribe(self._update)
+            mc.settelemetry(interval)
+
+    def subscribe(self, callback):
+        '''
+        Subscribes to the pose feed.
+        :param callback: Function called with a Pose every time a telemetry frame is decoded.
+        '''
+        self.subscribers.append(callback)
+
+    def seed(self):
+        '''
+        Takes the current angles of the motors as the pose, e.g. after they were restored from the
+        saved state.
+        '''
+        self.angles = {motor.name: motor.angle for motor in self.robot_arm.motors}
+        self.pose = self._pose()
+
+    def _update(self, motor_controller, channels):
+        for channel, (counter, target, time_slice) in enumerate(channels):
+            motor = self.channels.get((motor_controller.name, channel))
+            if motor is not None:
+                self.angles[motor.name] = motor.progressangle(counter, target)
+        self.pose = self._pose()
+        for callback in self.subscribers:
+            callback(self.pose)
+
+    def _pose(self):
+        base, arm_a, arm_b, picker = [self.angles[motor.name] for motor in self.robot_arm.motors]
+        x, y, z = self.robot_arm.anglestocoord(base, arm_a, arm_b)
+        return Pose(monotonic(), base, arm_a, arm_b, picker, x, y, z)
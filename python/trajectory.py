@@ -0,0 +1,229 @@
+'''
+Binary trajectory files for toolpaths too large to hold as commands. A trajectory file is a HEADER
+followed by fixed size records, so it can be memory mapped and read in chunks of any size without
+loading or parsing the whole file.
+
+Every record holds the x, y, z coordinates, the time in ms of the move to the point (0 to calculate
+it) and flags. Trajectories precomputed for a robot arm also hold the step positions of the base,
+arm a, arm b, and picker motors, counted from their initial angles, so they can be played without
+any inverse kinematics.
+
+Usage:
+    python -m python.trajectory info <trajectory path>
+    python -m python.trajectory precompute <config path> <trajectory path> <output path>
+    python -m python.trajectory play <config path> <trajectory path>
+'''
+import mmap
+import struct
+import sys
+from python.exception import ValidationError
+from python.robotarm import RobotArm
+from python.validation import validatepoints
+
+
+MAGIC = b'PRAT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')  # magic, version, file flags, record count
+POINT = struct.Struct('<ffffI')  # x, y, z, time, flags
+STEPS = struct.Struct('<ffffIiiii')  # point followed by step positions
+
+# File flags
+HAS_STEPS = 0x1
+
+# Record flags
+SKIP = 0x1  # point is ignored, allows removing points in place
+
+
+class TrajectoryWriter:
+    '''
+    Writes a trajectory file one record at a time.
+    '''
+    def __init__(self, path, steps=False):
+        '''
+        :param path: Path of the trajectory file.
+        :param steps: Whether the records hold step positions.
+        '''
+        self.record = STEPS if steps else POINT
+        self.flags = HAS_STEPS if steps else 0
+        self.count = 0
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.flags, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, x, y, z, time=0, flags=0, steps=None):
+        '''
+        Appends a point to the trajectory.
+        :param time: Time in ms of the move to the point, 0 to calculate it.
+        :param flags: Record flags.
+        :param steps: Step positions of the motors, required if the file holds steps.
+        '''
+        if self.flags & HAS_STEPS:
+            self.file.write(self.record.pack(x, y, z, time, flags, *steps))
+        else:
+            self.file.write(self.record.pack(x, y, z, time, flags))
+        self.count += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.flags, self.count))
+        self.file.close()
+
+
+class Trajectory:
+    '''
+    Memory mapped trajectory file. Records are only read from the file when they are accessed.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a version {VERSION} trajectory file')
+        self.record = STEPS if self.flags & HAS_STEPS else POINT
+        if HEADER.size + self.count * self.record.size > len(self.map):
+            self.close()
+            raise ValueError(f'{path} is truncated')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError('trajectory index out of range')
+        return self.record.unpack_from(self.map, HEADER.size + index * self.record.size)
+
+    @property
+    def hassteps(self):
+        return bool(self.flags & HAS_STEPS)
+
+    def chunks(self, size=4096, start=0):
+        '''
+        Reads the records in chunks.
+        :param size: Number of records per chunk.
+        :param start: Index of the first record.
+        :return: Generator of lists of record tuples.
+        '''
+        view = memoryview(self.map)
+        try:
+            for first in range(start, self.count, size):
+                begin = HEADER.size + first * self.record.size
+                end = HEADER.size + min(first + size, self.count) * self.record.size
+                yield list(self.record.iter_unpack(view[begin:end]))
+        finally:
+            view.release()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def precompute(robot_arm, trajectory, path, chunk_size=4096):
+    '''
+    Writes a copy of the trajectory with the step positions the robot arm moves through, starting
+    from its current angles. Times of 0 are replaced with the calculated move times.
+    :param robot_arm: Robot arm whose kinematics are used.
+    :param trajectory: Trajectory to precompute.
+    :param path: Path of the precomputed trajectory file.
+    :raise ValidationError: If a point violates a limit, the file then ends before the chunk of
+    the point.
+    '''
+    motors = robot_arm.motors
+    angles = [motor.angle for motor in motors]
+    positions = [motor.stepposition() for motor in motors]
+    checked = 0
+    with TrajectoryWriter(path, steps=True) as writer:
+        for chunk in trajectory.chunks(chunk_size):
+            points = [record for record in chunk if not record[4] & SKIP]
+            _validate(robot_arm, points, checked, angles)
+            checked += len(points)
+            targets = robot_arm.coordstoangles([point[:3] for point in points], angles)
+            for point, target in zip(points, targets):
+                time = point[3] or robot_arm.calcmovetime(target, angles)
+                for i, motor in enumerate(motors):
+                    steps = motor.angletosteps(target[i] - angles[i])
+                    angles[i] += motor.stepstoangle(steps)
+                    positions[i] += steps
+                writer.write(*point[:3], time, point[4], positions)
+
+
+def _validate(robot_arm, points, offset, angles=None):
+    '''
+    Validates a chunk of points and raises a ValidationError holding every violation if any is
+    found. Violations are indexed from the start of the trajectory.
+    :param offset: Number of points before the chunk.
+    :param angles: Motor angles the chunk starts from. Defaults to the current motor angles.
+    '''
+    violations = validatepoints(
+        robot_arm, [point[:3] for point in points], [point[3] or None for point in points], None,
+        angles
+    )
+    if violations:
+        raise ValidationError([
+            violation._replace(index=violation.index + offset) for violation in violations
+        ])
+
+
+def play(robot_arm, trajectory, chunk_size=4096):
+    '''
+    Moves the robot arm through the trajectory. Each chunk of records is validated and solved
+    with batch inverse kinematics, or not at all if the trajectory holds step positions, which
+    were validated when it was precomputed, then sent point by point.
+    :param robot_arm: Robot arm to move.
+    :param trajectory: Trajectory to play.
+    :param chunk_size: Number of records read and solved at a time.
+    :return: Number of points moved to.
+    :raise ValidationError: If a point of the chunk about to be sent violates a limit.
+    '''
+    moved = 0
+    for chunk in trajectory.chunks(chunk_size):
+        points = [record for record in chunk if not record[4] & SKIP]
+        if trajectory.hassteps:
+            for point in points:
+                robot_arm.stagesteps(point[5:], point[3] or None)
+                robot_arm.queuemove()
+        else:
+            _validate(robot_arm, points, moved)
+            targets = robot_arm.coordstoangles([point[:3] for point in points])
+            for point, target in zip(points, targets):
+                robot_arm.stageangles(target, point[3] or None)
+                robot_arm.x, robot_arm.y, robot_arm.z = point[:3]
+                robot_arm.queuemove()
+        moved += len(points)
+    robot_arm.waitmove()
+    return moved
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__.strip().split('Usage:')[-1])
+        sys.exit(1)
+    action = sys.argv[1]
+    if action == 'info':
+        with Trajectory(sys.argv[2]) as trajectory:
+            print(f'{len(trajectory)} points, steps: {trajectory.hassteps}')
+    elif action == 'precompute':
+        robot_arm = RobotArm(sys.argv[2])
+        with Trajectory(sys.argv[3]) as trajectory:
+            precompute(robot_arm, trajectory, sys.argv[4])
+    elif action == 'play':
+        robot_arm = RobotArm(sys.argv[2])
+        try:
+            with Trajectory(sys.argv[3]) as trajectory:
+                print(f'Moved through {play(robot_arm, trajectory)} points')
+        finally:
+            robot_arm.terminate()
@@ -0,0 +1,116 @@
+'''
+Transports a motor controller can be connected over, selected with the transport configuration:
+    serial      a serial port, or a pyserial URL such as socket://host:port for network endpoints
+    simulator   an in-process model of the firmware, running at simulation_speed times real time,
+                or as fast as possible if simulation_speed is 0
+'''
+import threading
+from time import monotonic
+from serial import Serial, serial_for_url
+from python.exception import InvalidConfigurationException
+from python.firmwaremodel import ModelLink, frametime
+
+
+TRANSPORTS = ('serial', 'simulator')
+
+
+def opentransport(config):
+    '''
+    Opens the transport of a motor controller.
+    :param config: A dictionary object with the keys: port, baud, timeout, and optionally transport
+    and simulation_speed.
+    :return: Serial port like object.
+    '''
+    transport = config.get('transport', 'serial')
+    if transport == 'serial':
+        if '://' in config['port']:
+            return serial_for_url(
+                config['port'], baudrate=config['baud'], timeout=config['timeout']
+            )
+        return Serial(port=config['port'], baudrate=config['baud'], timeout=config['timeout'])
+    if transport == 'simulator':
+        return SimulatedSerial(
+            config['baud'], config.get('simulation_speed', 1), config['timeout']
+        )
+    raise InvalidConfigurationException(f'transport must be one of: {", ".join(TRANSPORTS)}')
+
+
+class SimulatedSerial:
+    '''
+    Serial port like object connected to a firmware model. Replies become readable once the model
+    has finished handling the frame and the reply has been transmitted, measured on a simulated
+    clock which runs at a multiple of real time. At speed 0 the clock jumps ahead to the next
+    reply whenever the host waits for one.
+    '''
+    def __init__(self, baud, speed=1, timeout=None, latency=1):
+        '''
+        :param baud: Baud rate used for transmission times.
+        :param speed: Speed of the simulated clock relative to real time, 0 for as fast as possible.
+        :param timeout: Read timeout in seconds.
+        :param latency: Turnaround time in ms of the USB serial link and the firmware loop.
+        '''
+        self.baudrate = baud
+        self.speed = speed
+        self.timeout = timeout
+        self.link = ModelLink(latency)
+        self.start = monotonic()
+        self.skipped = 0  # ms the clock has jumped ahead
+        self.buffer = b''
+        self.condition = threading.Condition()
+        self.is_open = True
+
+    def now(self):
+        '''
+        :return: Simulated time in ms.
+        '''
+        return (monotonic() - self.start) * 1000 * self.speed + self.skipped
+
+    def write(self, data):
+        with self.condition:
+            now = self.now() + frametime(len(data), self.baudrate)
+            self.link.write(data, now, self.baudrate)
+            self.condition.notify_all()
+        return len(data)
+
+    def _deliver(self):
+        if self.speed == 0 and self.link.next() is not None and not self.buffer:
+            self.skipped += max(0, self.link.next() - self.now())
+        self.buffer += self.link.ready(self.now())
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self._deliver()
+            self.buffer = b''
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self._deliver()
+            return len(self.buffer)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self.condition:
+            while True:
+                self._deliver()
+                if self.buffer or not self.is_open:
+                    break
+                wait = None
+                if self.link.next() is not None and self.speed > 0:
+                    wait = (self.link.next() - self.now()) / 1000 / self.speed
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
@@ -0,0 +1,128 @@
+'''
+Validation of whole programs before any motion starts. The program is simulated against the robot
+arm's kinematics and the limits of the motor controller firmware, and every violation is reported
+instead of stopping at the first one.
+'''
+from collections import namedtuple
+from python.exception import IKError, ValidationError
+from python.firmwaremodel import MAX_FREQUENCY, MAX_INT, MAX_TIME_SLICES, UPDATE_INTERVAL_MILLIS
+from python.firmwaremodel import peakfrequency
+
+
+class Violation(namedtuple('Violation', ['index', 'command', 'message'])):
+    def __str__(self):
+        return f'{self.index}: {self.command}: {self.message}'
+
+
+def checkmove(robot_arm, point, angles, time=None, start_freqs=None, end_freqs=None):
+    '''
+    Checks a single move against the joint limits, reachability and firmware limits.
+    :param robot_arm: Robot arm whose kinematics and motors are used.
+    :param point: x, y, z coordinates of the destination.
+    :param angles: Motor angles the move starts from. Updated in place to the angles the motors end
+    up at, including step quantization.
+    :param time: Time in ms the move should take. Defaults to the time calculated by the arm.
+    :param start_freqs: Step frequencies the motors start the move at, e.g. of a blended move.
+    :param end_freqs: Step frequencies the motors end the move at.
+    :return: List of violation messages.
+    '''
+    try:
+        target = robot_arm.coordtoangles(*point, reference=angles)
+    except IKError as e:
+        return [f'unreachable: {str(e).splitlines()[-1]}']
+    messages = []
+    picker = robot_arm.picker_motor
+    if not picker.min_angle <= target[3] <= picker.max_angle:
+        messages.append(f'picker angle {target[3]:.2f} out of range')
+    if time is None:
+        time = robot_arm.calcmovetime(target, angles)
+    time = round(time, 2)
+    slices = int(time) // UPDATE_INTERVAL_MILLIS
+    if slices < 1:
+        messages.append(f'time {time} ms is shorter than one time slice')
+    elif slices > MAX_TIME_SLICES:
+        messages.append(f'time {time} ms needs more than {MAX_TIME_SLICES} time slices')
+    min_time = min([motor.min_time for motor in robot_arm.motors])
+    max_time = max([motor.max_time for motor in robot_arm.motors])
+    if not min_time <= time <= max_time:
+        messages.append(f'time {time} ms outside of the motor time range')
+    start_freqs = start_freqs or [0] * len(robot_arm.motors)
+    end_freqs = end_freqs or [0] * len(robot_arm.motors)
+    for i, motor in enumerate(robot_arm.motors):
+        steps = motor.angletosteps(target[i] - angles[i])
+        angles[i] += motor.stepstoangle(steps)
+        if abs(steps) * 200 > MAX_INT:
+            messages.append(f'{motor.name} {steps} steps overflow the firmware step count')
+        elif slices >= 1 and max(
+            peakfrequency(steps, time, start_freqs[i], end_freqs[i]), start_freqs[i], end_freqs[i]
+        ) > MAX_FREQUENCY:
+            messages.append(f'{motor.name} {steps} steps in {time} ms exceeds {MAX_FREQUENCY} Hz')
+    return messages
+
+
+def validate(robot_arm, commands):
+    '''
+    Simulates the commands from the current state of the robot arm and checks every move.
+    :param robot_arm: Robot arm the commands are to be executed on.
+    :param commands: List of commands.
+    :return: List of violations, empty if the program is valid.
+    '''
+    violations = []
+    angles = [motor.angle for motor in robot_arm.motors]
+    for index, command in enumerate(commands):
+        messages = []
+        try:
+            if command.type in ('move', 'm'):
+                if len(command.args) not in (3, 4):
+                    messages.append('expected x, y, z and optional time arguments')
+                else:
+                    point = list(map(int, command.args[:3]))
+                    time = float(command.args[3]) if len(command.args) == 4 else None
+                    messages += checkmove(robot_arm, point, angles, time)
+            elif command.type in ('wait', 'w'):
+                if float(command.args[0]) < 0:
+                    messages.append('negative wait time')
+            elif command.type in ('pin', 'p'):
+                if command.args[0] not in robot_arm.motor_controllers:
+                    messages.append(f'unknown motor controller {command.args[0]}')
+                if command.args[2] not in ('0', '1'):
+                    messages.append('pin state must be 0 or 1')
+            elif command.type in ('enable', 'e', 'disable', 'd'):
+                if command.args[0] not in [motor.name for motor in robot_arm.motors]:
+                    messages.append(f'unknown motor {command.args[0]}')
+        except (ValueError, IndexError):
+            messages.append('invalid arguments')
+        violations += [Violation(index, command, message) for message in messages]
+    return violations
+
+
+def validatepoints(robot_arm, points, times=None, exit_freqs=None, angles=None):
+    '''
+    Checks a trajectory of points from the current state of the robot arm.
+    :param points: List of x, y, z coordinates.
+    :param times: Optional list of times in ms, one per point, None for the calculated time.
+    :param exit_freqs: Optional list of the step frequencies the motors end each move at, as
+    planned by RobotArm.planblend. Each move starts at the exit frequencies of the one before.
+    :param angles: Motor angles the trajectory starts from. Defaults to the current motor angles.
+    :return: List of violations, empty if the trajectory is valid.
+    '''
+    violations = []
+    angles = list(angles) if angles is not None else [motor.angle for motor in robot_arm.motors]
+    for index, point in enumerate(points):
+        time = times[index] if times is not None else None
+        start_freqs = exit_freqs[index - 1] if exit_freqs is not None and index > 0 else None
+        end_freqs = exit_freqs[index] if exit_freqs is not None else None
+        violations += [
+            Violation(index, point, message)
+            for message in checkmove(robot_arm, point, angles, time, start_freqs, end_freqs)
+        ]
+    return violations
+
+
+def check(robot_arm, commands):
+    '''
+    Validates the commands and raises a ValidationError holding every violation if any is found.
+    '''
+    violations = validate(robot_arm, commands)
+    if violations:
+        raise ValidationError(violations)